@@ -918,6 +918,53 @@ test("xmltool.jstree.same_class", function() {
     equal(xmltool.jstree.same_class(node1, node2), true, 'same class');
 });
 
+test("xmltool.jstree_json_data", function() {
+    expect(4);
+    var form = $('<form id="xmltool-form">' +
+                 '<input type="hidden" id="_xml_filename" value="file.xml"/>' +
+                 '</form>').appendTo('body');
+    var tree = $('<div id="tree"></div>').appendTo('body');
+    var data = [{
+        data: 'list',
+        attr: {
+            'id': 'tree_texts:list',
+            'class': 'tree_texts:list'
+        },
+        state: 'closed'
+    }];
+    var old_ajax = $.ajax;
+    $.ajax = function(options){
+        equal(options.url, 'http://fake.url', 'url');
+        deepEqual(options.data, {tree_id: 'tree_texts:list',
+                                 filename: 'file.xml'}, 'params');
+        // The result of factory.get_jstree_children
+        options.success.call(options.context, [{
+            data: 'text',
+            attr: {
+                'id': 'tree_texts:list:text',
+                'class': 'tree_texts:list:text'
+            },
+            children: []
+        }]);
+    };
+    try {
+        tree.jstree({
+            plugins: ['json_data'],
+            json_data: xmltool.jstree_json_data(data, 'http://fake.url')
+        });
+        var node = tree.find('#' + xmltool.escape_id('tree_texts:list'));
+        equal(node.find('li').length, 0, 'children not loaded');
+        tree.jstree('open_node', node);
+        equal(node.find('#' + xmltool.escape_id('tree_texts:list:text')).length,
+              1, 'children loaded when opening the node');
+    }
+    finally {
+        $.ajax = old_ajax;
+        tree.remove();
+        form.remove();
+    }
+});
+
 /*
 jsdom.env({
   html: "<html><body></body></html>",
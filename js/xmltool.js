@@ -164,6 +164,29 @@ var create_nodes = function(tree, data, parentobj, position){
         },
         get_first_class: function(obj){
             return obj.attr('class').split(' ')[0];
+        },
+        // The structural changes made in the form, used to only submit the
+        // changes (see the partial option).
+        operations: [],
+        add_operation: function(operation){
+            xmltool.operations.push(operation);
+        },
+        jstree_json_data: function(data, url){
+            // The json_data settings of the jstree: the children of the
+            // closed nodes are loaded from url when they are opened (see
+            // factory.get_jstree_children).
+            return {
+                data: data,
+                ajax: {
+                    url: url,
+                    data: function(node){
+                        return {
+                            tree_id: node.attr('id'),
+                            filename: $('form#xmltool-form #_xml_filename').val()
+                        };
+                    }
+                }
+            };
         }
     }
 
@@ -226,6 +249,11 @@ var create_nodes = function(tree, data, parentobj, position){
                     reference_elt.after(button);
                 }
 
+                var siblings = drag_node.parent().children(
+                    '.' + xmltool.escape_id(xmltool.get_first_class(drag_node)));
+                xmltool.add_operation(
+                    ['move', drag_node_id, siblings.index(drag_node)]);
+
                 var elts = drag_node.parent().children();
                 var longprefix = xmltool.get_prefix(drag_node.attr('id'));
                 var prefix = xmltool.get_prefix(longprefix);
@@ -245,6 +273,8 @@ var create_nodes = function(tree, data, parentobj, position){
 (function($){
 
     var default_options = {
+        // Only submit the changes made in the form
+        partial: false,
         open_dialog: function(dialog){
             dialog.modal('show');
         },
@@ -292,6 +322,70 @@ var create_nodes = function(tree, data, parentobj, position){
         };
 
         $.extend(self, {
+            load_list_items: function(btn, async){
+                // Load the next items of a list rendered with a limit
+                var loaded = false;
+                var params = {
+                    elt_id: btn.data('id'),
+                    start: btn.data('start'),
+                    limit: btn.data('limit'),
+                    filename: $('form#xmltool-form #_xml_filename').val()
+                };
+                $.ajax({
+                    type: 'GET',
+                    url: settings.list_items_url,
+                    data: params,
+                    dataType: 'json',
+                    async: async,
+                    success: function(data, textStatus, jqXHR){
+                        var obj = $(data.html);
+                        // We use a fake 'div' since we don't get a container,
+                        // and we need one to attach the events!
+                        self.set_btn_event($('<div/>').append(obj));
+                        btn.replaceWith(obj);
+                        loaded = true;
+                    },
+                    error: function(jqXHR, textStatus, errorThrown){
+                        console.log('Error ajax loading');
+                    }
+                });
+                return loaded;
+            },
+            get_changed_fields: function(form){
+                var lis = [];
+                form.find('textarea, input').each(function(){
+                    if (this.name && this.type != 'hidden' &&
+                        this.value != this.defaultValue){
+                        lis.push(['set', this.name, this.value]);
+                    }
+                });
+                return lis;
+            },
+            submit_partial: function(form){
+                // Only submit the operations, the values are set after the
+                // structural changes since the names can have been updated.
+                var operations = xmltool.operations.concat(
+                    self.get_changed_fields(form));
+                form.find('textarea, input, select').not('[name^=_xml_]').prop(
+                    'disabled', true);
+                $('<input type="hidden" name="_xml_operations"/>').val(
+                    JSON.stringify(operations)).appendTo(form);
+                return true;
+            },
+            load_all_list_items: function(p){
+                // The items which are not loaded would be removed from the
+                // XML file when submitting the form.
+                var btns = p.find('.btn-list-more');
+                while(btns.length){
+                    for(var i=0; i < btns.length; i++){
+                        if (!self.load_list_items($(btns[i]), false)){
+                            return false;
+                        }
+                    }
+                    btns = p.find('.btn-list-more');
+                }
+                return true;
+            },
             set_btn_event: function(p){
                     p.find('textarea').autosize().focus(
                         function(){
@@ -345,6 +439,7 @@ var create_nodes = function(tree, data, parentobj, position){
                 else{
                     parent_obj.remove();
                 }
+                xmltool.add_operation(['delete', parent_obj.data('id')]);
                 delete_node('tree_' + parent_obj.data('id'));
             });
 
@@ -368,6 +463,7 @@ var create_nodes = function(tree, data, parentobj, position){
                 else{
                     fieldset.remove();
                 }
+                xmltool.add_operation(['delete', fieldset.attr('id')]);
                 delete_node('tree_' + fieldset.attr('id'));
 
             });
@@ -377,6 +473,7 @@ var create_nodes = function(tree, data, parentobj, position){
                 var nexts = parent_obj.nextAll();
                 parent_obj.prev().remove();
                 parent_obj.remove();
+                xmltool.add_operation(['delete', parent_obj.data('id')]);
                 delete_node('tree_' + parent_obj.data('id'));
 
                 var longprefix = xmltool.get_prefix(parent_obj.data('id'));
@@ -403,6 +500,7 @@ var create_nodes = function(tree, data, parentobj, position){
 
                         //jstree
                         add_node(data);
+                        xmltool.add_operation(['add', params.elt_id]);
                     },
                     error: function(jqXHR, textStatus, errorThrown){
                       console.log('Error ajax loading');
@@ -430,6 +528,7 @@ var create_nodes = function(tree, data, parentobj, position){
 
                         //jstree
                         add_node(data);
+                        xmltool.add_operation(['add', params.elt_id]);
                         $this.val($this.find('option:first').val());
                     },
                     error: function(jqXHR, textStatus, errorThrown){
@@ -467,6 +566,7 @@ var create_nodes = function(tree, data, parentobj, position){
 
                         //jstree
                         add_node(data);
+                        xmltool.add_operation(['add', params.elt_id]);
                         $this.val($this.find('option:first').val());
                     },
                     error: function(jqXHR, textStatus, errorThrown){
@@ -502,6 +602,7 @@ var create_nodes = function(tree, data, parentobj, position){
 
                         //jstree
                         add_node(data);
+                        xmltool.add_operation(['add', params.elt_id]);
 
                     },
                     error: function(jqXHR, textStatus, errorThrown){
@@ -510,6 +611,10 @@ var create_nodes = function(tree, data, parentobj, position){
                 });
             });
 
+            p.find('.btn-list-more').on('click', function(){
+                self.load_list_items($(this), true);
+            });
+
             p.find('.btn-comment').on('click', function(){
                 var self = $(this);
 
@@ -560,6 +665,13 @@ var create_nodes = function(tree, data, parentobj, position){
 
         return this.each(function(){
             self.set_btn_event($(this));
+            $(this).find('form').add($(this).filter('form')).on('submit', function(){
+                if (settings.partial){
+                    // The items which are not loaded are not changed
+                    return self.submit_partial($(this));
+                }
+                return self.load_all_list_items($(this));
+            });
         });
     };
 })(jQuery);
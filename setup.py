@@ -19,7 +19,6 @@ setup(name='xmltool',
         'Intended Audience :: Developers',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.6',
         'Programming Language :: Python :: 2.7',
         'Programming Language :: JavaScript',
         'Topic :: Text Processing :: Markup :: XML',
@@ -48,5 +47,7 @@ setup(name='xmltool',
       ],
       entry_points="""
       # -*- Entry points: -*-
+      [console_scripts]
+      xmltool = xmltool.cli:main
       """,
       )
@@ -5,6 +5,7 @@ from lxml import etree
 import tw2.core as twc
 import tw2.core.testbase as tw2test
 import os.path
+import threading
 from xmltool import dtd_parser, utils, factory
 from xmltool.elements import (
     Element,
@@ -1708,20 +1709,20 @@ class TestElementWithAttributes(ElementTester):
         dic = dtd_parser.parse(dtd_str=self.dtd_str)
         obj = dic[root.tag]()
         obj.load_from_xml(root)
-        self.assertEqual(obj._attribute_names, ['idtexts', 'name'])
+        self.assertEqual(obj._attribute_names, ('idtexts', 'name'))
         self.assertEqual(obj._attributes, {
             'idtexts': 'id_texts',
             'name': 'my texts',
         })
-        self.assertEqual(obj.text._attribute_names, ['idtext'])
+        self.assertEqual(obj.text._attribute_names, ('idtext',))
         self.assertEqual(obj.text._attributes, {
             'idtext': 'id_text',
         })
-        self.assertEqual(obj.text1[0]._attribute_names, ['idtext1'])
+        self.assertEqual(obj.text1[0]._attribute_names, ('idtext1',))
         self.assertEqual(obj.text1[0]._attributes, {
             'idtext1': 'id_text1_1',
         })
-        self.assertEqual(obj.text1[1]._attribute_names, ['idtext1'])
+        self.assertEqual(obj.text1[1]._attribute_names, ('idtext1',))
         self.assertEqual(obj.text1[1]._attributes, None)
 
     def test_walk(self):
@@ -1830,6 +1831,74 @@ class TestElementComments(ElementTester):
         self.assertEqual(obj.directors.director[0].firstname._comment,
                          ' director firstname comment ')
 
+    def test_to_xml_reuse(self):
+        root = etree.fromstring(self.xml)
+        dic = dtd_parser.parse(dtd_str=self.dtd_str)
+        obj = dic[root.tag]()
+        obj.load_from_xml(root)
+        length = len(root)
+        actors = obj.actors._xml_node
+        actor = obj.actors.actor[0]._xml_node
+        obj.year._value = '1998'
+        obj.actors.actor[1].name._comment = ' new comment '
+        xml = obj.to_xml()
+        # Nothing has changed in the first actor, its node is copied
+        self.assertTrue(xml.find('actors') is not actors)
+        self.assertTrue(xml.find('actors/actor') is not actor)
+        xml_str = etree.tostring(
+            xml.getroottree(),
+            pretty_print=True,
+            xml_declaration=True,
+            encoding='UTF-8',
+        )
+        expected = self.xml.replace('1997', '1998').replace(
+            'actor 2 name comment', 'new comment')
+        self.assertEqual(xml_str, expected)
+        xml_str = etree.tostring(xml)
+        # The loaded tree is not changed
+        self.assertEqual(len(root), length)
+        self.assertEqual(obj.actors._xml_node, actors)
+        self.assertEqual(actor.getparent(), actors)
+
+        # The given trees are never changed
+        obj.name._value = 'Titanic 2'
+        xml2 = obj.to_xml()
+        self.assertEqual(etree.tostring(xml), xml_str)
+        self.assertEqual(xml2.find('name').text, 'Titanic 2')
+
+    def test_write_indentation(self):
+        # The file is indented with 6 spaces, the value of resume is kept
+        lines = []
+        for line in self.xml.split('\n'):
+            text = line.lstrip(' ')
+            if text.startswith('<') and not text.startswith('</resume>'):
+                line = ' ' * (3 * (len(line) - len(text))) + text
+            lines += [line]
+        xml_str = '\n'.join(lines)
+        self.assertTrue('\n      <!-- name comment -->' in xml_str)
+        dic = dtd_parser.parse(dtd_str=self.dtd_str)
+        expected = self.xml.replace('1997', '1998').replace(
+            "<?xml version='1.0' encoding='UTF-8'?>\n",
+            "<?xml version='1.0' encoding='UTF-8'?>\n"
+            '<!DOCTYPE Movie SYSTEM "http://dtd.url">\n')
+        filename = 'tests/test.xml'
+        self.assertFalse(os.path.isfile(filename))
+        try:
+            for transform in [None, lambda s: s]:
+                root = etree.fromstring(xml_str)
+                root_str = etree.tostring(root)
+                obj = dic[root.tag]()
+                obj.load_from_xml(root)
+                # The loaded tree is not changed
+                self.assertEqual(etree.tostring(root), root_str)
+                obj.year._value = '1998'
+                obj.write(filename, dtd_url='http://dtd.url', validate=False,
+                          transform=transform)
+                self.assertEqual(open(filename, 'r').read(), expected)
+        finally:
+            if os.path.isfile(filename):
+                os.remove(filename)
+
 
 class TestWalk(TestCase):
     dtd_str = '''
@@ -1906,3 +1975,130 @@ class TestWalk(TestCase):
             obj.text1[1].text11,
         ]
         self.assertEqual(lis, expected)
+
+
+class TestJstree(TestCase):
+
+    def setUp(self):
+        dic = dtd_parser.parse(dtd_str=MOVIE_DTD)
+        root = etree.fromstring(MOVIE_XML_TITANIC)
+        self.obj = dic[root.tag]()
+        self.obj.load_from_xml(root)
+
+    def test_iter_jstree_json(self):
+        for max_depth in [None, 1, 2, 3]:
+            result = ''.join(self.obj.iter_jstree_json([],
+                                                       max_depth=max_depth))
+            self.assertEqual(json.loads(result),
+                             self.obj.to_jstree_dict([], max_depth=max_depth))
+
+    def test_get_jstree_children(self):
+        # Loading the closed nodes on demand gives the full tree
+        def load(dic):
+            if dic.get('state') == 'closed':
+                del dic['state']
+                dic['children'] = elements.get_jstree_children(
+                    self.obj, dic['attr']['id'])
+            for child in dic['children']:
+                if isinstance(child, list):
+                    for c in child:
+                        load(c)
+                else:
+                    load(child)
+            return dic
+
+        result = load(self.obj.to_jstree_dict([], max_depth=1))
+        self.assertEqual(result, self.obj.to_jstree_dict([]))
+
+
+class TestListLimit(TestCase):
+
+    def test_to_html(self):
+        dic = dtd_parser.parse(dtd_str=MOVIE_DTD)
+        root = etree.fromstring(MOVIE_XML_TITANIC)
+        obj = dic[root.tag]()
+        obj.load_from_xml(root)
+        html = obj.to_html(limit=1)
+        self.assertTrue(len(html) < len(obj.to_html()))
+
+        # Loading the next items gives the full form
+        while 'btn-list-more' in html:
+            start = html.index('<a class="btn btn-list-more"')
+            end = html.index('</a>', start) + len('</a>')
+            btn = etree.fromstring(html[start:end])
+            result = elements.get_list_html_from_str_id(
+                obj, btn.attrib['data-id'], int(btn.attrib['data-start']),
+                int(btn.attrib['data-limit']))
+            html = html[:start] + result + html[end:]
+        self.assertEqual(html, obj.to_html())
+
+
+class TestHtmlCache(TestCase):
+
+    def test_to_html(self):
+        dic = dtd_parser.parse(dtd_str=MOVIE_DTD)
+
+        def load(xml_str=MOVIE_XML_TITANIC_COMMENTS):
+            root = etree.fromstring(xml_str)
+            obj = dic[root.tag]()
+            obj.load_from_xml(root)
+            return obj
+
+        expected = load().to_html()
+        elements.set_html_cache(1000000)
+        try:
+            self.assertEqual(load().to_html(), expected)
+            size = len(elements._html_cache)
+            self.assertEqual(load().to_html(), expected)
+            self.assertEqual(len(elements._html_cache), size)
+
+            # Only the changed parts are rendered again
+            obj = load()
+            obj.actors.actor[1].name._value = 'Winslet updated'
+            html = obj.to_html()
+            self.assertEqual(html, expected.replace('>Winslet<',
+                                                    '>Winslet updated<'))
+            self.assertEqual(len(elements._html_cache), size + 3)
+
+            obj = load(MOVIE_XML_TITANIC_COMMENTS.replace('Kate', 'K.'))
+            html = obj.to_html()
+            self.assertEqual(html, expected.replace('>Kate<', '>K.<'))
+        finally:
+            elements.set_html_cache(None)
+
+
+class TestThreadSafety(TestCase):
+
+    def test_render(self):
+        # The classes are shared between all the threads
+        dic = dtd_parser.parse(dtd_str=MOVIE_DTD)
+
+        def render():
+            root = etree.fromstring(MOVIE_XML_TITANIC_COMMENTS)
+            obj = dic[root.tag]()
+            obj.load_from_xml(root)
+            obj.actors.actor[0].name._value = 'updated'
+            return (
+                etree.tostring(obj.to_xml()),
+                obj.to_html(),
+                json.dumps(obj.to_jstree_dict([])),
+            )
+
+        expected = render()
+        errors = []
+
+        def target():
+            try:
+                for i in range(20):
+                    result = render()
+                    if result != expected:
+                        errors.append(result)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=target) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+from unittest import TestCase
+from StringIO import StringIO
+import os.path
+import sys
+import shutil
+import simplejson as json
+from xmltool import cli, dtd_parser, utils
+
+
+class TestCli(TestCase):
+
+    def test_stats(self):
+        stdout = StringIO()
+        self.assertEqual(
+            cli.main(['stats', '--dtd-url', 'tests/exercise.dtd'], stdout),
+            0)
+        stats = json.loads(stdout.getvalue())
+        self.assertEqual(stats['elements'], 9)
+        self.assertEqual(stats['roots'], ['Exercise'])
+        self.assertTrue('form_bytes' not in stats)
+
+        catalog_filename = 'tests/catalog.xml'
+        open(catalog_filename, 'w').write(
+            '<catalog xmlns="urn:oasis:names:tc:entity:xmlns:xml:catalog">'
+            '<system systemId="http://xmltool.lereskp.fr/static/exercise.dtd"'
+            ' uri="exercise.dtd"/>'
+            '</catalog>')
+        try:
+            # The DTD of the sample is used
+            stdout = StringIO()
+            cli.main(['--catalog', catalog_filename, 'stats',
+                      '--sample', 'tests/exercise.xml'], stdout)
+            sample_stats = json.loads(stdout.getvalue())
+        finally:
+            utils.clear_catalog()
+            os.remove(catalog_filename)
+        self.assertEqual(sample_stats['elements'], 9)
+        self.assertEqual(sample_stats['sample_nodes'], 26)
+        self.assertTrue(sample_stats['form_bytes'] > 0)
+
+        try:
+            cli.main(['stats'], StringIO())
+            assert 0
+        except Exception, e:
+            self.assertEqual(str(e), 'No dtd url given')
+
+    def test_file_commands(self):
+        dirname = 'tests/cli-files'
+        self.assertFalse(os.path.exists(dirname))
+        xml_str = open('tests/exercise.xml', 'r').read().replace(
+            'PUBLIC "http://xmltool.lereskp.fr/static/exercise.dtd" '
+            '"http://xmltool.lereskp.fr/static/exercise.dtd"',
+            'SYSTEM "%s"' % os.path.abspath('tests/exercise.dtd'))
+        try:
+            os.makedirs(os.path.join(dirname, 'sub'))
+            for filename in ['a.xml', 'b.xml', 'sub/c.xml']:
+                open(os.path.join(dirname, filename), 'w').write(xml_str)
+            open(os.path.join(dirname, 'sub/invalid.xml'), 'w').write(
+                xml_str.replace('<number>1</number>', ''))
+            open(os.path.join(dirname, 'notxml.txt'), 'w').write('')
+
+            self.assertEqual(
+                list(cli.iter_filenames([dirname, 'tests/exercise.xml'])), [
+                    os.path.join(dirname, 'a.xml'),
+                    os.path.join(dirname, 'b.xml'),
+                    os.path.join(dirname, 'sub/c.xml'),
+                    os.path.join(dirname, 'sub/invalid.xml'),
+                    'tests/exercise.xml',
+                ])
+
+            for jobs in ['1', '2']:
+                stdout = StringIO()
+                progress = StringIO()
+                old_stderr = sys.stderr
+                try:
+                    sys.stderr = progress
+                    code = cli.main(['validate', '--jobs', jobs, dirname],
+                                    stdout)
+                finally:
+                    sys.stderr = old_stderr
+                self.assertEqual(code, 1)
+                summary = json.loads(stdout.getvalue())
+                self.assertEqual(summary['command'], 'validate')
+                self.assertEqual(summary['total'], 4)
+                self.assertEqual(summary['ok'], 3)
+                self.assertEqual(summary['errors'], 1)
+                self.assertEqual(
+                    [f['status'] for f in summary['files']],
+                    ['ok', 'ok', 'ok', 'error'])
+                self.assertTrue(summary['files'][3]['error'].startswith(
+                    'DocumentInvalid: '))
+                lines = progress.getvalue().splitlines()
+                self.assertEqual(len(lines), 4)
+                self.assertTrue(lines[-1].startswith('[4/4] '))
+            # The schema cache is only enabled during the command
+            self.assertEqual(dtd_parser._cache, None)
+
+            a_filename = os.path.join(dirname, 'a.xml')
+            stdout = StringIO()
+            self.assertEqual(cli.main(['render', '-q', '-j', '1', '--limit',
+                                       '1', a_filename], stdout), 0)
+            html = open(os.path.join(dirname, 'a.html'), 'r').read()
+            self.assertTrue(html.startswith('<form'))
+            self.assertTrue('btn-list-more' in html)
+
+            # The HTML is written in UTF-8
+            open(a_filename, 'w').write(xml_str.replace(
+                'favorite color?', 'favorite caf\xc3\xa9?'))
+            stdout = StringIO()
+            self.assertEqual(cli.main(['render', '-q', '-j', '1',
+                                       a_filename], stdout), 0)
+            html = open(os.path.join(dirname, 'a.html'), 'r').read()
+            self.assertTrue('favorite caf\xc3\xa9?' in html)
+            open(a_filename, 'w').write(xml_str)
+
+            stdout = StringIO()
+            self.assertEqual(cli.main(['jstree', '-q', '-j', '1',
+                                       '--max-depth', '1', a_filename],
+                                      stdout), 0)
+            data = json.loads(
+                open(os.path.join(dirname, 'a.json'), 'r').read())
+            self.assertEqual(data['state'], 'closed')
+
+            open(a_filename, 'w').write(xml_str.replace('\n', ''))
+            stdout = StringIO()
+            self.assertEqual(cli.main(['reformat', '-q', '-j', '1',
+                                       a_filename], stdout), 0)
+            self.assertEqual(open(a_filename, 'r').read(), xml_str)
+        finally:
+            shutil.rmtree(dirname)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+from unittest import TestCase
+from lxml import etree
+import simplejson as json
+from xmltool import dtd_parser, diff
+
+
+DTD = '''
+<!ELEMENT texts (title, (tag1|tag2)?, text*)>
+<!ELEMENT title (#PCDATA)>
+<!ELEMENT tag1 (#PCDATA)>
+<!ELEMENT tag2 (#PCDATA)>
+<!ELEMENT text (name, value?)>
+<!ATTLIST text idtext ID #IMPLIED>
+<!ATTLIST text lang CDATA #IMPLIED>
+<!ELEMENT name (#PCDATA)>
+<!ELEMENT value (#PCDATA)>
+'''
+
+XML = '''<texts>
+  <title>Title</title>
+  <tag1>tag1</tag1>
+  <text idtext="t1">
+    <name>text 1</name>
+  </text>
+  <text idtext="t2">
+    <name>text 2</name>
+  </text>
+  <!-- Comment -->
+  <text idtext="t3" lang="fr">
+    <name>text 3</name>
+    <value>value 3</value>
+  </text>
+</texts>'''
+
+
+class TestDiff(TestCase):
+
+    def setUp(self):
+        self.dic = dtd_parser.parse(dtd_str=DTD)
+
+    def load(self, xml=XML):
+        root = etree.fromstring(xml)
+        obj = self.dic[root.tag]()
+        obj.load_from_xml(root)
+        return obj
+
+    def to_str(self, obj):
+        # The loaded nodes keep their indentation and attribute order
+        parser = etree.XMLParser(remove_blank_text=True)
+        xml = etree.fromstring(etree.tostring(obj.to_xml()), parser)
+        return etree.tostring(xml, method='c14n')
+
+    def assertPatch(self, old, new, operations):
+        # The operations can be serialized
+        diff.patch(old, json.loads(json.dumps(operations)))
+        self.assertEqual(self.to_str(old), self.to_str(new))
+
+    def test__get_key(self):
+        obj = self.load()
+        text = obj.text[0]
+        self.assertEqual(diff._get_key(text, {}), None)
+        self.assertEqual(diff._get_key(text, {'text': 'idtext'}), 't1')
+        self.assertEqual(diff._get_key(text, {'text': 'lang'}), None)
+        key = lambda e: e.name._value
+        self.assertEqual(diff._get_key(text, {'text': key}), 'text 1')
+
+    def test__match_items(self):
+        old = self.load().text
+        new = self.load().text
+        new.insert(0, new.pop())
+        matched, used = diff._match_items(old, new, {})
+        self.assertEqual(matched, list(old))
+        self.assertEqual(used, set([id(e) for e in old]))
+
+        matched, used = diff._match_items(old, new, {'text': 'idtext'})
+        self.assertEqual(matched, [old[2], old[0], old[1]])
+
+    def test_diff_same(self):
+        self.assertEqual(diff.diff(self.load(), self.load()), [])
+
+    def test_diff_values(self):
+        old = self.load()
+        new = self.load()
+        new.title._value = 'New title'
+        new.text[0]._comment = 'New comment'
+        new.text[2]._comment = None
+        new.text[1].add_attribute('lang', 'en')
+        new.text[2]._attributes = {'idtext': 't3'}
+        operations = diff.diff(old, new)
+        expected = [
+            ('set', 'texts:title:_value', 'New title'),
+            ('set', 'texts:list__text:0:text:_comment', 'New comment'),
+            ('set', 'texts:list__text:1:text:_attrs:lang', 'en'),
+            ('set', 'texts:list__text:2:text:_comment', ''),
+            ('set', 'texts:list__text:2:text:_attrs:lang', None),
+        ]
+        self.assertEqual(operations, expected)
+        self.assertPatch(old, new, operations)
+
+    def test_diff_elements(self):
+        old = self.load()
+        new = self.load()
+        del new.tag1
+        new.add('tag2', 'tag2')
+        new.text[0].add('value', 'value 1')
+        del new.text[2].value
+        operations = diff.diff(old, new)
+        expected = [
+            ('delete', 'texts:tag1'),
+            ('add', 'texts:tag2'),
+            ('set', 'texts:tag2:_value', 'tag2'),
+            ('add', 'texts:list__text:0:text:value'),
+            ('set', 'texts:list__text:0:text:value:_value', 'value 1'),
+            ('delete', 'texts:list__text:2:text:value'),
+        ]
+        self.assertEqual(operations, expected)
+        self.assertPatch(old, new, operations)
+
+    def test_diff_list(self):
+        old = self.load()
+        new = self.load()
+        new.text.insert(0, new.text.pop())
+        # Matched by position
+        operations = diff.diff(old, new)
+        expected = [
+            ('set', 'texts:list__text:0:text:_comment', ' Comment '),
+            ('set', 'texts:list__text:0:text:_attrs:idtext', 't3'),
+            ('set', 'texts:list__text:0:text:_attrs:lang', 'fr'),
+            ('set', 'texts:list__text:0:text:name:_value', 'text 3'),
+            ('add', 'texts:list__text:0:text:value'),
+            ('set', 'texts:list__text:0:text:value:_value', 'value 3'),
+            ('set', 'texts:list__text:1:text:_attrs:idtext', 't1'),
+            ('set', 'texts:list__text:1:text:name:_value', 'text 1'),
+            ('set', 'texts:list__text:2:text:_comment', ''),
+            ('set', 'texts:list__text:2:text:_attrs:idtext', 't2'),
+            ('set', 'texts:list__text:2:text:_attrs:lang', None),
+            ('set', 'texts:list__text:2:text:name:_value', 'text 2'),
+            ('delete', 'texts:list__text:2:text:value'),
+        ]
+        self.assertEqual(operations, expected)
+        self.assertPatch(old, new, operations)
+
+        old = self.load()
+        operations = diff.diff(old, new, {'text': 'idtext'})
+        expected = [('move', 'texts:list__text:2:text', 0)]
+        self.assertEqual(operations, expected)
+        self.assertPatch(old, new, operations)
+
+    def test_diff_list_keys(self):
+        old = self.load()
+        new = self.load()
+        del new.text[0]
+        text = new.add('text')
+        text.add_attribute('idtext', 't4')
+        text.add('name', 'text 4')
+        new.text.insert(1, new.text.pop())
+        new.text[0].name._value = 'text 2 updated'
+        operations = diff.diff(old, new, {'text': 'idtext'})
+        expected = [
+            ('delete', 'texts:list__text:0:text'),
+            ('add', 'texts:list__text:1:text'),
+            ('set', 'texts:list__text:0:text:name:_value', 'text 2 updated'),
+            ('set', 'texts:list__text:1:text:_attrs:idtext', 't4'),
+            ('add', 'texts:list__text:1:text:name'),
+            ('set', 'texts:list__text:1:text:name:_value', 'text 4'),
+        ]
+        self.assertEqual(operations, expected)
+        self.assertPatch(old, new, operations)
+
+        # Use a function as key
+        old = self.load()
+        new = self.load()
+        new.text.reverse()
+        operations = diff.diff(old, new, {'text': lambda e: e.name._value})
+        expected = [
+            ('move', 'texts:list__text:2:text', 0),
+            ('move', 'texts:list__text:2:text', 1),
+        ]
+        self.assertEqual(operations, expected)
+        self.assertPatch(old, new, operations)
+
+    def test__get_increasing(self):
+        self.assertEqual(diff._get_increasing([]), set())
+        self.assertEqual(diff._get_increasing([0, 1, 2]), set([0, 1, 2]))
+        self.assertEqual(diff._get_increasing([2, 0, 1]), set([1, 2]))
+        self.assertEqual(len(diff._get_increasing([3, 0, 4, 1, 5, 2])), 3)
+
+    def test_diff_list_moves(self):
+        def load(ids):
+            return self.load('<texts><title>Title</title>%s</texts>' % ''.join(
+                '<text idtext="t%s"><name>%s</name></text>' % (i, i)
+                for i in ids))
+
+        # Only the moved item is moved
+        old = load(range(100))
+        new = load(range(1, 100) + [0])
+        operations = diff.diff(old, new, {'text': 'idtext'})
+        self.assertEqual(operations, [('move', 'texts:list__text:0:text', 99)])
+        self.assertPatch(old, new, operations)
+
+        old = load(range(6))
+        new = load([5, 1, 'new', 2, 0, 3])
+        operations = diff.diff(old, new, {'text': 'idtext'})
+        self.assertEqual(operations, [
+            ('delete', 'texts:list__text:4:text'),
+            ('move', 'texts:list__text:4:text', 0),
+            ('add', 'texts:list__text:3:text'),
+            ('move', 'texts:list__text:1:text', 4),
+            ('set', 'texts:list__text:2:text:_attrs:idtext', 'tnew'),
+            ('add', 'texts:list__text:2:text:name'),
+            ('set', 'texts:list__text:2:text:name:_value', 'new'),
+        ])
+        self.assertPatch(old, new, operations)
+
+    def test_diff_empty(self):
+        old = self.dic['texts']()
+        new = self.load()
+        operations = diff.diff(old, new)
+        self.assertPatch(old, new, operations)
+
+        old = self.load()
+        new = self.dic['texts']()
+        operations = diff.diff(old, new)
+        self.assertPatch(old, new, operations)
+
+    def test_diff_error(self):
+        try:
+            diff.diff(self.load(), self.dic['text']())
+            assert 0
+        except Exception, e:
+            self.assertEqual(str(e), "Can't compare texts with text")
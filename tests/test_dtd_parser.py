@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
 from unittest import TestCase
+import threading
+import time
+from lxml import etree
 from xmltool import dtd_parser
 import xmltool.utils as utils
 from xmltool.elements import (
@@ -312,6 +315,58 @@ class DtdParser(TestCase):
         expected = ('Exercise', [('idexercise', 'ID', '#IMPLIED')])
         self.assertEqual(result, expected)
 
+        attr = '''Exercise
+            type (qcm | mqm) "qcm"
+            version CDATA #FIXED "1.0"
+            title CDATA 'My title'
+            format NOTATION (gif|png) #REQUIRED
+            idexercise ID #IMPLIED'''
+        result = dtd_parser.parse_attribute(attr)
+        expected = ('Exercise', [
+            ('type', '(qcm|mqm)', '"qcm"'),
+            ('version', 'CDATA', '#FIXED "1.0"'),
+            ('title', 'CDATA', "'My title'"),
+            ('format', 'NOTATION(gif|png)', '#REQUIRED'),
+            ('idexercise', 'ID', '#IMPLIED'),
+        ])
+        self.assertEqual(result, expected)
+
+        try:
+            dtd_parser.parse_attribute('Exercise idexercise ID')
+            assert 0
+        except Exception, e:
+            self.assertEqual(str(e),
+                             'Error parsing attribute Exercise idexercise ID')
+
+    def test__get_attribute_info(self):
+        attrs = [
+            ('type', '(qcm|mqm)', '"qcm"'),
+            ('version', 'CDATA', '#FIXED "1.0"'),
+            ('title', 'CDATA', "'My title'"),
+            ('format', 'NOTATION(gif|png)', '#REQUIRED'),
+            ('idexercise', 'ID', '#REQUIRED'),
+        ]
+        types, values, defaults, required = dtd_parser._get_attribute_info(
+            attrs)
+        self.assertEqual(types, {
+            'type': 'ENUMERATION',
+            'version': 'CDATA',
+            'title': 'CDATA',
+            'format': 'NOTATION',
+            'idexercise': 'ID',
+        })
+        self.assertEqual(values, {
+            'type': frozenset(['qcm', 'mqm']),
+            'version': frozenset(['1.0']),
+            'format': frozenset(['gif', 'png']),
+        })
+        self.assertEqual(defaults, {
+            'type': 'qcm',
+            'version': '1.0',
+            'title': 'My title',
+        })
+        self.assertEqual(required, frozenset(['format', 'idexercise']))
+
     def test_dtd_to_dict(self):
         expected = {
             'name': {'elts': '#PCDATA', 'attrs': []},
@@ -434,8 +489,12 @@ class DtdParser(TestCase):
         self.assertTrue(issubclass(tag, TextElement))
         self.assertEqual(tag._tagname, 'tag')
         self.assertEqual(tag._is_empty, False)
-        self.assertEqual(tag._attribute_names, ['idtag'])
-        self.assertEqual(tag._sub_elements, [])
+        self.assertEqual(tag._attribute_names, ('idtag',))
+        self.assertEqual(tag._attribute_types, {'idtag': 'ID'})
+        self.assertEqual(tag._attribute_values, {})
+        self.assertEqual(tag._attribute_defaults, {})
+        self.assertEqual(tag._required_attributes, frozenset())
+        self.assertEqual(tag._sub_elements, ())
 
         dtd_dict = {
             'tag': {'elts': '(#PCDATA|tag1|tag2)*', 'attrs': []},
@@ -446,11 +505,11 @@ class DtdParser(TestCase):
         self.assertTrue(issubclass(tag, TextElement))
         self.assertEqual(tag._tagname, 'tag')
         self.assertEqual(tag._is_empty, False)
-        self.assertEqual(tag._attribute_names, [])
-        self.assertEqual(tag._sub_elements, [])
-        # dtd_dict has changed because of the mixed content
+        self.assertEqual(tag._attribute_names, ())
+        self.assertEqual(tag._sub_elements, ())
+        # dtd_dict is not changed by the mixed content
         self.assertEqual(
-            dtd_dict, {'tag': {'elts': 'tag1?,tag2?', 'attrs': []}})
+            dtd_dict, {'tag': {'elts': '(#PCDATA|tag1|tag2)*', 'attrs': []}})
 
         dtd_dict = {
             'tag': {'elts': '(tag1)*', 'attrs': []},
@@ -461,8 +520,8 @@ class DtdParser(TestCase):
         self.assertTrue(issubclass(tag, Element))
         self.assertEqual(tag._tagname, 'tag')
         self.assertEqual(tag._is_empty, False)
-        self.assertEqual(tag._attribute_names, [])
-        self.assertEqual(tag._sub_elements, [])
+        self.assertEqual(tag._attribute_names, ())
+        self.assertEqual(tag._sub_elements, ())
 
         dtd_dict = {
             'tag': {'elts': '(tag1|tag2)', 'attrs': []},
@@ -473,8 +532,8 @@ class DtdParser(TestCase):
         self.assertTrue(issubclass(tag, Element))
         self.assertEqual(tag._tagname, 'tag')
         self.assertEqual(tag._is_empty, False)
-        self.assertEqual(tag._attribute_names, [])
-        self.assertEqual(tag._sub_elements, [])
+        self.assertEqual(tag._attribute_names, ())
+        self.assertEqual(tag._sub_elements, ())
 
         dtd_dict = {
             'tag': {'elts': 'EMPTY', 'attrs': []},
@@ -485,7 +544,7 @@ class DtdParser(TestCase):
         self.assertTrue(issubclass(tag, TextElement))
         self.assertEqual(tag._tagname, 'tag')
         self.assertEqual(tag._is_empty, True)
-        self.assertEqual(tag._sub_elements, [])
+        self.assertEqual(tag._sub_elements, ())
 
     def test__create_new_class(self):
         dtd_dict = {
@@ -570,7 +629,7 @@ class DtdParser(TestCase):
         tag = class_dict['tag']
         self.assertEqual(tag.__name__, 'tag')
         self.assertEqual(tag._required, False)
-        self.assertEqual(tag._sub_elements, [])
+        self.assertEqual(tag._sub_elements, ())
 
         dtd_dict = {
             'tag': {'elts': 'subtag', 'attrs': []},
@@ -587,9 +646,80 @@ class DtdParser(TestCase):
         self.assertEqual(tag._required, False)
         self.assertEqual(subtag.__name__, 'subtag')
         self.assertEqual(subtag._required, True)
-        self.assertEqual(subtag._sub_elements, [])
+        self.assertEqual(subtag._sub_elements, ())
         self.assertEqual(subtag._parent, tag)
 
+        dtd_dict = {
+            'tag': {'elts': '(#PCDATA|subtag)*', 'attrs': []},
+            'subtag': {'elts': '#PCDATA', 'attrs': []},
+        }
+        class_dict = dtd_parser._create_classes(dtd_dict)
+        tag = class_dict['tag']
+        self.assertTrue(issubclass(tag, TextElement))
+        self.assertEqual(len(tag._sub_elements), 1)
+        self.assertEqual(tag._sub_elements[0]._required, False)
+        self.assertEqual(dtd_dict['tag']['elts'], '(#PCDATA|subtag)*')
+
+    def test__create_classes_frozen(self):
+        dtd_dict = {
+            'tag': {'elts': 'subtag,(sub1|sub2),sub3*', 'attrs': []},
+            'subtag': {'elts': '#PCDATA', 'attrs': []},
+            'sub1': {'elts': '#PCDATA', 'attrs': []},
+            'sub2': {'elts': '#PCDATA', 'attrs': []},
+            'sub3': {'elts': '#PCDATA', 'attrs': []},
+        }
+        class_dict = dtd_parser._create_classes(dtd_dict)
+        tag = class_dict['tag']
+        classes = [tag] + list(tag._sub_elements)
+        classes += list(tag._sub_elements[1]._elts)
+        classes += list(tag._sub_elements[2]._elts)
+        self.assertEqual(len(classes), 7)
+        for cls in classes:
+            if hasattr(cls, '_elts'):
+                self.assertTrue(isinstance(cls._elts, tuple))
+            else:
+                self.assertTrue(isinstance(cls._sub_elements, tuple))
+            try:
+                cls._required = True
+                assert 0
+            except AttributeError, e:
+                self.assertEqual(
+                    str(e),
+                    "Can't set _required on the frozen class %s" % cls.__name__)
+            try:
+                del cls._tagname
+                assert 0
+            except AttributeError:
+                pass
+
+        # We can still inherit and update the new class
+        newcls = type('newcls', (tag,), {})
+        newcls._required = True
+        self.assertEqual(newcls._required, True)
+        self.assertEqual(tag._required, False)
+
+    def test__create_classes_attribute_names(self):
+        dtd_dict = {
+            'tag': {'elts': '#PCDATA',
+                    'attrs': [('attr2', 'CDATA', '#IMPLIED'),
+                              ('attr1', 'CDATA', '#IMPLIED')]},
+        }
+        tag = dtd_parser._create_classes(dtd_dict)['tag']
+        # The tuple keeps the order, the set is used to check the names
+        self.assertEqual(tag._attribute_names, ('attr2', 'attr1'))
+        self.assertEqual(tag._attribute_name_set,
+                         frozenset(['attr1', 'attr2']))
+        obj = tag()
+        self.assertEqual(obj._is_attribute_name('attr1'), True)
+        self.assertEqual(obj._is_attribute_name('attr3'), False)
+
+        newcls = type('newcls', (tag,), {})
+        newcls._attribute_names = ('attr3',)
+        obj = newcls()
+        self.assertEqual(obj._is_attribute_name('attr1'), False)
+        self.assertEqual(obj._is_attribute_name('attr3'), True)
+        obj.add_attribute('attr3', 'value')
+
     def test_parse(self):
         try:
             dtd_parser.parse()
@@ -623,3 +753,142 @@ class DtdParser(TestCase):
         finally:
             utils.get_dtd_content = old_get_dtd_content
 
+    def test_parse_single_flight(self):
+        dtd_str = '''
+            <!ELEMENT Exercise (question)>
+            <!ELEMENT question (#PCDATA)>
+        '''
+        old_get_dtd_content = utils.get_dtd_content
+        fetches = []
+        results = []
+
+        def get_dtd_content(url):
+            fetches.append(url)
+            time.sleep(0.05)
+            return dtd_str
+
+        def target():
+            results.append(dtd_parser.parse(dtd_url='http://dtd'))
+
+        stats = dtd_parser.get_parse_stats()
+        try:
+            utils.get_dtd_content = get_dtd_content
+            threads = [threading.Thread(target=target) for i in range(5)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            utils.get_dtd_content = old_get_dtd_content
+        self.assertEqual(len(results), 5)
+        new_stats = dtd_parser.get_parse_stats()
+        self.assertEqual(len(fetches), new_stats['calls'] - stats['calls'])
+        self.assertEqual(
+            5, (new_stats['calls'] - stats['calls']) +
+            (new_stats['coalesced'] - stats['coalesced']))
+        self.assertEqual(new_stats['in_flight'], 0)
+        # The coalesced calls get the same classes
+        self.assertTrue(len(fetches) < 5)
+        self.assertEqual(len(set(map(id, results))), len(fetches))
+
+    def test_get_stats(self):
+        dtd_str = '''
+            <!ENTITY % person "name, firstname" >
+            <!ELEMENT Exercise (number, (qcm|mqm), (test|section)*)>
+            <!ELEMENT section (title, (test|section)*)>
+            <!ELEMENT test (%person;, question)>
+            <!ELEMENT qcm (choice+)>
+            <!ELEMENT mqm (choice+)>
+            <!ELEMENT number (#PCDATA)>
+            <!ELEMENT title (#PCDATA)>
+            <!ELEMENT name (#PCDATA)>
+            <!ELEMENT firstname (#PCDATA)>
+            <!ELEMENT question (#PCDATA)>
+            <!ELEMENT choice (#PCDATA)>
+            <!ATTLIST Exercise idexercise ID #IMPLIED>
+            <!ATTLIST choice idchoice ID #IMPLIED value CDATA #IMPLIED>
+        '''
+        stats = dtd_parser.get_stats(dtd_str=dtd_str)
+        self.assertEqual(stats, {
+            'elements': 11,
+            'attributes': 3,
+            'entities': 1,
+            'entity_expansion': 1.05,
+            'classes': 29,
+            'lists': 4,
+            'choices': 1,
+            'max_children': 3,
+            'max_list_fanout': 2,
+            'max_choice_fanout': 2,
+            'roots': ['Exercise'],
+            'max_depth': 4,
+            'recursive': ['section'],
+        })
+
+        sample = etree.fromstring(
+            '<Exercise><number>1</number><qcm><choice>a</choice></qcm>'
+            '</Exercise>')
+        stats = dtd_parser.get_stats(dtd_str=dtd_str, sample=sample)
+        self.assertEqual(stats['sample_nodes'], 4)
+        self.assertTrue(stats['form_bytes'] > 0)
+        self.assertEqual(stats['form_bytes_per_node'],
+                         stats['form_bytes'] // 4)
+
+        # The sample is not changed
+        sample_str = ('<Exercise>\n  <number/>\n  <qcm>\n'
+                      '    <choice>a</choice>\n  </qcm>\n</Exercise>')
+        sample = etree.fromstring(sample_str)
+        stats = dtd_parser.get_stats(dtd_str=dtd_str, sample=sample)
+        self.assertEqual(stats['sample_nodes'], 4)
+        self.assertEqual(etree.tostring(sample), sample_str)
+
+        try:
+            dtd_parser.get_stats()
+            assert 0
+        except Exception, e:
+            self.assertEqual(str(e), 'You didn\'t provide dtd_str nor dtd_url')
+
+    def test_set_cache(self):
+        dtd_str = '''
+            <!ELEMENT Exercise (question)>
+            <!ELEMENT question (#PCDATA)>
+        '''
+        dic1 = dtd_parser.parse(dtd_str=dtd_str)
+        self.assertNotEqual(dtd_parser.parse(dtd_str=dtd_str)['Exercise'],
+                            dic1['Exercise'])
+        try:
+            dtd_parser.set_cache(1)
+            dic1 = dtd_parser.parse(dtd_str=dtd_str)
+            dic2 = dtd_parser.parse(dtd_str=dtd_str)
+            self.assertEqual(dic1, dic2)
+            self.assertTrue(dic1 is not dic2)
+            self.assertEqual(dic1['Exercise'], dic2['Exercise'])
+            other_dtd_str = dtd_str.replace('question', 'other')
+            dic3 = dtd_parser.parse(dtd_str=other_dtd_str)
+            self.assertTrue('other' in dic3)
+            # The first DTD has been dropped
+            self.assertNotEqual(dtd_parser.parse(dtd_str=dtd_str)['Exercise'],
+                                dic1['Exercise'])
+        finally:
+            dtd_parser.set_cache(None)
+        self.assertEqual(dtd_parser._cache, None)
+
+    def test_parse_async(self):
+        dtd_str = '''
+            <!ELEMENT Exercise (question)>
+            <!ELEMENT question (#PCDATA)>
+        '''
+        results = []
+        res = dtd_parser.parse_async(dtd_str=dtd_str, callback=results.append)
+        dic = res.get(10)
+        self.assertEqual(len(dic), 2)
+        self.assertTrue(issubclass(dic['Exercise'], Element))
+        self.assertEqual(results, [dic])
+
+        res = dtd_parser.parse_async()
+        try:
+            res.get(10)
+            assert 0
+        except Exception, e:
+            self.assertEqual(str(e), 'You didn\'t provide dtd_str nor dtd_url')
+
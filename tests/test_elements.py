@@ -5,7 +5,10 @@ from lxml import etree
 import tw2.core as twc
 import tw2.core.testbase as tw2test
 import os.path
-from xmltool import utils
+import threading
+from StringIO import StringIO
+import simplejson as json
+from xmltool import utils, dtd_parser
 from xmltool.elements import (
     Element,
     ListElement,
@@ -41,6 +44,137 @@ class TestElement(TestCase):
         self.cls = type('Cls', (Element, ), {'_tagname': 'tag',
                                                '_sub_elements': [self.sub_cls]})
 
+    def test__set_modified(self):
+        obj = self.cls()
+        sub = self.sub_cls()
+        sub._parent = obj
+        self.assertEqual(obj._modified, False)
+        self.assertEqual(sub._modified, False)
+        sub._set_modified()
+        self.assertEqual(sub._modified, True)
+        self.assertEqual(obj._modified, True)
+
+        obj = self.cls()
+        obj.subtag = self.sub_cls()
+        self.assertEqual(obj._modified, True)
+        obj._modified = False
+        obj.subtag._parent = obj
+        obj.subtag._sourceline = 10
+        self.assertEqual(obj._modified, False)
+        obj.subtag._comment = 'comment'
+        self.assertEqual(obj._modified, True)
+        obj._modified = False
+        del obj.subtag
+        self.assertEqual(obj._modified, True)
+
+    def test__get_hash(self):
+        obj = self.cls()
+        h = obj._get_hash()
+        self.assertEqual(obj._hash, h)
+        self.assertEqual(self.cls()._get_hash(), h)
+
+        obj.subtag = self.sub_cls()
+        obj.subtag._parent = obj
+        self.assertEqual(obj._hash, None)
+        h1 = obj._get_hash()
+        self.assertNotEqual(h1, h)
+        self.assertTrue(obj.subtag._hash)
+
+        obj.subtag._comment = 'comment'
+        self.assertEqual(obj.subtag._hash, None)
+        self.assertEqual(obj._hash, None)
+        h2 = obj._get_hash()
+        self.assertNotEqual(h2, h1)
+
+        obj._attributes = {'attr': 'value'}
+        self.assertNotEqual(obj._get_hash(), h2)
+
+        # The loaded objects have the hash of the same generated objects
+        xml = etree.fromstring('<tag><subtag/></tag>')
+        obj = self.cls()
+        obj.load_from_xml(xml)
+        h = obj._get_hash()
+        self.assertEqual(obj._modified, False)
+        self.assertEqual(h, h1)
+        obj.subtag._comment = 'comment'
+        self.assertEqual(obj._hash, None)
+        self.assertNotEqual(obj._get_hash(), h)
+
+    def test__set_xml_node(self):
+        obj = self.cls()
+        sub = self.sub_cls()
+        sub._parent = obj
+        sub._comment = 'comment'
+        xml = etree.Element('subtag')
+        sub._set_xml_node(xml)
+        self.assertEqual(sub._xml_node, xml)
+        self.assertEqual(sub._modified, False)
+        obj._modified = False
+        # The parent should be regenerated to contain the new node
+        sub._set_xml_node(etree.Element('subtag'))
+        self.assertEqual(obj._modified, True)
+
+    def test__get_xml_node(self):
+        obj = self.cls()
+        xml = obj._get_xml_node()
+        self.assertEqual(xml.tag, 'tag')
+        self.assertEqual(obj._xml_node, None)
+
+        root = etree.fromstring('<root><tag><subtag/></tag>\n</root>')
+        obj.load_from_xml(root[0])
+        # We keep an indented copy, the given tree is not changed
+        self.assertTrue(obj._xml_node is not root[0])
+        self.assertEqual(etree.tostring(root),
+                         '<root><tag><subtag/></tag>\n</root>')
+        kept = obj._xml_node
+        self.assertEqual(etree.tostring(kept),
+                         '<tag>\n  <subtag/>\n</tag>\n')
+        xml = obj._get_xml_node()
+        # The kept node is copied, it's never moved
+        self.assertTrue(xml is not kept)
+        self.assertEqual(etree.tostring(xml), '<tag>\n  <subtag/>\n</tag>')
+        obj._comment = 'comment'
+        newxml = obj._get_xml_node()
+        self.assertTrue(newxml is not kept)
+        self.assertEqual(obj._xml_node, kept)
+
+    def test__write_xmlfile_kept_node(self):
+        dtd_str = """
+        <!ELEMENT tag (title, item*)>
+        <!ELEMENT title (#PCDATA)>
+        <!ELEMENT item (#PCDATA)>
+        """
+        xml_str = '<tag><title/><item>Item 1</item></tag>'
+        xml = etree.fromstring(xml_str)
+        dic = dtd_parser.parse(dtd_str=dtd_str)
+        obj = dic['tag']()
+        obj.load_from_xml(xml)
+        self.assertEqual(etree.tostring(xml), xml_str)
+        kept = obj._xml_node
+        self.assertEqual(kept.find('title').text, '')
+
+        nodes = []
+
+        class FakeWriter(object):
+            def write(self, node, **kwargs):
+                nodes.append(node)
+
+        # The kept node is indented, it's written as it is
+        obj._write_xmlfile(FakeWriter())
+        self.assertEqual(nodes, [kept])
+
+        # At another level, we write an indented copy
+        nodes = []
+        obj._write_xmlfile(FakeWriter(), level=1)
+        self.assertEqual(len(nodes), 1)
+        self.assertTrue(nodes[0] is not kept)
+        self.assertEqual(
+            etree.tostring(nodes[0]),
+            '<tag>\n    <title></title>\n    <item>Item 1</item>\n  </tag>')
+        self.assertEqual(
+            etree.tostring(kept),
+            '<tag>\n  <title></title>\n  <item>Item 1</item>\n</tag>')
+
     def test__get_allowed_tagnames(self):
         self.assertEqual(self.cls._get_allowed_tagnames(), ['tag'])
 
@@ -149,6 +283,71 @@ class TestElement(TestCase):
         except Exception, e:
             self.assertEqual(str(e), 'Invalid attribute name: unexisting')
 
+    def test_add_attribute_dtd(self):
+        dtd_str = """
+        <!ELEMENT tag (sub*)>
+        <!ELEMENT sub (#PCDATA)>
+        <!ATTLIST tag type (qcm|mqm) "qcm">
+        <!ATTLIST tag version CDATA #FIXED "1.0">
+        <!ATTLIST tag name CDATA #IMPLIED>
+        <!ATTLIST sub idsub ID #REQUIRED>
+        """
+        dic = dtd_parser.parse(dtd_str=dtd_str)
+        obj = dic['tag']()
+        obj.add_attribute('type', 'mqm')
+        obj.add_attribute('type', ' qcm ')
+        obj.add_attribute('version', '1.0')
+        obj.add_attribute('name', 'any value')
+        for name, value in [('type', 'other'), ('version', '2.0')]:
+            try:
+                obj.add_attribute(name, value)
+                assert 0
+            except Exception, e:
+                self.assertEqual(
+                    str(e),
+                    'Invalid value for the attribute %s: %s' % (name, value))
+        self.assertEqual(obj._attributes, {'type': ' qcm ',
+                                           'version': '1.0',
+                                           'name': 'any value'})
+
+        try:
+            dic['tag'].from_dict({'tag': {'_attrs': {'type': 'other'}}})
+            assert 0
+        except Exception, e:
+            self.assertEqual(str(e),
+                             'Invalid value for the attribute type: other')
+
+        obj = dic['tag']()
+        self.assertEqual(obj.get_attribute('type'), 'qcm')
+        self.assertEqual(obj.get_attribute('version'), '1.0')
+        self.assertEqual(obj.get_attribute('name'), None)
+        obj.add_attribute('type', 'mqm')
+        self.assertEqual(obj.get_attribute('type'), 'mqm')
+        try:
+            obj.get_attribute('unexisting')
+            assert 0
+        except Exception, e:
+            self.assertEqual(str(e), 'Invalid attribute name: unexisting')
+
+    def test_check_attributes(self):
+        dtd_str = """
+        <!ELEMENT tag (sub*)>
+        <!ELEMENT sub (#PCDATA)>
+        <!ATTLIST tag name CDATA #IMPLIED>
+        <!ATTLIST sub idsub ID #REQUIRED>
+        """
+        dic = dtd_parser.parse(dtd_str=dtd_str)
+        obj = dic['tag']()
+        obj.check_attributes()
+        sub = obj.add('sub')
+        try:
+            obj.check_attributes()
+            assert 0
+        except Exception, e:
+            self.assertEqual(str(e), 'Missing attribute idsub in sub')
+        sub.add_attribute('idsub', 'sub1')
+        obj.check_attributes()
+
     def test__load_attributes_from_xml(self):
         obj = self.cls()
         obj._attribute_names = ['attr']
@@ -284,6 +483,13 @@ class TestElement(TestCase):
         self.assertEqual(obj._comment, 'comment')
         self.assertEqual(obj._attributes, {'attr': 'value'})
 
+        obj = self.cls()
+        obj._attribute_names = ['attr']
+        obj._load_extra_from_xml(xml.getchildren()[1], ['c1', 'c2'])
+        self.assertEqual(obj._comment, 'c1\nc2')
+        obj._load_extra_from_xml(xml.getchildren()[1], [])
+        self.assertEqual(obj._comment, None)
+
     def test_load_from_xml(self):
         xml = etree.Element('test')
         xml.append(etree.Element('prev'))
@@ -385,6 +591,129 @@ class TestElement(TestCase):
         self.assertEqual(obj.sub[0]._comment, 'element comment')
         self.assertEqual(obj.sub[0]._attributes, {'attr': 'value'})
 
+    def _get_json_classes(self):
+        text_cls = type('TextElement', (TextElement,),
+                        {'_tagname': 'text',
+                         '_attribute_names': ['attr']})
+        sub_cls = type('Element', (Element,),
+                       {'_tagname': 'sub',
+                        '_sub_elements': [text_cls],
+                        '_attribute_names': ['attr']})
+        list_cls = type('ListElement', (ListElement,),
+                        {'_tagname': 'element',
+                         '_elts': [sub_cls]})
+        cls = type('Cls', (Element, ),
+                   {'_tagname': 'tag',
+                    '_sub_elements': [list_cls, text_cls]})
+        return cls, list_cls, sub_cls, text_cls
+
+    def test_to_dict(self):
+        cls, list_cls, sub_cls, text_cls = self._get_json_classes()
+        obj = cls()
+        self.assertEqual(obj.to_dict(), {'tag': {}})
+        self.assertEqual(json.loads(obj.to_json()), obj.to_dict())
+
+        obj._comment = 'comment'
+        obj.text = text_cls()
+        obj.text._value = 'value'
+        obj.text._attributes = {'attr': 'text attr'}
+        sub1 = obj.add('sub')
+        sub1._attributes = {'attr': 'value'}
+        sub1.text = text_cls()
+        sub1.text._value = 'sub value'
+        sub2 = obj.add('sub')
+        sub2._comment = 'sub comment'
+        expected = {
+            'tag': {
+                '_comment': 'comment',
+                'text': {'_value': 'value', '_attrs': {'attr': 'text attr'}},
+                'element': [
+                    {'sub': {'_attrs': {'attr': 'value'},
+                             'text': {'_value': 'sub value'}}},
+                    {'sub': {'_comment': 'sub comment'}},
+                ]
+            }
+        }
+        self.assertEqual(obj.to_dict(), expected)
+        self.assertEqual(json.loads(obj.to_json()), expected)
+
+        # The format is the one of load_from_dict
+        new_obj = cls()
+        new_obj.load_from_dict(json.loads(obj.to_json()))
+        self.assertEqual(new_obj.to_dict(), expected)
+
+    def test_iter_json(self):
+        cls, list_cls, sub_cls, text_cls = self._get_json_classes()
+        obj = cls()
+        self.assertEqual(''.join(obj.iter_json()), '{"tag": {}}')
+        obj._attributes = {'attr': 'value'}
+        obj.add('sub')
+        sub = obj.add('sub')
+        sub._comment = u'comment \xe9 "quoted"'
+        sub.text = text_cls()
+        sub.text._value = u'value \xe9\n'
+        obj.text = text_cls()
+        result = ''.join(obj.iter_json())
+        self.assertEqual(json.loads(result), obj.to_dict())
+
+    def test_from_dict(self):
+        cls, list_cls, sub_cls, text_cls = self._get_json_classes()
+        dic = {
+            'tag': {
+                '_comment': 'comment',
+                'text': {'_value': 'value', '_attrs': {'attr': 'text attr'}},
+                'element': [
+                    {'sub': {'_attrs': {'attr': 'value'},
+                             'text': {'_value': 'sub value'}}},
+                    {'sub': {'_comment': 'sub comment'}},
+                ]
+            }
+        }
+        copy_dic = json.loads(json.dumps(dic))
+        obj = cls.from_dict(dic)
+        # The data is not changed
+        self.assertEqual(dic, copy_dic)
+        self.assertEqual(obj._comment, 'comment')
+        self.assertEqual(obj.text._value, 'value')
+        self.assertEqual(obj.text._attributes, {'attr': 'text attr'})
+        self.assertEqual(obj.text._parent, obj)
+        self.assertEqual(obj.text._exists, True)
+        self.assertEqual(len(obj.sub), 2)
+        self.assertEqual(obj.sub._parent, obj)
+        self.assertEqual(obj.sub[0]._parent, obj.sub)
+        self.assertEqual(obj.sub[0]._attributes, {'attr': 'value'})
+        self.assertEqual(obj.sub[0].text._value, 'sub value')
+        self.assertEqual(obj.sub[1]._comment, 'sub comment')
+        self.assertEqual(obj.to_dict(), dic)
+
+        obj = cls.from_json(json.dumps(dic))
+        self.assertEqual(obj.to_dict(), dic)
+        self.assertEqual(obj.to_xml().tag, 'tag')
+
+        try:
+            cls.from_dict({'unexisting': {}})
+            assert 0
+        except Exception, e:
+            self.assertEqual(str(e), 'Invalid data for tag')
+
+        try:
+            cls.from_dict({'tag': {'unexisting': {}}})
+            assert 0
+        except Exception, e:
+            self.assertEqual(str(e), 'Invalid child unexisting')
+
+        try:
+            cls.from_dict({'tag': {'element': [{'unexisting': {}}]}})
+            assert 0
+        except Exception, e:
+            self.assertEqual(str(e), 'Invalid child unexisting')
+
+        try:
+            cls.from_dict({'tag': {'text': {'_attrs': {'unexisting': 'v'}}}})
+            assert 0
+        except Exception, e:
+            self.assertEqual(str(e), 'Invalid attribute name: unexisting')
+
     def test_to_xml(self):
         sub_cls = type('SubClsElement', (Element,),
                             {'_tagname': 'element',
@@ -590,6 +919,106 @@ class TestElement(TestCase):
                 'data': 'subtag'}]}
         self.assertEqual(result, expected)
 
+    def test_to_html_cache(self):
+        obj = self.cls()
+        expected = obj.to_html()
+        elements.set_html_cache(1000)
+        try:
+            html = obj.to_html()
+            self.assertEqual(html, expected)
+            # The fragments of obj and its sub element
+            self.assertEqual(len(elements._html_cache), 2)
+            self.assertTrue(elements._html_cache.size > len(html))
+            self.assertEqual(self.cls().to_html(), expected)
+            self.assertEqual(len(elements._html_cache), 2)
+
+            obj.subtag = self.sub_cls()
+            obj.subtag._parent = obj
+            html = obj.to_html()
+            self.assertNotEqual(html, expected)
+            self.assertEqual(len(elements._html_cache), 4)
+
+            # The rendering parameters are in the key
+            html = obj.to_html(['prefix'])
+            self.assertTrue('id="prefix:tag"' in html)
+            self.assertEqual(len(elements._html_cache), 6)
+        finally:
+            elements.set_html_cache(None)
+        self.assertEqual(elements._html_cache, None)
+
+    def test_to_html_cache_exists(self):
+        dtd_str = """
+        <!ELEMENT texts (tag1, tag2?)>
+        <!ELEMENT tag1 (#PCDATA)>
+        <!ELEMENT tag2 (#PCDATA)>
+        """
+        dic = dtd_parser.parse(dtd_str=dtd_str)
+        # The same content but tag2 only exists in the loaded object
+        obj1 = dic['texts']()
+        obj1.load_from_xml(etree.fromstring(
+            '<texts><tag1>x</tag1><tag2/></texts>'))
+        obj2 = dic['texts']()
+        obj2.add('tag1', 'x')
+        obj2.add('tag2')
+        expected1 = obj1.to_html()
+        expected2 = obj2.to_html()
+        self.assertNotEqual(expected1, expected2)
+        self.assertNotEqual(obj1._get_hash(), obj2._get_hash())
+        elements.set_html_cache(10000)
+        try:
+            self.assertEqual(obj1.to_html(), expected1)
+            self.assertEqual(obj2.to_html(), expected2)
+            # Changing _exists resets the hash, the XML is not modified
+            h = obj1._get_hash()
+            obj1.tag2._exists = False
+            self.assertEqual(obj1._hash, None)
+            self.assertEqual(obj1._modified, False)
+            self.assertNotEqual(obj1._get_hash(), h)
+            self.assertEqual(obj1.to_html(), expected2)
+        finally:
+            elements.set_html_cache(None)
+
+    def test_to_jstree_dict_max_depth(self):
+        obj = self.cls()
+        result = obj.to_jstree_dict([], max_depth=1)
+        expected = {
+            'data': 'tag',
+            'attr': {
+                'id': 'tree_tag',
+                'class': 'tree_:tag'},
+            'children': []}
+        self.assertEqual(result, expected)
+
+        obj.subtag = self.sub_cls()
+        obj.subtag._parent = obj
+        result = obj.to_jstree_dict([], max_depth=1)
+        expected = {
+            'data': 'tag',
+            'attr': {
+                'id': 'tree_tag',
+                'class': 'tree_:tag'},
+            'state': 'closed'}
+        self.assertEqual(result, expected)
+
+        result = obj.to_jstree_dict([], max_depth=2)
+        self.assertEqual(result, obj.to_jstree_dict([]))
+
+    def test_iter_jstree_json(self):
+        obj = self.cls()
+        result = ''.join(obj.iter_jstree_json([]))
+        self.assertEqual(json.loads(result), obj.to_jstree_dict([]))
+
+        obj._value = 'my value'
+        obj.subtag = self.sub_cls()
+        obj.subtag._parent = obj
+        result = ''.join(obj.iter_jstree_json([], index=10))
+        self.assertEqual(json.loads(result),
+                         obj.to_jstree_dict([], index=10))
+
+        result = ''.join(obj.iter_jstree_json([], max_depth=1))
+        self.assertEqual(json.loads(result),
+                         obj.to_jstree_dict([], max_depth=1))
+
     def test___getitem__(self):
         obj = self.cls()
         obj.tag = 'Hello world'
@@ -686,6 +1115,72 @@ class TestElement(TestCase):
         lis = obj3.find_parents('subtag')
         self.assertEqual(lis, [obj3, obj2, obj1])
 
+    def test_clone(self):
+        dtd_str = """
+        <!ELEMENT tag (title, comment?, item*)>
+        <!ELEMENT title (#PCDATA)>
+        <!ELEMENT comment (#PCDATA)>
+        <!ELEMENT item (#PCDATA)>
+        <!ATTLIST item iditem ID #IMPLIED>
+        """
+        xml = etree.fromstring(
+            '<tag><title>Title</title><comment>Comment</comment>'
+            '<item iditem="i1">Item 1</item><item>Item 2</item></tag>')
+        dic = dtd_parser.parse(dtd_str=dtd_str)
+        obj = dic['tag']()
+        obj.load_from_xml(xml)
+        expected = etree.tostring(xml)
+        kept = etree.tostring(obj._xml_node)
+
+        clone = obj.clone()
+        self.assertTrue(isinstance(clone, dic['tag']))
+        self.assertEqual(clone._clone_source, obj)
+        self.assertEqual(clone._parent, None)
+        # Nothing is copied before being accessed
+        self.assertFalse('title' in clone.__dict__)
+        self.assertEqual(clone.title._value, 'Title')
+        self.assertTrue(clone.title is not obj.title)
+        self.assertEqual(clone.title._parent, clone)
+        self.assertEqual(clone.title._xml_node, obj.title._xml_node)
+        self.assertEqual(clone._modified, False)
+        self.assertEqual(etree.tostring(clone.to_xml()), expected)
+
+        clone.title._value = 'New title'
+        self.assertEqual(clone._modified, True)
+        self.assertEqual(obj._modified, False)
+        clone.item[0].add_attribute('iditem', 'i2')
+        self.assertEqual(obj.item[0]._attributes, {'iditem': 'i1'})
+        clone.add('item', 'Item 3')
+        self.assertEqual(len(clone.item), 3)
+        self.assertEqual(len(obj.item), 2)
+        self.assertEqual(clone.item[2]._parent, clone.item)
+        del clone.comment
+        self.assertFalse(hasattr(clone, 'comment'))
+        self.assertTrue(hasattr(obj, 'comment'))
+        self.assertEqual(
+            etree.tostring(clone.to_xml()),
+            '<tag><title>New title</title>'
+            '<item iditem="i2">Item 1</item><item>Item 2</item>'
+            '<item>Item 3</item></tag>')
+        # The source is not changed, its nodes are not moved
+        self.assertEqual(obj.title._value, 'Title')
+        self.assertEqual(obj._modified, False)
+        self.assertEqual(etree.tostring(obj._xml_node), kept)
+        self.assertEqual(etree.tostring(obj.to_xml()), expected)
+
+        clone2 = clone.clone()
+        self.assertFalse(hasattr(clone2, 'comment'))
+        self.assertEqual(clone2.title._value, 'New title')
+        clone2.add('comment', 'Comment 2')
+        self.assertEqual(clone2.comment._value, 'Comment 2')
+        self.assertFalse(hasattr(clone, 'comment'))
+
+        try:
+            clone.unexisting
+            assert 0
+        except AttributeError:
+            pass
+
     def test_write(self):
         filename = 'tests/test.xml'
         self.assertFalse(os.path.isfile(filename))
@@ -704,14 +1199,14 @@ class TestElement(TestCase):
                 self.assertEqual(str(e), 'No dtd url given')
 
             old_get_content = utils.get_dtd_content
-            old_validate_xml = utils.validate_xml
+            old_validate_xml_file = utils.validate_xml_file
             try:
                 utils.get_dtd_content = lambda url, path: 'dtd content'
-                utils.validate_xml = lambda xml, dtd_str: True
+                utils.validate_xml_file = lambda filename, dtd_str: True
                 obj.write(filename, dtd_url='http://dtd.url')
             finally:
                 utils.get_dtd_content = old_get_content
-                utils.validate_xml = old_validate_xml
+                utils.validate_xml_file = old_validate_xml_file
 
             obj.write(filename, dtd_url='http://dtd.url', validate=False)
             result = open(filename, 'r').read()
@@ -743,6 +1238,208 @@ class TestElement(TestCase):
             if os.path.isfile(filename):
                 os.remove(filename)
 
+    def test_write_not_valid(self):
+        filename = 'tests/test.xml'
+        self.assertFalse(os.path.isfile(filename))
+        try:
+            obj = self.cls()
+            obj.write(filename, dtd_url='http://dtd.url', validate=False)
+            old_get_content = utils.get_dtd_content
+            try:
+                utils.get_dtd_content = lambda url, path: (
+                    '<!ELEMENT tag (subtag)><!ELEMENT subtag (#PCDATA)>')
+                obj.write(filename, dtd_url='http://dtd.url')
+                assert 0
+            except etree.DocumentInvalid:
+                pass
+            finally:
+                utils.get_dtd_content = old_get_content
+            # The file is not updated and the temporary one is removed
+            result = open(filename, 'r').read()
+            expected = ("<?xml version='1.0' encoding='UTF-8'?>\n"
+                        '<!DOCTYPE tag SYSTEM "http://dtd.url">\n'
+                        "<tag/>\n")
+            self.assertEqual(result, expected)
+            self.assertEqual(
+                [f for f in os.listdir('tests') if f.endswith('.tmp')], [])
+        finally:
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+    def test_write_merged(self):
+        filename = 'tests/test.xml'
+        dtd_str = ('<!ELEMENT tag (title, item+)>'
+                   '<!ELEMENT title (#PCDATA)>'
+                   '<!ELEMENT item (#PCDATA)>'
+                   '<!ATTLIST item iditem ID #IMPLIED>')
+        dic = dtd_parser.parse(dtd_str=dtd_str)
+        obj = dic['tag']()
+        obj.add('title', 'My title')
+        obj.add('item', 'existing')
+
+        def get_items(values):
+            for value in values:
+                item = dic['item']()
+                item._value = value
+                yield item
+
+        self.assertFalse(os.path.isfile(filename))
+        old_get_content = utils.get_dtd_content
+        try:
+            utils.get_dtd_content = lambda url, path: dtd_str
+            try:
+                obj.write_merged('item', [], filename)
+                assert 0
+            except Exception, e:
+                self.assertEqual(str(e), 'No dtd url given')
+            try:
+                obj.write_merged('title', [], filename, dtd_url='http://dtd.url')
+                assert 0
+            except Exception, e:
+                self.assertEqual(str(e), 'No list of title in tag')
+
+            obj._xml_dtd_url = 'http://dtd.url'
+            count = obj.write_merged('item', get_items(['item 1', 'item 2']),
+                                     filename)
+            self.assertEqual(count, 2)
+            result = open(filename, 'r').read()
+            expected = ("<?xml version='1.0' encoding='UTF-8'?>\n"
+                        '<!DOCTYPE tag SYSTEM "http://dtd.url">\n'
+                        '<tag>\n'
+                        '  <title>My title</title>\n'
+                        '  <item>existing</item>\n'
+                        '  <item>item 1</item>\n'
+                        '  <item>item 2</item>\n'
+                        '</tag>\n')
+            self.assertEqual(result, expected)
+            # The object is not changed
+            self.assertEqual(len(obj.item), 1)
+
+            # The document is written as loaded for the other parts
+            loaded = dic['tag']()
+            loaded.load_from_xml(etree.parse(filename).getroot())
+            loaded._xml_dtd_url = 'http://dtd.url'
+            loaded.write_merged('item', get_items(['item 3']), filename)
+            self.assertEqual(open(filename, 'r').read(),
+                             expected.replace(
+                                 '</tag>', '  <item>item 3</item>\n</tag>'))
+
+            # The subtrees are validated one by one
+            def get_invalid_items():
+                for item in get_items(['item 4']):
+                    yield item
+                title = dic['title']()
+                title._value = 'title'
+                yield title
+            try:
+                obj.write_merged('item', get_invalid_items(), filename)
+                assert 0
+            except Exception, e:
+                self.assertEqual(str(e), 'Invalid child title')
+
+            items = list(get_items(['item 4']))
+            items[0]._attributes = {'iditem': '1 is not an ID'}
+            try:
+                obj.write_merged('item', items, filename)
+                assert 0
+            except etree.DocumentInvalid:
+                pass
+            obj.write_merged('item', items, filename, validate=False)
+
+            # The list is required
+            del obj.item
+            try:
+                obj.write_merged('item', [], filename)
+                assert 0
+            except etree.DocumentInvalid:
+                pass
+        finally:
+            utils.get_dtd_content = old_get_content
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+    def test_write_concurrent(self):
+        filename = 'tests/test.xml'
+        text_cls = type('TextCls', (TextElement,), {'_tagname': 'text'})
+        list_cls = type('TextList', (ListElement,), {'_tagname': 'list__text',
+                                                     '_elts': [text_cls]})
+        self.cls._sub_elements = [list_cls]
+        errors = []
+        stop = []
+
+        def writer(name):
+            try:
+                for i in range(20):
+                    obj = self.cls()
+                    for j in range(50):
+                        obj.add('text', '%s-%s-%s' % (name, i, j))
+                    obj.write(filename, dtd_url='http://dtd.url',
+                              validate=False, lock=True)
+            except Exception, e:
+                errors.append(e)
+
+        def reader():
+            while not stop:
+                try:
+                    root = etree.parse(filename).getroot()
+                except IOError:
+                    # Not written yet
+                    continue
+                except Exception, e:
+                    errors.append(e)
+                    continue
+                # Each file is written by one writer
+                values = set([t.text.split('-')[0] for t in root])
+                if len(root) != 50 or len(values) != 1:
+                    errors.append(Exception('Partial file'))
+
+        try:
+            writers = [threading.Thread(target=writer, args=(i,))
+                       for i in range(4)]
+            readers = [threading.Thread(target=reader) for i in range(2)]
+            for t in writers + readers:
+                t.start()
+            for t in writers:
+                t.join()
+            stop.append(True)
+            for t in readers:
+                t.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(
+                [f for f in os.listdir('tests') if f.endswith('.tmp')], [])
+        finally:
+            for f in [filename, utils.get_lock_filename(filename)]:
+                if os.path.isfile(f):
+                    os.remove(f)
+
+    def test_to_xmlfile(self):
+        obj = self.cls()
+        f = StringIO()
+        obj.to_xmlfile(f)
+        expected = ("<?xml version='1.0' encoding='UTF-8'?>\n"
+                    "<tag/>\n")
+        self.assertEqual(f.getvalue(), expected)
+
+        text_cls = type('TextCls', (TextElement,), {'_tagname': 'text'})
+        self.sub_cls._sub_elements = [text_cls]
+        obj.subtag = self.sub_cls()
+        obj.subtag._comment = 'comment'
+        obj.subtag.text = text_cls()
+        obj.subtag.text._value = u'\xe9t\xe9'
+        obj._comment = 'root comment'
+        f = StringIO()
+        obj.to_xmlfile(f, 'iso-8859-1', 'http://dtd.url')
+        expected = ("<?xml version='1.0' encoding='iso-8859-1'?>\n"
+                    '<!DOCTYPE tag SYSTEM "http://dtd.url">\n'
+                    "<!--root comment-->\n"
+                    "<tag>\n"
+                    "  <!--comment-->\n"
+                    "  <subtag>\n"
+                    "    <text>\xe9t\xe9</text>\n"
+                    "  </subtag>\n"
+                    "</tag>\n")
+        self.assertEqual(f.getvalue(), expected)
+
 class TestTextElement(TestCase):
 
     def setUp(self):
@@ -880,6 +1577,33 @@ class TestTextElement(TestCase):
                     '</div>')
         self.assertEqual(html, expected)
 
+    def test_to_html_escape(self):
+        obj = self.cls()
+        obj._required = True
+        obj._value = u'a < b & "c" \xe9'
+        obj._comment = '<!-- comment -->'
+        obj._attributes = {'attr': 'a "value"'}
+        html = obj.to_html()
+        expected = (u'<div data-id="tag">'
+                    u'<label>tag</label>'
+                    u'<a data-comment-name="tag:_comment" '
+                    u'class="btn-comment has-comment" '
+                    u'title="&lt;!-- comment --&gt;">Comment</a>'
+                    u'<textarea class="_comment" name="tag:_comment">'
+                    u'&lt;!-- comment --&gt;</textarea>'
+                    u'<input value="a &quot;value&quot;" name="tag:_attrs:attr" '
+                    u'id="tag:_attrs:attr" class="_attrs" />'
+                    u'<textarea name="tag:_value" id="tag" class="tag" rows="1">'
+                    u'a &lt; b &amp; &quot;c&quot; \xe9</textarea>'
+                    u'</div>')
+        self.assertEqual(html, expected)
+
+        data = obj._get_jstree_data([], None)['data']
+        self.assertEqual(
+            data,
+            u'tag <span class="_tree_text">'
+            u'(a &lt; b &amp; &quot;c&quot; \xe9)</span>')
+
 
 class TestListElement(TestCase):
 
@@ -892,6 +1616,46 @@ class TestListElement(TestCase):
         self.cls = type('Cls', (ListElement,), {'_tagname': 'list_cls',
                                                   '_elts': [self.sub_cls]})
 
+    def test_set_modified(self):
+        dtd_str = """
+        <!ELEMENT texts (text*)>
+        <!ELEMENT text (#PCDATA)>
+        """
+        dic = dtd_parser.parse(dtd_str=dtd_str)
+
+        def get_texts(func):
+            xml = etree.fromstring(
+                '<texts><text>1</text><text>2</text><text>3</text></texts>')
+            obj = dic['texts']()
+            obj.load_from_xml(xml)
+            lis = obj.text
+            func(lis)
+            self.assertEqual(obj._modified, True)
+            # The kept node is not reused
+            return [e.text for e in obj.to_xml()]
+
+        def setslice(lis):
+            lis[0:1] = []
+
+        def delslice(lis):
+            del lis[0:2]
+
+        def iadd(lis):
+            lis += [lis[0]._clone(lis)]
+
+        self.assertEqual(get_texts(lambda lis: lis.reverse()),
+                         ['3', '2', '1'])
+        self.assertEqual(
+            get_texts(lambda lis: lis.sort(key=lambda e: e._value,
+                                           reverse=True)),
+            ['3', '2', '1'])
+        self.assertEqual(get_texts(setslice), ['2', '3'])
+        self.assertEqual(get_texts(delslice), ['3'])
+        self.assertEqual(get_texts(iadd), ['1', '2', '3', '1'])
+        self.assertEqual(get_texts(lambda lis: lis.pop()), ['1', '2'])
+        self.assertEqual(get_texts(lambda lis: lis.remove(lis[1])),
+                         ['1', '3'])
+
     def test__get_allowed_tagnames(self):
         self.assertEqual(self.cls._get_allowed_tagnames(), ['list_cls', 'tag'])
 
@@ -981,6 +1745,8 @@ class TestListElement(TestCase):
         # Empty required with only one element, xml is created!
         self.assertEqual(len(lis), 1)
         self.assertEqual(lis[0].tag, 'tag')
+        # But the object is not updated
+        self.assertEqual(len(obj), 0)
 
         sub_cls = type('SubCls', (Element, ), {'_tagname': 'tag1'})
         self.cls._elts += [sub_cls]
@@ -989,6 +1755,29 @@ class TestListElement(TestCase):
         lis = obj.to_xml()
         self.assertEqual(lis, [])
 
+    def test__get_items(self):
+        obj = self.cls()
+        self.assertEqual(obj._get_items(), [])
+        lis = obj._get_items(force=True)
+        self.assertEqual(len(lis), 1)
+        self.assertTrue(isinstance(lis[0], self.sub_cls))
+        self.assertEqual(lis[0]._parent, obj)
+        self.assertEqual(len(obj), 0)
+
+        obj._required = True
+        lis = obj._get_items()
+        self.assertEqual(len(lis), 1)
+        self.assertEqual(len(obj), 0)
+
+        subobj = self.sub_cls()
+        obj.append(subobj)
+        self.assertEqual(obj._get_items(), [subobj])
+
+        sub_cls = type('SubCls', (Element, ), {'_tagname': 'tag1'})
+        self.cls._elts += [sub_cls]
+        obj = self.cls()
+        self.assertEqual(obj._get_items(force=True), [])
+
     def test__get_html_add_button(self):
         html = self.cls._get_html_add_button(None)
         expected = ('<a class="btn btn-add-ajax-list" '
@@ -1069,6 +1858,55 @@ class TestListElement(TestCase):
                     '</div>')
         self.assertEqual(html, expected)
 
+    def test_to_html_limit(self):
+        obj = self.cls()
+        for i in range(3):
+            obj.append(self.sub_cls())
+        html = obj.to_html(limit=2)
+        expected = ('<div class="list-container">'
+                    '<a class="btn btn-add-ajax-list" '
+                    'data-id="list_cls:0:tag">New tag</a>'
+                    '<fieldset class="tag list_cls:0:tag" '
+                    'id="list_cls:0:tag">'
+                    '<legend>tag'
+                    '<a data-comment-name="list_cls:0:tag:_comment" '
+                    'class="btn-comment">Comment</a>'
+                    '<a class="btn-delete-fieldset">Delete</a>'
+                    '</legend>'
+                    '</fieldset>'
+                    '<a class="btn btn-add-ajax-list" '
+                    'data-id="list_cls:1:tag">New tag</a>'
+                    '<fieldset class="tag list_cls:1:tag" '
+                    'id="list_cls:1:tag">'
+                    '<legend>tag'
+                    '<a data-comment-name="list_cls:1:tag:_comment" '
+                    'class="btn-comment">Comment</a>'
+                    '<a class="btn-delete-fieldset">Delete</a>'
+                    '</legend>'
+                    '</fieldset>'
+                    '<a class="btn btn-list-more" data-id="list_cls:2" '
+                    'data-start="2" data-limit="2">More tag (1)</a>'
+                    '</div>')
+        self.assertEqual(html, expected)
+
+        html = obj.to_html(limit=3)
+        self.assertEqual(html, obj.to_html())
+
+        html = obj._items_to_html(None, obj[2:], 5, limit=2, start=2)
+        expected = ['<a class="btn btn-add-ajax-list" '
+                    'data-id="list_cls:5:tag">New tag</a>',
+                    '<fieldset class="tag list_cls:5:tag" '
+                    'id="list_cls:5:tag">'
+                    '<legend>tag'
+                    '<a data-comment-name="list_cls:5:tag:_comment" '
+                    'class="btn-comment">Comment</a>'
+                    '<a class="btn-delete-fieldset">Delete</a>'
+                    '</legend>'
+                    '</fieldset>',
+                    '<a class="btn btn-add-ajax-list" '
+                    'data-id="list_cls:6:tag">New tag</a>']
+        self.assertEqual(html, expected)
+
     def test_to_jstree_dict(self):
         obj = self.cls()
         result = obj.to_jstree_dict([])
@@ -1083,6 +1921,20 @@ class TestListElement(TestCase):
             'data': 'tag'}]
         self.assertEqual(result, expected)
 
+    def test_iter_jstree_json(self):
+        obj = self.cls()
+        self.assertEqual(''.join(obj.iter_jstree_json([])), '[]')
+
+        obj._required = True
+        result = ''.join(obj.iter_jstree_json([]))
+        self.assertEqual(json.loads(result), obj.to_jstree_dict([]))
+
+        obj.append(self.sub_cls())
+        obj.append(self.sub_cls())
+        result = ''.join(obj.iter_jstree_json([], offset=1))
+        self.assertEqual(json.loads(result),
+                         obj.to_jstree_dict([], offset=1))
+
     def test_walk(self):
         sub_cls = type('SubCls', (Element, ),
                        {'_tagname': 'tag1',
@@ -1255,9 +2107,80 @@ class TestChoiceElement(TestCase):
         result = obj.to_jstree_dict([])
         self.assertEqual(result, {})
 
+    def test_iter_jstree_json(self):
+        obj = self.cls()
+        self.assertEqual(''.join(obj.iter_jstree_json([])), '{}')
+
+    def test_to_dict(self):
+        self.sub_cls2._sub_elements = []
+        cls = type('Cls', (Element,),
+                   {'_tagname': 'tag',
+                    '_sub_elements': [self.cls]})
+        obj = cls()
+        self.assertEqual(obj.to_dict(), {'tag': {}})
+        obj.tag2 = self.sub_cls2()
+        obj.tag2._comment = 'comment'
+        expected = {'tag': {'tag2': {'_comment': 'comment'}}}
+        self.assertEqual(obj.to_dict(), expected)
+        self.assertEqual(json.loads(''.join(obj.iter_json())), expected)
+
+        obj = cls.from_dict(expected)
+        self.assertFalse(hasattr(obj, 'tag1'))
+        self.assertTrue(isinstance(obj.tag2, self.sub_cls2))
+        self.assertEqual(obj.tag2._comment, 'comment')
+        self.assertEqual(obj.to_dict(), expected)
+
 
 class TestFunctions(TestCase):
 
+    def test__write_node(self):
+        xml = etree.fromstring('<root><tag>value</tag>tail</root>')[0]
+        f = StringIO()
+        with etree.xmlfile(f) as xf:
+            elements._write_node(xf, xml)
+        self.assertEqual(f.getvalue(), '<tag>value</tag>')
+        self.assertEqual(xml.tail, 'tail')
+
+        # The node is never changed, even during the writing
+        tails = []
+
+        class FakeWriter(object):
+            def write(self, node, **kwargs):
+                tails.append(node.tail)
+
+        elements._write_node(FakeWriter(), xml)
+        self.assertEqual(tails, ['tail'])
+
+    def test__get_children_comments(self):
+        xml = etree.Element('test')
+        self.assertEqual(elements._get_children_comments(xml), [])
+        xml.append(etree.Comment('comment'))
+        self.assertEqual(elements._get_children_comments(xml), [])
+
+        xml = etree.Element('test')
+        for i in range(7):
+            if i in [1, 4]:
+                elt = etree.Element('sub%i' % i)
+            else:
+                elt = etree.Comment('comment %i' % i)
+            xml.append(elt)
+        xml.append(etree.Element('sub7'))
+        result = [(child.tag, comments) for child, comments
+                  in elements._get_children_comments(xml)]
+        expected = [
+            ('sub1', ['comment 0']),
+            ('sub4', ['comment 2', 'comment 3']),
+            ('sub7', ['comment 5', 'comment 6']),
+        ]
+        self.assertEqual(result, expected)
+
+        # Same result as _load_comment_from_xml
+        xml.append(etree.Comment('comment 8'))
+        obj = Element()
+        for child, comments in elements._get_children_comments(xml):
+            obj._load_comment_from_xml(child)
+            self.assertEqual(obj._comment, '\n'.join(comments))
+
     def test_get_obj_from_str_id(self):
         dtd_str = '''
         <!ELEMENT texts (text)>
@@ -1444,3 +2367,240 @@ class TestFunctions(TestCase):
                 'children': []}}
         self.assertEqual(result, expected)
 
+    def test__get_obj_from_loaded_str_id(self):
+        dtd_str = '''
+        <!ELEMENT texts (tag1, list*, tag2)>
+        <!ELEMENT list (text)>
+        <!ELEMENT text (#PCDATA)>
+        <!ELEMENT tag1 (#PCDATA)>
+        <!ELEMENT tag2 (#PCDATA)>
+        '''
+        dic = dtd_parser.parse(dtd_str=dtd_str)
+        obj = dic['texts']()
+        obj.add('tag1', 'value')
+        lis = obj.add('list')
+        obj.add('list')
+        result = elements._get_obj_from_loaded_str_id(obj, 'texts')
+        self.assertEqual(result, obj)
+        result = elements._get_obj_from_loaded_str_id(obj, 'texts:tag1')
+        self.assertEqual(result, obj.tag1)
+        result = elements._get_obj_from_loaded_str_id(
+            obj, 'texts:list__list:0:list')
+        self.assertEqual(result, lis)
+        result = elements._get_obj_from_loaded_str_id(
+            obj, 'texts:list__list:1:list:text')
+        self.assertEqual(result._tagname, 'text')
+
+        for str_id in ['tag1', 'texts:list__list:2:list',
+                       'texts:list__list:list', 'texts:list__list:0:text']:
+            try:
+                elements._get_obj_from_loaded_str_id(obj, str_id)
+                assert 0
+            except Exception, e:
+                self.assertEqual(str(e), 'Invalid id %s' % str_id)
+
+        try:
+            elements._get_obj_from_loaded_str_id(obj, 'texts:unexisting')
+            assert 0
+        except Exception, e:
+            self.assertEqual(str(e), 'Unsupported tag unexisting')
+
+    def test_get_jstree_children(self):
+        dtd_str = '''
+        <!ELEMENT texts (tag1, list*, tag2)>
+        <!ELEMENT list (text)>
+        <!ELEMENT text (#PCDATA)>
+        <!ELEMENT tag1 (#PCDATA)>
+        <!ELEMENT tag2 (#PCDATA)>
+        '''
+        dic = dtd_parser.parse(dtd_str=dtd_str)
+        obj = dic['texts']()
+        obj.add('list')
+        result = elements.get_jstree_children(obj, 'tree_texts')
+        expected = [
+            {'data': 'tag1',
+             'attr': {'id': 'tree_texts:tag1',
+                      'class': 'tree_texts:tag1'},
+             'children': []},
+            [{'data': 'list',
+              'attr': {'id': 'tree_texts:list__list:0:list',
+                       'class': ('tree_texts:list__list '
+                                 'tree_texts:list__list:0')},
+              'state': 'closed'}],
+            {'data': 'tag2',
+             'attr': {'id': 'tree_texts:tag2',
+                      'class': 'tree_texts:tag2'},
+             'children': []},
+        ]
+        self.assertEqual(result, expected)
+
+        result = elements.get_jstree_children(obj, 'texts:list__list:0:list')
+        expected = [
+            {'data': 'text',
+             'attr': {'id': 'tree_texts:list__list:0:list:text',
+                      'class': 'tree_texts:list__list:0:list:text'},
+             'children': []}]
+        self.assertEqual(result, expected)
+
+        result = elements.get_jstree_children(obj, 'tree_texts',
+                                              max_depth=None)
+        self.assertEqual(result, obj.to_jstree_dict([])['children'])
+
+    def test_get_list_html_from_str_id(self):
+        dtd_str = '''
+        <!ELEMENT texts (tag1, list*, tag2)>
+        <!ELEMENT list (text)>
+        <!ELEMENT text (#PCDATA)>
+        <!ELEMENT tag1 (#PCDATA)>
+        <!ELEMENT tag2 (#PCDATA)>
+        '''
+        dic = dtd_parser.parse(dtd_str=dtd_str)
+        obj = dic['texts']()
+        for i in range(3):
+            obj.add('list').add('text', 'text %i' % i)
+
+        result = elements.get_list_html_from_str_id(
+            obj, 'texts:list__list:2', limit=1)
+        expected = (
+            '<a class="btn btn-add-ajax-list" '
+            'data-id="texts:list__list:2:list">New list</a>'
+            '<fieldset class="list texts:list__list:2:list" '
+            'id="texts:list__list:2:list">'
+            '<legend>list'
+            '<a data-comment-name="texts:list__list:2:list:_comment" '
+            'class="btn-comment">Comment</a>'
+            '<a class="btn-delete-fieldset">Delete</a>'
+            '</legend>'
+            '<div data-id="texts:list__list:2:list:text">'
+            '<label>text</label>'
+            '<a data-comment-name="texts:list__list:2:list:text:_comment" '
+            'class="btn-comment">Comment</a>'
+            '<textarea name="texts:list__list:2:list:text:_value" '
+            'id="texts:list__list:2:list:text" '
+            'class="texts:list__list:2:list:text" rows="1">text 2</textarea>'
+            '</div>'
+            '</fieldset>'
+            '<a class="btn btn-add-ajax-list" '
+            'data-id="texts:list__list:3:list">New list</a>')
+        self.assertEqual(result, expected)
+
+        # An item has been deleted in the form, the index is not the same
+        # than the position in the loaded list.
+        result = elements.get_list_html_from_str_id(
+            obj, 'texts:list__list:1', start=2, limit=1)
+        self.assertTrue('>text 2</textarea>' in result)
+        self.assertTrue('id="texts:list__list:1:list"' in result)
+
+        result = elements.get_list_html_from_str_id(
+            obj, 'texts:list__list:0', limit=2)
+        self.assertTrue(result.endswith(
+            '<a class="btn btn-list-more" data-id="texts:list__list:2" '
+            'data-start="2" data-limit="2">More list (1)</a>'))
+
+        for str_id in ['texts:list__list', 'texts:list__list:4',
+                       'texts:tag1:0']:
+            try:
+                elements.get_list_html_from_str_id(obj, str_id)
+                assert 0
+            except Exception, e:
+                self.assertEqual(str(e), 'Invalid id %s' % str_id)
+
+    def test__get_position_from_loaded_str_id(self):
+        dtd_str = '''
+        <!ELEMENT texts (tag1, list*, tag2)>
+        <!ELEMENT list (text)>
+        <!ELEMENT text (#PCDATA)>
+        <!ELEMENT tag1 (#PCDATA)>
+        <!ELEMENT tag2 (#PCDATA)>
+        '''
+        dic = dtd_parser.parse(dtd_str=dtd_str)
+        obj = dic['texts']()
+        result = elements._get_position_from_loaded_str_id(obj, 'texts:tag1')
+        self.assertEqual(result, (obj, 'tag1', None, None))
+
+        for str_id in ['texts', 'texts:list__list:0:list']:
+            try:
+                elements._get_position_from_loaded_str_id(obj, str_id)
+                assert 0
+            except Exception, e:
+                self.assertEqual(str(e), 'Invalid id %s' % str_id)
+
+        result = elements._get_position_from_loaded_str_id(
+            obj, 'texts:list__list:0:list', create=True)
+        self.assertEqual(result, (obj, 'list', obj.list, 0))
+        self.assertEqual(obj.list, [])
+
+        obj.add('list')
+        result = elements._get_position_from_loaded_str_id(
+            obj, 'texts:list__list:0:list')
+        self.assertEqual(result, (obj, 'list', obj.list, 0))
+
+        result = elements._get_position_from_loaded_str_id(
+            obj, 'texts:list__list:0:list:text', create=True)
+        self.assertEqual(result, (obj.list[0], 'text', None, None))
+
+        for str_id in ['texts:unexisting', 'texts:list__list:0:text']:
+            try:
+                elements._get_position_from_loaded_str_id(obj, str_id)
+                assert 0
+            except Exception, e:
+                self.assertTrue(str(e).startswith('Unsupported tag'))
+
+    def test_apply_operations(self):
+        dtd_str = '''
+        <!ELEMENT texts (tag1, list*, tag2?)>
+        <!ELEMENT list (text)>
+        <!ELEMENT text (#PCDATA)>
+        <!ATTLIST text idtext ID #IMPLIED>
+        <!ELEMENT tag1 (#PCDATA)>
+        <!ELEMENT tag2 (#PCDATA)>
+        '''
+        dic = dtd_parser.parse(dtd_str=dtd_str)
+        obj = dic['texts']()
+        for i in range(3):
+            obj.add('list').add('text', 'text %i' % i)
+
+        elements.apply_operations(obj, [
+            ('set', 'texts:tag1:_value', 'tag1 value'),
+            ('set', 'texts:tag1:_comment', 'tag1 comment'),
+            ('delete', 'texts:list__list:0:list'),
+            ('add', 'texts:list__list:1:list'),
+            ('set', 'texts:list__list:1:list:text:_value', 'new text'),
+            ('set', 'texts:list__list:1:list:text:_attrs:idtext', 'id1'),
+            ('move', 'texts:list__list:0:list', 2),
+            ('add', 'texts:tag2'),
+        ])
+        self.assertEqual(obj.tag1._value, 'tag1 value')
+        self.assertEqual(obj.tag1._comment, 'tag1 comment')
+        self.assertEqual([e.text._value for e in obj.list],
+                         ['new text', 'text 2', 'text 1'])
+        self.assertEqual(obj.list[0].text._attributes, {'idtext': 'id1'})
+        self.assertEqual(obj.list[0]._parent, obj.list)
+        self.assertTrue(obj.tag2)
+
+        elements.apply_operations(obj, [
+            ('set', 'texts:tag1:_comment', ''),
+            ('delete', 'texts:tag2'),
+            ('set', 'texts:list__list:0:list:text:_attrs:idtext', None),
+        ])
+        self.assertEqual(obj.tag1._comment, None)
+        self.assertFalse(hasattr(obj, 'tag2'))
+        self.assertEqual(obj.list[0].text._attributes, None)
+
+        for operations, msg in [
+            ([('update', 'texts:tag1')], 'Unsupported operation update'),
+            ([('set', 'texts:tag1', 'value')], 'Invalid name texts:tag1'),
+            ([('set', 'texts:list__list:0:list:_value', 'value')],
+             "Can't set value to non TextElement"),
+            ([('delete', 'texts:tag2')], 'Invalid id texts:tag2'),
+            ([('add', 'texts:list__list:5:list')],
+             'Invalid id texts:list__list:5:list'),
+            ([('move', 'texts:list__list:0:list', 3)],
+             'Invalid move of texts:list__list:0:list'),
+            ([('move', 'texts:tag1', 0)], 'Invalid move of texts:tag1'),
+        ]:
+            try:
+                elements.apply_operations(obj, operations)
+                assert 0
+            except Exception, e:
+                self.assertEqual(str(e), msg)
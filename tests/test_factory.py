@@ -2,8 +2,21 @@
 
 from unittest import TestCase
 from lxml import etree
+import mmap
 import os.path
-from xmltool import factory
+import shutil
+from StringIO import StringIO
+import webob
+from xmltool import factory, utils, metrics, elements
+
+
+def _get_question(obj):
+    # Used by the processes of map_subtrees
+    return (obj._tagname, obj.question._value)
+
+
+def _get_comment(obj):
+    return obj._comment
 
 
 class TestFactory(TestCase):
@@ -24,6 +37,154 @@ class TestFactory(TestCase):
                                  validate=False)
         self.assertEqual(obj._tagname, 'Exercise')
 
+    def test_load_catalog(self):
+        url = 'http://xmltool.lereskp.fr/static/exercise.dtd'
+        try:
+            utils.add_catalog_entry(url, 'tests/exercise.dtd')
+            obj = factory.load('tests/exercise.xml')
+            self.assertEqual(obj._tagname, 'Exercise')
+            self.assertEqual(obj._xml_dtd_url, url)
+
+            xml_str = open('tests/exercise.xml', 'r').read()
+            obj = factory.load_string(xml_str)
+            self.assertEqual(obj._tagname, 'Exercise')
+            self.assertEqual(obj._xml_filename, None)
+            self.assertEqual(obj._xml_dtd_url, url)
+            self.assertEqual(obj._xml_encoding, 'UTF-8')
+            obj = factory.load_string(xml_str.decode('utf-8'))
+            self.assertEqual(obj._tagname, 'Exercise')
+
+            for buf in [bytearray(xml_str), memoryview(xml_str)]:
+                obj = factory.load_string(buf)
+                self.assertEqual(obj._tagname, 'Exercise')
+                self.assertEqual(obj._xml_dtd_url, url)
+                self.assertEqual(obj._xml_encoding, 'UTF-8')
+                obj = factory.load(buf)
+                self.assertEqual(obj._tagname, 'Exercise')
+
+            f = open('tests/exercise.xml', 'rb')
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                obj = factory.load_string(m)
+                self.assertEqual(obj._tagname, 'Exercise')
+                m.close()
+            finally:
+                f.close()
+
+            try:
+                factory.load_string(bytearray('<Exercise>'))
+                assert 0
+            except etree.XMLSyntaxError:
+                pass
+            # The parser of the thread can still be used
+            obj = factory.load_string(bytearray(xml_str))
+            self.assertEqual(obj._tagname, 'Exercise')
+        finally:
+            utils.clear_catalog()
+
+    def test_load_metrics(self):
+        url = 'http://xmltool.lereskp.fr/static/exercise.dtd'
+        try:
+            utils.add_catalog_entry(url, 'tests/exercise.dtd')
+            with metrics.collect() as events:
+                factory.generate_form('tests/exercise.xml')
+        finally:
+            utils.clear_catalog()
+        self.assertEqual([e[0] for e in events], [
+            'xml_parse',
+            'dtd_fetch',
+            'validate',
+            'dtd_parse',
+            'class_generation',
+            'load_from_xml',
+            'load',
+            'to_html',
+            'generate_form_from_obj',
+            'generate_form',
+        ])
+        infos = dict((name, info) for name, duration, info in events)
+        self.assertEqual(infos['xml_parse']['bytes'],
+                         os.path.getsize('tests/exercise.xml'))
+        self.assertEqual(infos['dtd_fetch']['bytes'],
+                         os.path.getsize('tests/exercise.dtd'))
+        self.assertEqual(infos['class_generation']['classes'], 9)
+        root = etree.parse('tests/exercise.xml').getroot()
+        self.assertEqual(infos['load_from_xml']['nodes'],
+                         len(list(root.iter())))
+        self.assertTrue(infos['to_html']['bytes'] > 0)
+
+    def test_load_document_cache(self):
+        url = 'http://xmltool.lereskp.fr/static/exercise.dtd'
+        filename = 'tests/exercise-cache.xml'
+        self.assertFalse(os.path.isfile(filename))
+        shutil.copy('tests/exercise.xml', filename)
+        try:
+            utils.add_catalog_entry(url, 'tests/exercise.dtd')
+            elements.set_document_cache(10 ** 6)
+            obj1 = factory.load(filename)
+            self.assertEqual(len(elements._document_cache), 1)
+            self.assertEqual(elements._document_cache.size,
+                             os.path.getsize(filename))
+            with metrics.collect() as events:
+                obj2 = factory.load(filename, validate=False)
+            # The file is not parsed again
+            self.assertEqual([e[0] for e in events], ['clone', 'load'])
+            self.assertTrue(obj1 is not obj2)
+            self.assertTrue(obj1._clone_source is obj2._clone_source)
+            self.assertEqual(obj2._xml_filename, filename)
+            self.assertEqual(obj2._xml_dtd_url, url)
+            self.assertEqual(obj2.to_dict(), obj1.to_dict())
+
+            obj1.number._value = '2'
+            self.assertEqual(obj2.number._value, '1')
+            self.assertEqual(factory.load(filename).number._value, '1')
+
+            # Writing the file drops its document
+            obj1.write()
+            self.assertEqual(len(elements._document_cache), 0)
+            self.assertEqual(factory.load(filename).number._value, '2')
+            self.assertEqual(len(elements._document_cache), 1)
+
+            # The file is reloaded when it's changed by someone else
+            xml_str = open('tests/exercise.xml', 'r').read()
+            with utils.atomic_open(filename) as f:
+                f.write(xml_str.replace('<number>1</number>',
+                                        '<number>10</number>'))
+            self.assertEqual(factory.load(filename).number._value, '10')
+            self.assertEqual(len(elements._document_cache), 1)
+
+            # A document loaded without validation is validated when needed
+            shutil.copy('tests/exercise-notvalid.xml', filename)
+            obj = factory.load(filename, validate=False)
+            self.assertEqual(obj._tagname, 'Exercise')
+            try:
+                factory.load(filename)
+                assert 0
+            except etree.DocumentInvalid:
+                pass
+
+            # The documents bigger than the cache are not kept
+            elements.set_document_cache(10)
+            obj = factory.load('tests/exercise.xml')
+            self.assertEqual(obj._tagname, 'Exercise')
+            self.assertEqual(len(elements._document_cache), 0)
+        finally:
+            elements.set_document_cache(None)
+            utils.clear_catalog()
+            os.remove(filename)
+        self.assertEqual(elements._document_cache, None)
+
+    def test_json(self):
+        url = 'http://xmltool.lereskp.fr/static/exercise.dtd'
+        try:
+            utils.add_catalog_entry(url, 'tests/exercise.dtd')
+            obj = factory.load('tests/exercise.xml')
+            new_obj = obj.__class__.from_json(obj.to_json())
+            self.assertEqual(new_obj.to_dict(), obj.to_dict())
+            self.assertEqual(new_obj.to_xml().tag, 'Exercise')
+        finally:
+            utils.clear_catalog()
+
     def test_load_string(self):
         xml_str = open('tests/exercise.xml', 'r').read()
         obj = factory.load_string(xml_str)
@@ -72,6 +233,68 @@ class TestFactory(TestCase):
 
         self.assertTrue('<fieldset class="Exercise" id="Exercise">' in html)
 
+    def test_generate_form_limit(self):
+        filename = 'tests/exercise-local.xml'
+        self.assertFalse(os.path.isfile(filename))
+        try:
+            xml_str = open('tests/exercise.xml', 'r').read().replace(
+                'PUBLIC "http://xmltool.lereskp.fr/static/exercise.dtd" '
+                '"http://xmltool.lereskp.fr/static/exercise.dtd"',
+                'SYSTEM "exercise.dtd"')
+            open(filename, 'w').write(xml_str)
+            html = factory.generate_form(filename, limit=1)
+            self.assertTrue('id="Exercise:list__test:0:test"' in html)
+            self.assertFalse('id="Exercise:list__test:1:test"' in html)
+            button = ('<a class="btn btn-list-more" '
+                      'data-id="Exercise:list__test:1" data-start="1" '
+                      'data-limit="1">More test (1)</a>')
+            self.assertTrue(button in html)
+
+            html = factory.get_list_html(filename, 'Exercise:list__test:1',
+                                         limit=1)
+            self.assertTrue(html.startswith(
+                '<a class="btn btn-add-ajax-list" '
+                'data-id="Exercise:list__test:1:test">New test</a>'
+                '<fieldset class="test Exercise:list__test:1:test" '
+                'id="Exercise:list__test:1:test">'))
+            self.assertTrue(html.endswith(
+                '<a class="btn btn-add-ajax-list" '
+                'data-id="Exercise:list__test:2:test">New test</a>'))
+        finally:
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+    def test_get_jstree_children(self):
+        filename = 'tests/exercise-local.xml'
+        self.assertFalse(os.path.isfile(filename))
+        try:
+            xml_str = open('tests/exercise.xml', 'r').read().replace(
+                'PUBLIC "http://xmltool.lereskp.fr/static/exercise.dtd" '
+                '"http://xmltool.lereskp.fr/static/exercise.dtd"',
+                'SYSTEM "exercise.dtd"')
+            open(filename, 'w').write(xml_str)
+            obj = factory.load(filename)
+            tree = obj.to_jstree_dict([], max_depth=2)
+            test = tree['children'][1][0]
+            self.assertEqual(test['attr']['id'],
+                             'tree_Exercise:list__test:0:test')
+            self.assertEqual(test['state'], 'closed')
+            self.assertFalse('children' in test)
+
+            # Expand the closed node
+            children = factory.get_jstree_children(filename,
+                                                   test['attr']['id'])
+            self.assertEqual(children[0]['attr']['id'],
+                             'tree_Exercise:list__test:0:test:question')
+            self.assertEqual(children[1][0]['state'], 'closed')
+            self.assertEqual(
+                factory.get_jstree_children(filename, test['attr']['id'],
+                                            max_depth=None),
+                obj.to_jstree_dict([])['children'][1][0]['children'])
+        finally:
+            if os.path.isfile(filename):
+                os.remove(filename)
+
     def test_generate_form_from_obj(self):
         obj = factory.load('tests/exercise.xml')
         html = factory.generate_form_from_obj(obj)
@@ -129,6 +352,240 @@ class TestFactory(TestCase):
             if os.path.isfile(filename):
                 os.remove(filename)
 
+    def test_iter_subtrees(self):
+        url = 'http://xmltool.lereskp.fr/static/exercise.dtd'
+        try:
+            utils.add_catalog_entry(url, 'tests/exercise.dtd')
+            objs = list(factory.iter_subtrees('tests/exercise.xml', 'test',
+                                              validate=True))
+            self.assertEqual(len(objs), 2)
+            self.assertEqual(objs[0]._tagname, 'test')
+            self.assertEqual(objs[0]._xml_dtd_url, url)
+            self.assertEqual(objs[0]._attributes, {'idtest': 'T1'})
+            self.assertEqual(objs[0].question._value,
+                             'What is your favorite color?')
+            self.assertEqual(len(objs[0].list__qcm_mqm), 2)
+            self.assertEqual(objs[1].list__qcm_mqm[0]._tagname, 'qcm')
+            self.assertEqual(objs[1].to_xml().tag, 'test')
+
+            self.assertEqual(
+                list(factory.iter_subtrees('tests/exercise.xml', 'unexisting')),
+                [])
+            try:
+                list(factory.iter_subtrees(StringIO(
+                    '<?xml version="1.0"?>'
+                    '<!DOCTYPE Exercise SYSTEM "%s">'
+                    '<Exercise><unknown/></Exercise>' % url), 'unknown'))
+                assert 0
+            except Exception, e:
+                self.assertEqual(str(e), 'Invalid tag unknown')
+        finally:
+            utils.clear_catalog()
+
+    def test_map_subtrees(self):
+        url = 'http://xmltool.lereskp.fr/static/exercise.dtd'
+        expected = [('test', 'What is your favorite color?'),
+                    ('test', 'What is your favorite color 2?')]
+        try:
+            utils.add_catalog_entry(url, 'tests/exercise.dtd')
+            for jobs in [1, 2]:
+                result = factory.map_subtrees(_get_question,
+                                              'tests/exercise.xml', 'test',
+                                              jobs=jobs, chunksize=1,
+                                              validate=True)
+                self.assertEqual(list(result), expected)
+            result = factory.map_subtrees(_get_question,
+                                          'tests/exercise.xml', 'unexisting',
+                                          jobs=2)
+            self.assertEqual(list(result), [])
+        finally:
+            utils.clear_catalog()
+
+    def test_subtrees_comments(self):
+        url = 'http://xmltool.lereskp.fr/static/exercise.dtd'
+        xml_str = open('tests/exercise.xml', 'r').read()
+        xml_str = xml_str.replace(
+            '<test idtest="T1">', '<!-- c1 -->\n  <test idtest="T1">').replace(
+            '<test idtest="T2">', '<!-- c2 -->\n  <!-- c3 -->\n  '
+            '<test idtest="T2">')
+        try:
+            utils.add_catalog_entry(url, 'tests/exercise.dtd')
+            objs = list(factory.iter_subtrees(StringIO(xml_str), 'test'))
+            self.assertEqual([o._comment for o in objs],
+                             [' c1 ', ' c2 \n c3 '])
+            for jobs in [1, 2]:
+                result = factory.map_subtrees(_get_comment, StringIO(xml_str),
+                                              'test', jobs=jobs, chunksize=1)
+                self.assertEqual(list(result), [' c1 ', ' c2 \n c3 '])
+        finally:
+            utils.clear_catalog()
+
+    def test_load_async(self):
+        filename = 'tests/exercise-local.xml'
+        self.assertFalse(os.path.isfile(filename))
+        try:
+            xml_str = open('tests/exercise.xml', 'r').read().replace(
+                'PUBLIC "http://xmltool.lereskp.fr/static/exercise.dtd" '
+                '"http://xmltool.lereskp.fr/static/exercise.dtd"',
+                'SYSTEM "exercise.dtd"')
+            open(filename, 'w').write(xml_str)
+            results = []
+            res = factory.load_async(filename, callback=results.append)
+            obj = res.get(10)
+            self.assertEqual(obj._tagname, 'Exercise')
+            self.assertEqual(results, [obj])
+
+            open(filename, 'w').write(xml_str.replace('<comments>', '<a>'))
+            res = factory.load_async(filename)
+            try:
+                res.get(10)
+                assert 0
+            except etree.XMLSyntaxError:
+                pass
+        finally:
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+    def test_update_async(self):
+        filename = 'tests/test.xml'
+        self.assertFalse(os.path.isfile(filename))
+        try:
+            data = {
+                '_xml_encoding': 'UTF-8',
+                '_xml_dtd_url': os.path.abspath('tests/exercise.dtd'),
+                'Exercise': {'number': {'_value': '1'}},
+            }
+            res = factory.update_async(filename, data, lock=True)
+            obj = res.get(10)
+            self.assertEqual(obj.number._value, '1')
+            result = open(filename, 'r').read()
+            self.assertTrue('<number>1</number>' in result)
+        finally:
+            for f in [filename, utils.get_lock_filename(filename)]:
+                if os.path.isfile(f):
+                    os.remove(f)
+
+    def test_update_partial(self):
+        filename = 'tests/exercise-local.xml'
+        self.assertFalse(os.path.isfile(filename))
+        try:
+            xml_str = open('tests/exercise.xml', 'r').read().replace(
+                'PUBLIC "http://xmltool.lereskp.fr/static/exercise.dtd" '
+                '"http://xmltool.lereskp.fr/static/exercise.dtd"',
+                'SYSTEM "exercise.dtd"')
+            open(filename, 'w').write(xml_str)
+            operations = [
+                ('set', 'Exercise:number:_value', '2'),
+                ('delete', 'Exercise:list__test:0:test'),
+            ]
+            obj = factory.update_partial(filename, operations)
+            self.assertEqual(obj.number._value, '2')
+            result = open(filename, 'r').read()
+            self.assertTrue('<number>2</number>' in result)
+            self.assertFalse('idtest="T1"' in result)
+            self.assertTrue('<test idtest="T2">' in result)
+            self.assertTrue(result.startswith(
+                "<?xml version='1.0' encoding='UTF-8'?>\n"
+                '<!DOCTYPE Exercise SYSTEM "exercise.dtd">\n'))
+
+            # The test needs a question
+            operations = [('add', 'Exercise:list__test:1:test')]
+            try:
+                factory.update_partial(filename, operations, lock=True)
+                assert 0
+            except etree.DocumentInvalid:
+                pass
+            self.assertEqual(open(filename, 'r').read(), result)
+        finally:
+            for f in [filename, utils.get_lock_filename(filename)]:
+                if os.path.isfile(f):
+                    os.remove(f)
+
+    def test_get_operations(self):
+        # The payload posted by xmltool.js (JSON.stringify)
+        operations_str = (
+            '[["delete","Exercise:list__test:0:test"],'
+            '["add","Exercise:list__test:1:test"],'
+            '["set","Exercise:number:_value","2"]]')
+        result = factory.get_operations(operations_str)
+        expected = [
+            ('delete', 'Exercise:list__test:0:test'),
+            ('add', 'Exercise:list__test:1:test'),
+            ('set', 'Exercise:number:_value', '2'),
+        ]
+        self.assertEqual(result, expected)
+
+        result = factory.get_operations(
+            '[["move","Exercise:list__test:0:test",1],'
+            '["set","Exercise:number:attr",null]]')
+        expected = [
+            ('move', 'Exercise:list__test:0:test', 1),
+            ('set', 'Exercise:number:attr', None),
+        ]
+        self.assertEqual(result, expected)
+        self.assertEqual(factory.get_operations('[]'), [])
+
+        for operations_str in [
+                None,
+                'invalid',
+                '{"set": "Exercise:number:_value"}',
+                '["set"]',
+                '[[]]',
+                '[["unknown","Exercise"]]',
+                '[[["set"],"Exercise"]]',
+                '[["delete"]]',
+                '[["delete",1]]',
+                '[["delete","Exercise","Exercise"]]',
+                '[["set","Exercise:number:_value"]]',
+                '[["set","Exercise:number:_value",2]]',
+                '[["move","Exercise:list__test:0:test","1"]]',
+                '[["move","Exercise:list__test:0:test",true]]']:
+            try:
+                factory.get_operations(operations_str)
+                assert 0
+            except Exception, e:
+                self.assertTrue(str(e).startswith('Bad operation'))
+
+    def test_update_operations(self):
+        filename = 'tests/exercise-local.xml'
+        self.assertFalse(os.path.isfile(filename))
+        try:
+            xml_str = open('tests/exercise.xml', 'r').read().replace(
+                'PUBLIC "http://xmltool.lereskp.fr/static/exercise.dtd" '
+                '"http://xmltool.lereskp.fr/static/exercise.dtd"',
+                'SYSTEM "exercise.dtd"')
+            open(filename, 'w').write(xml_str)
+            # The data posted by the form with the partial option: the
+            # other fields are disabled
+            data = webob.MultiDict([
+                ('_xml_filename', filename),
+                ('_xml_dtd_url', 'exercise.dtd'),
+                ('_xml_encoding', 'UTF-8'),
+                ('_xml_operations',
+                 '[["delete","Exercise:list__test:0:test"],'
+                 '["set","Exercise:number:_value","2"],'
+                 '["set","Exercise:list__test:0:test:question:_value",'
+                 '"Question?"]]'),
+            ])
+            obj = factory.update(filename, data)
+            self.assertEqual(obj.number._value, '2')
+            result = open(filename, 'r').read()
+            self.assertTrue('<number>2</number>' in result)
+            self.assertFalse('idtest="T1"' in result)
+            self.assertTrue('<test idtest="T2">' in result)
+            self.assertTrue('<question idquestion="Q2">Question?</question>' in result)
+
+            data['_xml_operations'] = '[["set","Exercise:number:_value"]]'
+            try:
+                factory.update(filename, data)
+                assert 0
+            except Exception, e:
+                self.assertTrue(str(e).startswith('Bad operation'))
+            self.assertEqual(open(filename, 'r').read(), result)
+        finally:
+            if os.path.isfile(filename):
+                os.remove(filename)
+
     def test_new(self):
         dtd_url = 'http://xmltool.lereskp.fr/static/exercise.dtd'
         root_tag = 'choice'
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+from unittest import TestCase
+import os.path
+import threading
+from xmltool import metrics
+
+
+class TestMetrics(TestCase):
+
+    def test_phase(self):
+        self.assertEqual(metrics._is_enabled(), False)
+        phase = metrics.phase('name', bytes=10)
+        self.assertEqual(phase, metrics._noop_phase)
+        self.assertEqual(phase.enabled, False)
+        with phase as p:
+            p.set(nodes=1)
+
+        events = []
+        handler = lambda *args: events.append(args)
+        metrics.add_handler(handler)
+        try:
+            with metrics.phase('name', bytes=10) as p:
+                self.assertEqual(p.enabled, True)
+                p.set(nodes=2)
+            self.assertEqual(len(events), 1)
+            name, duration, info = events[0]
+            self.assertEqual(name, 'name')
+            self.assertTrue(duration >= 0)
+            self.assertEqual(info, {'bytes': 10, 'nodes': 2})
+
+            try:
+                with metrics.phase('error'):
+                    raise ValueError('My error')
+                assert 0
+            except ValueError:
+                pass
+            self.assertEqual(events[1][0], 'error')
+            self.assertEqual(events[1][2], {'error': 'ValueError'})
+        finally:
+            metrics.remove_handler(handler)
+        self.assertEqual(metrics._is_enabled(), False)
+        with metrics.phase('name'):
+            pass
+        self.assertEqual(len(events), 2)
+
+    def test_measured(self):
+        @metrics.measured('func')
+        def func(a, b=1):
+            "My func"
+            return a + b
+
+        self.assertEqual(func.__name__, 'func')
+        self.assertEqual(func.__doc__, 'My func')
+        self.assertEqual(func(1), 2)
+        with metrics.collect() as events:
+            self.assertEqual(func(1, b=2), 3)
+        self.assertEqual([e[0] for e in events], ['func'])
+
+    def test_collect(self):
+        phases = []
+
+        def target():
+            with metrics.phase('other') as p:
+                phases.append(p)
+
+        with metrics.collect() as events:
+            with metrics.phase('phase1'):
+                with metrics.collect() as sub_events:
+                    with metrics.phase('phase2'):
+                        pass
+            # The phases of the other threads are not collected, nor
+            # measured
+            t = threading.Thread(target=target)
+            t.start()
+            t.join()
+            self.assertEqual(phases, [metrics._noop_phase])
+        self.assertEqual([e[0] for e in events], ['phase2', 'phase1'])
+        self.assertEqual([e[0] for e in sub_events], ['phase2'])
+        self.assertEqual(metrics._is_enabled(), False)
+
+    def test_PrometheusHandler(self):
+        handler = metrics.PrometheusHandler()
+        handler('load', 0.5, {'bytes': 100, 'url': 'http://dtd'})
+        handler('load', 0.25, {'bytes': 50, 'error': 'ValueError'})
+        handler('validate', 1, {})
+        expected = '''# HELP xmltool_phase_seconds Duration of the phases
+# TYPE xmltool_phase_seconds summary
+xmltool_phase_seconds_count{phase="load"} 2
+xmltool_phase_seconds_sum{phase="load"} 0.75
+xmltool_phase_seconds_count{phase="validate"} 1
+xmltool_phase_seconds_sum{phase="validate"} 1.0
+# HELP xmltool_phase_errors_total Number of phases which raised an error
+# TYPE xmltool_phase_errors_total counter
+xmltool_phase_errors_total{phase="load"} 1
+xmltool_phase_errors_total{phase="validate"} 0
+# TYPE xmltool_phase_bytes_total counter
+xmltool_phase_bytes_total{phase="load"} 150
+'''
+        self.assertEqual(handler.to_text(), expected)
+
+        filename = 'tests/metrics.prom'
+        self.assertFalse(os.path.isfile(filename))
+        try:
+            handler.write(filename)
+            self.assertEqual(open(filename, 'r').read(), expected)
+        finally:
+            if os.path.isfile(filename):
+                os.remove(filename)
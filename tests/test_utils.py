@@ -2,6 +2,13 @@
 
 from unittest import TestCase
 from lxml import etree
+import mmap
+import os.path
+import stat
+import StringIO
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 from xmltool import utils
 from test_dtd_parser import EXERCISE_XML, EXERCISE_DTD, INVALID_EXERCISE_XML
 import webob
@@ -27,6 +34,98 @@ class TestUtils(TestCase):
         fs_content = utils.get_dtd_content(url, path='tests/')
         self.assertEqual(http_content, fs_content)
 
+    def test_catalog(self):
+        url = 'http://xmltool.lereskp.fr/static/exercise.dtd'
+        public_id = '-//XMLTOOL//DTD Exercise//EN'
+        catalog_filename = 'tests/catalog.xml'
+        fs_content = open('tests/exercise.dtd', 'r').read()
+        self.assertEqual(utils.get_catalog_filename(url), None)
+        try:
+            utils.add_catalog_entry(url, 'tests/exercise.dtd')
+            self.assertEqual(utils.get_catalog_filename(url),
+                             os.path.abspath('tests/exercise.dtd'))
+            self.assertEqual(utils.get_dtd_content(url), fs_content)
+
+            # lxml uses the catalog to load the DTD
+            parser = etree.XMLParser(load_dtd=True, no_network=True)
+            parser.resolvers.add(utils.CatalogResolver())
+            tree = etree.parse('tests/exercise.xml', parser)
+            self.assertEqual(tree.docinfo.system_url, url)
+            self.assertTrue(tree.docinfo.internalDTD is not None)
+
+            utils.clear_catalog()
+            self.assertEqual(utils.get_catalog_filename(url), None)
+
+            open(catalog_filename, 'w').write(
+                '<catalog xmlns='
+                '"urn:oasis:names:tc:entity:xmlns:xml:catalog">'
+                '<system systemId="%s" uri="exercise.dtd"/>'
+                '<public publicId="%s" uri="file://exercise.dtd"/>'
+                '</catalog>' % (url, public_id))
+            utils.load_catalog(catalog_filename)
+            self.assertEqual(utils.get_catalog_filename(url),
+                             os.path.abspath('tests/exercise.dtd'))
+            self.assertEqual(
+                utils.get_catalog_filename('http://other.dtd', public_id),
+                os.path.abspath('tests/exercise.dtd'))
+
+            self.assertEqual(utils.preload_catalog(),
+                             [os.path.abspath('tests/exercise.dtd')])
+            # The preloaded content is used
+            utils._catalog_contents[
+                os.path.abspath('tests/exercise.dtd')] = 'preloaded'
+            self.assertEqual(utils.get_dtd_content(url), 'preloaded')
+        finally:
+            utils.clear_catalog()
+            if os.path.isfile(catalog_filename):
+                os.remove(catalog_filename)
+
+    def test_get_xml_parser(self):
+        parser = utils.get_xml_parser()
+        self.assertTrue(isinstance(parser, etree.XMLParser))
+        # The parser is cached for the thread
+        self.assertTrue(utils.get_xml_parser() is parser)
+        parsers = []
+        t = threading.Thread(
+            target=lambda: parsers.append(utils.get_xml_parser()))
+        t.start()
+        t.join()
+        self.assertTrue(parsers[0] is not parser)
+
+        xml_str = '<root>\n  <a>a</a>\n</root>'
+        self.assertEqual(etree.tostring(etree.fromstring(xml_str, parser)),
+                         xml_str)
+        try:
+            utils.set_xml_parser_options(remove_blank_text=True)
+            new_parser = utils.get_xml_parser()
+            self.assertTrue(new_parser is not parser)
+            self.assertTrue(utils.get_xml_parser() is new_parser)
+            self.assertEqual(
+                etree.tostring(etree.fromstring(xml_str, new_parser)),
+                '<root><a>a</a></root>')
+        finally:
+            utils.set_xml_parser_options()
+        self.assertEqual(utils._xml_parser_options,
+                         utils.DEFAULT_XML_PARSER_OPTIONS)
+
+    def test_iter_buffer_chunks(self):
+        data = 'abcdefg'
+        for buf in [data, bytearray(data), memoryview(data)]:
+            chunks = list(utils.iter_buffer_chunks(buf, 3))
+            self.assertEqual(chunks, ['abc', 'def', 'g'])
+            for chunk in chunks:
+                self.assertEqual(type(chunk), str)
+        self.assertEqual(list(utils.iter_buffer_chunks('')), [])
+
+        f = open('tests/exercise.dtd', 'rb')
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.assertEqual(''.join(utils.iter_buffer_chunks(m, 100)),
+                             open('tests/exercise.dtd', 'rb').read())
+            m.close()
+        finally:
+            f.close()
+
     def test_validate_xml(self):
         root = etree.fromstring(EXERCISE_XML)
         utils.validate_xml(root, EXERCISE_DTD)
@@ -37,6 +136,257 @@ class TestUtils(TestCase):
         except etree.DocumentInvalid:
             pass
 
+    def test_validate_xml_file(self):
+        dtd_str = (
+            '<!ELEMENT texts (text+)>'
+            '<!ELEMENT text (title, ref*)>'
+            '<!ELEMENT title (#PCDATA)>'
+            '<!ELEMENT ref EMPTY>'
+            '<!ATTLIST text idtext ID #IMPLIED>'
+            '<!ATTLIST ref idref IDREF #REQUIRED>')
+        header = ('<?xml version="1.0"?>\n'
+                  '<!DOCTYPE texts SYSTEM "http://dtd.url">\n')
+        xml_str = header + (
+            '<texts>'
+            '<text idtext="t1"><title>Title 1</title><ref idref="t2"/></text>'
+            '<text idtext="t2"><title>Title 2</title><ref idref="t1"/></text>'
+            '</texts>')
+        self.assertEqual(
+            utils.validate_xml_file(StringIO.StringIO(xml_str), dtd_str),
+            True)
+
+        for xml_str, error in [
+                ('<texts><text><ref idref="t1"/></text></texts>',
+                 'Element text content does not follow the DTD'),
+                ('<texts><text idtext="t1"><title/></text>'
+                 '<text idtext="t1"><title/></text></texts>',
+                 'ID t1 already defined'),
+                ('<texts><text idtext="t1"><title/><ref idref="t2"/></text>'
+                 '</texts>',
+                 'IDREF attribute references an unknown ID "t2"')]:
+            # Same result as validate_xml
+            try:
+                utils.validate_xml(etree.fromstring(xml_str), dtd_str)
+                assert 0
+            except etree.DocumentInvalid:
+                pass
+            try:
+                utils.validate_xml_file(
+                    StringIO.StringIO(header + xml_str), dtd_str)
+                assert 0
+            except etree.DocumentInvalid, e:
+                self.assertTrue(error in str(e), str(e))
+
+    def test_atomic_open(self):
+        filename = 'tests/test.txt'
+        self.assertFalse(os.path.isfile(filename))
+        try:
+            with utils.atomic_open(filename) as f:
+                f.write('content')
+                self.assertFalse(os.path.isfile(filename))
+            self.assertEqual(open(filename, 'r').read(), 'content')
+
+            try:
+                with utils.atomic_open(filename) as f:
+                    f.write('new content')
+                    raise Exception('Error')
+                assert 0
+            except Exception, e:
+                self.assertEqual(str(e), 'Error')
+            self.assertEqual(open(filename, 'r').read(), 'content')
+            self.assertFalse(os.path.isfile(f.name))
+
+            with utils.atomic_open(filename, fsync=True) as f:
+                f.write('synced content')
+            self.assertEqual(open(filename, 'r').read(), 'synced content')
+        finally:
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+    def test_atomic_open_permissions(self):
+        filename = 'tests/test.txt'
+        link = 'tests/test-link.txt'
+        self.assertFalse(os.path.isfile(filename))
+        try:
+            open(filename, 'w').write('content')
+            os.chmod(filename, 0600)
+            with utils.atomic_open(filename) as f:
+                f.write('new content')
+            self.assertEqual(open(filename, 'r').read(), 'new content')
+            self.assertEqual(stat.S_IMODE(os.stat(filename).st_mode), 0600)
+
+            if hasattr(os, 'symlink'):
+                os.symlink('test.txt', link)
+                with utils.atomic_open(link) as f:
+                    f.write('link content')
+                # The link is kept, the file is replaced
+                self.assertTrue(os.path.islink(link))
+                self.assertEqual(open(filename, 'r').read(), 'link content')
+                self.assertEqual(stat.S_IMODE(os.stat(filename).st_mode),
+                                 0600)
+        finally:
+            for name in [filename, link]:
+                if os.path.lexists(name):
+                    os.remove(name)
+
+    def test_file_lock(self):
+        filename = 'tests/test.txt'
+        events = []
+
+        def target(name):
+            with utils.file_lock(filename):
+                events.append(('start', name))
+                time.sleep(0.01)
+                events.append(('end', name))
+
+        try:
+            threads = [threading.Thread(target=target, args=(i,))
+                       for i in range(5)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(len(events), 10)
+            # The threads never hold the lock at the same time
+            for start, end in zip(events[::2], events[1::2]):
+                self.assertEqual(start[0], 'start')
+                self.assertEqual(end, ('end', start[1]))
+
+            # The lock is reentrant in the same thread
+            with utils.file_lock(filename):
+                with utils.file_lock(filename):
+                    pass
+
+            # The lock file is hidden next to the file
+            lock_filename = utils.get_lock_filename(filename)
+            self.assertEqual(lock_filename,
+                             os.path.abspath('tests/.test.txt.lock'))
+            self.assertTrue(os.path.isfile(lock_filename))
+            self.assertFalse(os.path.isfile(filename + '.lock'))
+        finally:
+            if os.path.isfile(utils.get_lock_filename(filename)):
+                os.remove(utils.get_lock_filename(filename))
+
+    def test_file_lock_symlink(self):
+        filename = 'tests/test.txt'
+        link = 'tests/test-link.txt'
+        os.symlink('test.txt', link)
+        try:
+            # Same lock as atomic_open: the one of the target
+            self.assertEqual(utils.get_lock_filename(link),
+                             utils.get_lock_filename(filename))
+            events = []
+
+            def target():
+                with utils.file_lock(filename):
+                    events.append('locked')
+
+            with utils.file_lock(link):
+                t = threading.Thread(target=target)
+                t.start()
+                t.join(0.1)
+                # Waiting for the lock of the link
+                self.assertEqual(events, [])
+            t.join()
+            self.assertEqual(events, ['locked'])
+        finally:
+            os.remove(link)
+            if os.path.isfile(utils.get_lock_filename(filename)):
+                os.remove(utils.get_lock_filename(filename))
+
+    def test_SingleFlight(self):
+        single_flight = utils.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def func(value):
+            calls.append(value)
+            started.set()
+            release.wait(10)
+            return value * 2
+
+        def target():
+            results.append(single_flight.call('key', func, 21))
+
+        threads = [threading.Thread(target=target) for i in range(5)]
+        threads[0].start()
+        started.wait(10)
+        for t in threads[1:]:
+            t.start()
+        # Let the other threads wait for the result
+        time.sleep(0.05)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(calls, [21])
+        self.assertEqual(results, [42] * 5)
+        self.assertEqual(single_flight.get_stats(),
+                         {'calls': 1, 'coalesced': 4, 'in_flight': 0})
+
+        # The call is done, the next one calls func again
+        self.assertEqual(single_flight.call('key', func, 1), 2)
+        self.assertEqual(calls, [21, 1])
+
+        def error():
+            raise Exception('My error')
+        try:
+            single_flight.call('key', error)
+            assert 0
+        except Exception, e:
+            self.assertEqual(str(e), 'My error')
+        self.assertEqual(single_flight._calls, {})
+
+    def test_run_async(self):
+        results = []
+        res = utils.run_async(lambda a, b=0: a + b, (1,), {'b': 2},
+                              callback=results.append)
+        self.assertEqual(res.get(10), 3)
+        self.assertEqual(results, [3])
+
+        old_executor = utils.get_executor()
+        pool = ThreadPool(1)
+        try:
+            utils.set_executor(pool)
+            self.assertEqual(utils.get_executor(), pool)
+            self.assertEqual(utils.run_async(len, ('abc',)).get(10), 3)
+        finally:
+            utils.set_executor(old_executor)
+            pool.close()
+
+    def test_LRUCache(self):
+        cache = utils.LRUCache(2)
+        self.assertEqual(cache.get('key1'), None)
+        cache.set('key1', 'value1')
+        cache.set('key2', 'value2')
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('key1'), 'value1')
+        # key2 is the least recently used
+        cache.set('key3', 'value3')
+        self.assertEqual(len(cache), 2)
+        self.assertTrue('key1' in cache)
+        self.assertFalse('key2' in cache)
+        self.assertEqual(cache.pop('key1'), 'value1')
+        self.assertEqual(cache.pop('key1', 'default'), 'default')
+        self.assertEqual(cache.size, 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+        cache = utils.LRUCache(10, len)
+        cache.set('key1', 'a' * 4)
+        cache.set('key2', 'b' * 4)
+        cache.set('key1', 'a' * 5)
+        self.assertEqual(cache.size, 9)
+        cache.set('key3', 'c' * 3)
+        self.assertEqual(cache.size, 8)
+        self.assertFalse('key2' in cache)
+        # Too big to be kept
+        cache.set('key4', 'd' * 11)
+        self.assertFalse('key4' in cache)
+        self.assertEqual(cache.size, 8)
+
     def test_to_int(self):
         result = utils.to_int('bob')
         self.assertEqual(result, None)
@@ -44,6 +394,14 @@ class TestUtils(TestCase):
         result = utils.to_int('10')
         self.assertEqual(result, 10)
 
+    def test_escape_html(self):
+        s = 'Nothing to escape'
+        self.assertTrue(utils.escape_html(s) is s)
+        self.assertEqual(utils.escape_html('<a href="#">\'&\'</a>'),
+                         '&lt;a href=&quot;#&quot;&gt;&#39;&amp;&#39;&lt;/a&gt;')
+        self.assertEqual(utils.escape_html(u'\xe9 & \xe8'), u'\xe9 &amp; \xe8')
+        self.assertEqual(utils.escape_html('&amp;'), '&amp;amp;')
+
     def test_truncate(self):
         s = 'This text should be truncated'
         self.assertEqual(utils.truncate(s, 11), 'This text...')
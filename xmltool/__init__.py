@@ -1,8 +1,14 @@
 from factory import (
     load,
     load_string,
+    load_async,
+    iter_subtrees,
+    map_subtrees,
     generate_form,
     generate_form_from_obj,
+    get_list_html,
     update,
+    update_async,
+    update_partial,
     new,
 )
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+"""Command line interface of xmltool.
+
+Usage::
+
+    xmltool stats --dtd-url exercise.dtd --sample exercise.xml
+    xmltool validate --jobs 4 directory/ file.xml
+    xmltool reformat directory/
+    xmltool render --limit 50 directory/
+    xmltool jstree --max-depth 2 directory/
+
+The commands on files take files and directories, the XML files of the
+directories are processed recursively by a pool of processes. The progress
+is written on stderr and the summary as JSON on stdout, the exit code is 1
+if a file failed.
+
+render and jstree write the result next to each XML file, with the .html or
+.json extension.
+"""
+
+import os
+import sys
+import time
+import fnmatch
+import argparse
+import itertools
+import multiprocessing
+from lxml import etree
+import simplejson as json
+import dtd_parser
+import factory
+import utils
+
+
+# The maximum number of DTDs whose classes are kept by each process
+SCHEMA_CACHE_SIZE = 100
+
+
+def stats(args):
+    """Get the statistics of a DTD (see
+    :func:`xmltool.dtd_parser.get_stats`).
+    """
+    sample = None
+    dtd_str = None
+    if args.sample:
+        tree = etree.parse(args.sample, utils.get_xml_parser())
+        sample = tree.getroot()
+        if not args.dtd_url:
+            dtd_str = utils.get_dtd_content(tree.docinfo.system_url,
+                                            os.path.dirname(args.sample),
+                                            tree.docinfo.public_id)
+    if dtd_str is None:
+        if not args.dtd_url:
+            raise Exception('No dtd url given')
+        dtd_str = utils.get_dtd_content(args.dtd_url)
+    return dtd_parser.get_stats(dtd_str=dtd_str, sample=sample)
+
+
+def _get_output_filename(filename, ext):
+    return os.path.splitext(filename)[0] + ext
+
+
+def _validate(filename, options):
+    factory.load(filename)
+
+
+def _reformat(filename, options):
+    obj = factory.load(filename, validate=options['validate'])
+    # Generate all the nodes instead of reusing the loaded ones
+    obj._set_modified()
+    for elt in obj.walk():
+        elt._set_modified()
+    obj.write(filename, validate=options['validate'])
+
+
+def _render(filename, options):
+    html = factory.generate_form(filename, validate=options['validate'],
+                                 limit=options['limit'])
+    if isinstance(html, unicode):
+        html = html.encode('utf-8')
+    with utils.atomic_open(_get_output_filename(filename, '.html')) as f:
+        f.write(html)
+
+
+def _jstree(filename, options):
+    obj = factory.load(filename, validate=options['validate'])
+    with utils.atomic_open(_get_output_filename(filename, '.json')) as f:
+        for s in obj.iter_jstree_json([], max_depth=options['max_depth']):
+            f.write(s)
+
+
+_file_commands = {
+    'validate': _validate,
+    'reformat': _reformat,
+    'render': _render,
+    'jstree': _jstree,
+}
+
+
+def _run_file(task):
+    """Run a command on a file, the errors are given in the result.
+    """
+    command, filename, options = task
+    start = time.time()
+    result = {'filename': filename, 'status': 'ok'}
+    try:
+        _file_commands[command](filename, options)
+    except Exception, e:
+        result['status'] = 'error'
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    result['seconds'] = round(time.time() - start, 3)
+    return result
+
+
+def _init_worker(catalogs):
+    for filename in catalogs:
+        utils.load_catalog(filename)
+    # The files of a process share the classes of their DTD
+    dtd_parser.set_cache(SCHEMA_CACHE_SIZE)
+
+
+def iter_filenames(paths, pattern='*.xml'):
+    """Get the files of paths, the directories are walked recursively to
+    find the files matching pattern.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(fnmatch.filter(filenames, pattern)):
+                yield os.path.join(dirpath, filename)
+
+
+def run_files(command, paths, options, jobs=1, catalogs=None,
+              progress=None):
+    """Run command on the XML files of paths.
+
+    :param command: validate, reformat, render or jstree
+    :type command: str
+    :param paths: the files and directories
+    :type paths: list
+    :param options: the options of the command
+    :type options: dict
+    :param jobs: the number of processes, the files are processed in the
+        current process if it's 1.
+    :type jobs: int
+    :param catalogs: the XML catalog files to load in the processes
+    :type catalogs: list
+    :param progress: file where the progress is written
+    :type progress: file
+    :return: the summary
+    :rtype: dict
+    """
+    filenames = list(iter_filenames(paths, options.get('pattern', '*.xml')))
+    tasks = [(command, filename, options) for filename in filenames]
+    start = time.time()
+    pool = None
+    old_cache = dtd_parser._cache
+    if jobs == 1:
+        dtd_parser.set_cache(SCHEMA_CACHE_SIZE)
+        results = itertools.imap(_run_file, tasks)
+    else:
+        pool = multiprocessing.Pool(jobs, _init_worker, (catalogs or [],))
+        chunksize = max(1, min(20, len(tasks) // (jobs * 4)))
+        results = pool.imap_unordered(_run_file, tasks, chunksize)
+
+    files = []
+    try:
+        for result in results:
+            files += [result]
+            if progress:
+                progress.write('[%d/%d] %s %s\n' % (
+                    len(files), len(tasks), result['status'],
+                    result['filename']))
+                progress.flush()
+    finally:
+        dtd_parser._cache = old_cache
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    files.sort(key=lambda result: result['filename'])
+    errors = len([r for r in files if r['status'] != 'ok'])
+    return {
+        'command': command,
+        'total': len(files),
+        'ok': len(files) - errors,
+        'errors': errors,
+        'seconds': round(time.time() - start, 3),
+        'files': files,
+    }
+
+
+def _run_file_command(args):
+    options = {
+        'pattern': args.pattern,
+        'validate': getattr(args, 'validate', True),
+        'limit': getattr(args, 'limit', None),
+        'max_depth': getattr(args, 'max_depth', None),
+    }
+    progress = None
+    if not args.quiet:
+        progress = sys.stderr
+    return run_files(args.command, args.paths, options, args.jobs,
+                     args.catalog, progress)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='xmltool')
+    parser.add_argument('--catalog', action='append', default=[],
+                        help='XML catalog file to resolve the DTD urls')
+    subparsers = parser.add_subparsers(dest='command')
+
+    sub = subparsers.add_parser(
+        'stats', help='Give statistics about a DTD to estimate its cost')
+    sub.add_argument('--dtd-url', help='the url or the filename of the DTD, '
+                     'by default the one of the sample')
+    sub.add_argument('--sample', help='a sample XML file to estimate the '
+                     'size of the HTML form')
+    sub.set_defaults(func=stats)
+
+    helps = {
+        'validate': 'Validate the XML files',
+        'reformat': 'Rewrite the XML files in the xmltool format',
+        'render': 'Write the HTML form of the XML files',
+        'jstree': 'Write the jstree JSON of the XML files',
+    }
+    for command in ['validate', 'reformat', 'render', 'jstree']:
+        sub = subparsers.add_parser(command, help=helps[command])
+        sub.add_argument('paths', nargs='+',
+                         help='the XML files and directories')
+        sub.add_argument('--jobs', '-j', type=int,
+                         default=multiprocessing.cpu_count(),
+                         help='the number of processes')
+        sub.add_argument('--pattern', default='*.xml',
+                         help='the pattern of the files of the directories')
+        sub.add_argument('--quiet', '-q', action='store_true',
+                         help="don't write the progress on stderr")
+        if command != 'validate':
+            sub.add_argument('--no-validate', dest='validate',
+                             action='store_false',
+                             help="don't validate the XML files")
+        if command == 'render':
+            sub.add_argument('--limit', type=int,
+                             help='the maximum number of items rendered '
+                             'for each list')
+        if command == 'jstree':
+            sub.add_argument('--max-depth', type=int,
+                             help='the number of levels to render')
+        sub.set_defaults(func=_run_file_command)
+    return parser
+
+
+def main(argv=None, stdout=None):
+    """Run the command given in argv and write its result as JSON.
+
+    :return: the exit code, 1 if some files failed
+    :rtype: int
+    """
+    stdout = stdout or sys.stdout
+    args = get_parser().parse_args(argv)
+    for filename in args.catalog:
+        utils.load_catalog(filename)
+    result = args.func(args)
+    json.dump(result, stdout, indent=2, sort_keys=True)
+    stdout.write('\n')
+    if result.get('errors'):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+"""Compare two objects generated from the same dtd.
+
+The differences are given as the operations of
+:func:`xmltool.elements.apply_operations`, so a patch can be applied on a
+loaded object or serialized as JSON.
+"""
+
+import bisect
+import elements
+from elements import ListElement, TextElement
+
+
+def _get_key(obj, keys):
+    """Get the key used to match obj with the items of the other list.
+
+    :param keys: the key of the items by tagname. It's the name of an
+        attribute or a function which takes the object as parameter.
+    :type keys: dict
+    """
+    key = keys.get(obj._tagname)
+    if key is None:
+        return None
+    if callable(key):
+        return key(obj)
+    return (obj._attributes or {}).get(key)
+
+
+def _diff_extra(old, new, prefixes, operations):
+    name = ':'.join(prefixes)
+    if (old._comment or None) != (new._comment or None):
+        operations += [('set', '%s:_comment' % name, new._comment or '')]
+
+    old_attributes = old._attributes or {}
+    new_attributes = new._attributes or {}
+    for k, v in sorted(new_attributes.items()):
+        if old_attributes.get(k) != v:
+            operations += [('set', '%s:_attrs:%s' % (name, k), v)]
+    for k in sorted(old_attributes):
+        if k not in new_attributes:
+            operations += [('set', '%s:_attrs:%s' % (name, k), None)]
+
+    if (isinstance(new, TextElement) and
+            (old._value or '') != (new._value or '')):
+        operations += [('set', '%s:_value' % name, new._value)]
+
+
+def _match_items(old_items, new_items, keys):
+    """Match the items of the lists.
+
+    The items with a key are matched by key, the other ones by position.
+
+    :return: the old item matched by each new item, None if not matched.
+    :rtype: list
+    """
+    old_by_key = {}
+    for e in old_items:
+        k = _get_key(e, keys)
+        if k is not None:
+            old_by_key.setdefault((e._tagname, k), e)
+
+    used = set()
+    matched = []
+    for i, e in enumerate(new_items):
+        k = _get_key(e, keys)
+        o = None
+        if k is not None:
+            o = old_by_key.pop((e._tagname, k), None)
+        elif (i < len(old_items) and
+                old_items[i]._tagname == e._tagname and
+                _get_key(old_items[i], keys) is None):
+            o = old_items[i]
+        if o is not None:
+            used.add(id(o))
+        matched += [o]
+    return matched, used
+
+
+def _get_increasing(values):
+    """Get the indexes of one of the longest increasing subsequences of
+    values.
+
+    :rtype: set
+    """
+    tails = []
+    tail_indexes = []
+    previous = []
+    for i, v in enumerate(values):
+        k = bisect.bisect_left(tails, v)
+        if k == len(tails):
+            tails += [v]
+            tail_indexes += [i]
+        else:
+            tails[k] = v
+            tail_indexes[k] = i
+        previous += [tail_indexes[k - 1] if k else None]
+
+    indexes = set()
+    i = tail_indexes[-1] if tail_indexes else None
+    while i is not None:
+        indexes.add(i)
+        i = previous[i]
+    return indexes
+
+
+class _Positions(object):
+    """Count the used slots before a slot (a Fenwick tree), to get the
+    position of an item in a list while moving the items.
+    """
+
+    def __init__(self, size):
+        self._tree = [0] * (size + 1)
+
+    def add(self, slot, value):
+        slot += 1
+        while slot < len(self._tree):
+            self._tree[slot] += value
+            slot += slot & -slot
+
+    def index(self, slot):
+        total = 0
+        while slot > 0:
+            total += self._tree[slot]
+            slot -= slot & -slot
+        return total
+
+
+def _diff_list(old_items, new_items, prefixes, keys, operations):
+    matched, used = _match_items(old_items, new_items, keys)
+
+    # Delete from the end to keep the ids of the previous items
+    for j in reversed(range(len(old_items))):
+        e = old_items[j]
+        if id(e) not in used:
+            operations += [
+                ('delete', ':'.join(prefixes + [str(j), e._tagname]))]
+
+    current = [e for e in old_items if id(e) in used]
+    positions = dict((id(e), j) for j, e in enumerate(current))
+    # The matched items which are already in the right order don't move
+    news = [i for i, o in enumerate(matched) if o is not None]
+    kept = set(news[k] for k in _get_increasing(
+        [positions[id(matched[i])] for i in news]))
+
+    # The other items are put just after the previous item of new_items: we
+    # give them a slot after the last kept item before them. The slots of
+    # the items are in the order of the list during the whole update.
+    anchors = {}
+    counts = {}
+    anchor = -1
+    for i in range(len(new_items)):
+        if i in kept:
+            anchor = positions[id(matched[i])]
+            continue
+        anchors[i] = (anchor, counts.get(anchor, 0))
+        counts[anchor] = counts.get(anchor, 0) + 1
+    starts = {-1: 0}
+    slot = counts.get(-1, 0)
+    current_slots = []
+    for j in range(len(current)):
+        current_slots += [slot]
+        starts[j] = slot + 1
+        slot += 1 + counts.get(j, 0)
+
+    used_slots = _Positions(slot)
+    for slot in current_slots:
+        used_slots.add(slot, 1)
+    for i, e in enumerate(new_items):
+        if i in kept:
+            continue
+        anchor, k = anchors[i]
+        slot = starts[anchor] + k
+        o = matched[i]
+        if o is None:
+            index = used_slots.index(slot)
+            operations += [
+                ('add', ':'.join(prefixes + [str(index), e._tagname]))]
+        else:
+            old_slot = current_slots[positions[id(o)]]
+            j = used_slots.index(old_slot)
+            used_slots.add(old_slot, -1)
+            operations += [('move', ':'.join(prefixes + [str(j), o._tagname]),
+                            used_slots.index(slot))]
+        used_slots.add(slot, 1)
+
+    # The content is updated when the items are at their final position
+    for i, e in enumerate(new_items):
+        o = matched[i]
+        if o is None:
+            o = e.__class__()
+        _diff(o, e, prefixes + [str(i), e._tagname], keys, operations)
+
+
+def _diff(old, new, prefixes, keys, operations):
+    _diff_extra(old, new, prefixes, operations)
+    for elt in new._sub_elements or []:
+        v1 = elt._get_value_from_parent(old)
+        v2 = elt._get_value_from_parent(new)
+        if issubclass(elt, ListElement):
+            _diff_list(v1 or [], v2 or [], prefixes + [elt._tagname], keys,
+                       operations)
+            continue
+
+        if v1 and v2 and v1._tagname == v2._tagname:
+            _diff(v1, v2, prefixes + [v2._tagname], keys, operations)
+            continue
+        if v1:
+            operations += [('delete', ':'.join(prefixes + [v1._tagname]))]
+        if v2:
+            operations += [('add', ':'.join(prefixes + [v2._tagname]))]
+            _diff(v2.__class__(), v2, prefixes + [v2._tagname], keys,
+                  operations)
+
+
+def diff(old, new, keys=None):
+    """Get the operations to transform old into new.
+
+    The items of the lists are matched by position, or by key if one is
+    given for their tagname.
+
+    :param old: the original object
+    :type old: :class:`xmltool.elements.Element`
+    :param new: the updated object
+    :type new: :class:`xmltool.elements.Element`
+    :param keys: the key of the list items by tagname: the name of an
+        attribute or a function which takes the item as parameter.
+    :type keys: dict
+    :return: the operations, see :func:`xmltool.elements.apply_operations`
+    :rtype: list of tuple
+    """
+    if old._tagname != new._tagname:
+        raise Exception('Can\'t compare %s with %s' % (old._tagname,
+                                                     new._tagname))
+    operations = []
+    _diff(old, new, [new._tagname], keys or {}, operations)
+    return operations
+
+
+def patch(obj, operations):
+    """Apply the operations generated by :func:`diff` on obj.
+
+    :param obj: the object to update
+    :type obj: :class:`xmltool.elements.Element`
+    :param operations: the operations to apply
+    :type operations: list
+    :return: the updated object
+    :rtype: :class:`xmltool.elements.Element`
+    """
+    elements.apply_operations(obj, operations)
+    return obj
@@ -1,5 +1,6 @@
 import re
 import utils
+import metrics
 from elements import (
     Element,
     TextElement,
@@ -13,6 +14,10 @@ tag_regex_compile = re.compile(r'<!(?P<type>[A-Z]+)(.*?)>', re.DOTALL)
 element_regex_compile = re.compile(r' *(?P<name>[^( ]+) *\((?P<elements>.+)\)')
 empty_element_regex_compile = re.compile(r' *(?P<name>[^( ]+) *(?P<elements>.+)')
 entity_regex_compile = re.compile(r' *(?P<name>% *[^" ]+?) *"(?P<elements>.+)"')
+attribute_regex_compile = re.compile(
+    r'\s*(?P<name>[^\s]+)\s+'
+    r'(?P<type>\([^)]*\)|NOTATION\s*\([^)]*\)|[A-Z]+)\s+'
+    r'(?P<default>#REQUIRED|#IMPLIED|(?:#FIXED\s+)?(?:"[^"]*"|\'[^\']*\'))')
 
 
 def cleanup(value):
@@ -46,19 +51,66 @@ def split_list(lis, cols):
 
 
 def parse_attribute(value):
+    """Parse the content of an ATTLIST.
+
+    :return: the tagname and the list of (name, type, default) of its
+        attributes. The enumerations are given as type like '(a|b)', the
+        default is #REQUIRED, #IMPLIED, a quoted value or #FIXED and a quoted
+        value.
+    :rtype: tuple
+    """
     for c in ['\n', '\r']:
-        value = value.replace(c, '')
-    lis = value.split(' ')
-    lis = filter(bool, lis)
-    assert (len(lis) - 1) % 3 == 0
-    name = lis[0].strip()
+        value = value.replace(c, ' ')
+    lis = value.strip().split(None, 1)
+    name = lis[0]
     attributes = []
-    for (attr_name, attr_type, require) in split_list(lis[1:], 3):
-        attributes += [(attr_name.strip(), attr_type.strip(), require.strip())]
+    rest = lis[1] if len(lis) > 1 else ''
+    pos = 0
+    while rest[pos:].strip():
+        matchobj = attribute_regex_compile.match(rest, pos)
+        if not matchobj:
+            raise Exception, 'Error parsing attribute %s' % value
+        attr_type = re.sub(r'\s+', '', matchobj.group('type'))
+        default = matchobj.group('default')
+        if default.startswith('#FIXED'):
+            default = '#FIXED %s' % default[len('#FIXED'):].strip()
+        attributes += [(matchobj.group('name'), attr_type, default)]
+        pos = matchobj.end()
     return name, attributes
 
 
-def dtd_to_dict_v2(dtd):
+def _get_attribute_info(attributes):
+    """Get the types, the allowed values, the default values and the
+    required names of the attributes given by parse_attribute.
+    """
+    types = {}
+    values = {}
+    defaults = {}
+    required = []
+    for name, attr_type, default in attributes:
+        if attr_type.startswith('('):
+            types[name] = 'ENUMERATION'
+            values[name] = frozenset(attr_type[1:-1].split('|'))
+        elif attr_type.startswith('NOTATION'):
+            types[name] = 'NOTATION'
+            values[name] = frozenset(attr_type[len('NOTATION('):-1].split('|'))
+        else:
+            types[name] = attr_type
+
+        if default == '#REQUIRED':
+            required += [name]
+        elif default.startswith('#FIXED'):
+            defaults[name] = default[len('#FIXED '):][1:-1]
+            values[name] = frozenset([defaults[name]])
+        elif default != '#IMPLIED':
+            defaults[name] = default[1:-1]
+    return types, values, defaults, frozenset(required)
+
+
+def _get_dtd_tags(dtd):
+    """Get the entities, the attributes and the elements defined in dtd, the
+    entities are not expanded.
+    """
     dtd_entities = {}
     dtd_attributes = {}
     dtd_elements = {}
@@ -78,7 +130,11 @@ def dtd_to_dict_v2(dtd):
             dtd_attributes.setdefault(tagname, []).extend(attributes)
         else:
             raise Exception, '%s is not supported' % element
+    return dtd_entities, dtd_attributes, dtd_elements
 
+
+def dtd_to_dict_v2(dtd):
+    dtd_entities, dtd_attributes, dtd_elements = _get_dtd_tags(dtd)
     dic = {}
     for tagname, elements in dtd_elements.items():
         for key, value in dtd_entities.items():
@@ -128,27 +184,29 @@ def _create_new_class(class_dict, name, required, islist, conditionals):
     if conditionals:
         assert not base_cls
         assert name
+        sub_classes = []
+        for (subname, subrequired, subislist, subconditionals) in conditionals:
+            assert not subconditionals, subconditionals
+            assert not subislist
+            sub_cls = _create_new_class(class_dict, subname, subrequired,
+                                        subislist, subconditionals)
+            sub_cls._is_choice = not islist
+            sub_classes += [sub_cls]
+
         if not islist:
             parent_cls = type('%sChoice' % name, (ChoiceElement,), {
-                '_elts': [],
+                '_elts': tuple(sub_classes),
                 '_tagname': 'choice__%s' % name,
                 '_required': required
             })
         else:
             parent_cls = type('%sList' % name, (ListElement, ), {
-                '_elts': [],
+                '_elts': tuple(sub_classes),
                 '_tagname': 'list__%s' % name,
                 '_required': required,
             })
-
-        for (subname, subrequired, subislist, subconditionals) in conditionals:
-            assert not subconditionals, subconditionals
-            assert not subislist
-            sub_cls = _create_new_class(class_dict, subname, subrequired,
-                                        subislist, subconditionals)
+        for sub_cls in sub_classes:
             sub_cls._parent = parent_cls
-            sub_cls._is_choice = not islist
-            parent_cls._elts += [sub_cls]
         return parent_cls
 
     if not islist:
@@ -159,7 +217,7 @@ def _create_new_class(class_dict, name, required, islist, conditionals):
     newcls = type(cls.__name__, (cls, ), {'_required': required})
 
     listcls = type('%sList' % cls.__name__, (ListElement, ), {
-        '_elts': [newcls],
+        '_elts': (newcls,),
         '_required': required,
         '_tagname': 'list__%s' % name
     })
@@ -167,47 +225,83 @@ def _create_new_class(class_dict, name, required, islist, conditionals):
     return listcls
 
 
+def _get_class_info(elts):
+    """Get the information to create the class of a dtd element.
+
+    :param elts: the sub elements as defined in the dtd
+    :type elts: str
+    :return: the base class, if the element is EMPTY and the sub elements
+        to create.
+    :rtype: tuple
+    """
+    if elts in ['#PCDATA', 'EMPTY']:
+        return TextElement, elts == 'EMPTY', elts
+
+    lis = _parse_elts(elts)
+    if (lis[0][3] and
+          lis[0][3][0][0] in ['#PCDATA', 'EMPTY']):
+        # Special case with mixed content
+        is_empty = (lis[0][3][0][0] == 'EMPTY')
+        # TODO: find a better way to handle the mixed content
+        #
+        # Make some replacements to have the same dtd than for the children
+        # like this 'sub1, sub2'. Not sure we can have list of elements in,
+        # but it is sure it is not supported!
+        elts = elts.replace('#PCDATA|', '')
+        elts = elts.replace('EMPTY|', '')
+        elts = elts.replace('|', '?,')
+        elts = elts[1:-2] + '?' # Remove the '*' at the end
+        return TextElement, is_empty, elts
+
+    return Element, False, elts
+
+
 def _create_class_dict(dtd_dict):
     class_dict = {}
     for tagname, dic in dtd_dict.items():
-        is_empty = False
-        lis = _parse_elts(dic['elts'])
-        if dic['elts'] in ['#PCDATA', 'EMPTY']:
-            c = TextElement
-            if dic['elts'] == 'EMPTY':
-                is_empty = True
-        elif (lis[0][3] and
-              lis[0][3][0][0] in ['#PCDATA', 'EMPTY']):
-            # Special case with mixed content
-            c = TextElement
-            if lis[0][3][0][0] == 'EMPTY':
-                is_empty = True
-            # TODO: find a better way to handle the mixed content
-            # 
-            # Make some replacements to have the same dtd than for the children
-            # like this 'sub1, sub2'. Not sure we can have list of elements in,
-            # but it is sure it is not supported!
-            dic['elts'] = dic['elts'].replace('#PCDATA|', '')
-            dic['elts'] = dic['elts'].replace('EMPTY|', '')
-            dic['elts'] = dic['elts'].replace('|', '?,')
-            dic['elts'] = dic['elts'][1:-2] + '?' # Remove the '*' at the end
-        else:
-            c = Element
+        c, is_empty, elts = _get_class_info(dic['elts'])
+        types, values, defaults, required = _get_attribute_info(dic['attrs'])
         cls = type(tagname, (c,), {
             '_tagname': tagname,
-            '_attribute_names': [tple[0] for tple in dic['attrs']],
-            '_sub_elements': [],
+            '_attribute_names': tuple([tple[0] for tple in dic['attrs']]),
+            '_attribute_types': types,
+            '_attribute_values': values,
+            '_attribute_defaults': defaults,
+            '_required_attributes': required,
+            '_sub_elements': (),
             '_is_empty': is_empty,
         })
         class_dict[tagname] = cls
     return class_dict
 
 
+def _freeze_classes(classes):
+    """Freeze the given classes and their sub classes.
+    """
+    lis = list(classes)
+    while lis:
+        cls = lis.pop()
+        if cls.__dict__.get('_frozen'):
+            continue
+        # The attribute names are checked often, the tuple keeps their order
+        cls._attribute_name_set = frozenset(cls._attribute_names or ())
+        cls._frozen = True
+        lis += list(cls._sub_elements or [])
+        lis += list(getattr(cls, '_elts', None) or [])
+
+
 def _create_classes(dtd_dict):
+    """Create the classes corresponding to dtd_dict.
+
+    ..note:: The classes are frozen once created, so they can be shared
+    between threads.
+    """
     class_dict = _create_class_dict(dtd_dict)
     for tagname, dic in dtd_dict.items():
         cls = class_dict[tagname]
-        lis  = _parse_elts(dic['elts'])
+        c, is_empty, elts = _get_class_info(dic['elts'])
+        lis  = _parse_elts(elts)
+        sub_elements = []
         for (name, required, islist, conditionals) in lis:
             if name in ['#PCDATA', 'EMPTY']:
                 # Text with no sub elements
@@ -215,13 +309,174 @@ def _create_classes(dtd_dict):
             sub_cls = _create_new_class(
                 class_dict, name, required, islist, conditionals)
             sub_cls._parent = cls
-            cls._sub_elements += [sub_cls]
+            sub_elements += [sub_cls]
+        cls._sub_elements = tuple(sub_elements)
 
+    _freeze_classes(class_dict.values())
     return class_dict
 
 
+_parses = utils.SingleFlight()
+_cache = None
+
+
+def set_cache(maxsize):
+    """Enable the cache of the classes generated by parse.
+
+    The classes are keyed by the content of the DTD, so the documents using
+    the same DTD share their classes (and the HTML fragments, see
+    :func:`xmltool.elements.set_html_cache`). The DTD of an url is still
+    fetched by each call.
+
+    :param maxsize: the maximum number of cached DTDs, None to disable the
+        cache.
+    :type maxsize: int
+    """
+    global _cache
+    _cache = None
+    if maxsize:
+        _cache = utils.LRUCache(maxsize)
+
+
+def _parse(dtd_str=None, dtd_url=None):
+    if dtd_url:
+        dtd_str = utils.get_dtd_content(dtd_url)
+
+    cache = _cache
+    if cache is not None:
+        dic = cache.get(dtd_str)
+        if dic is not None:
+            return dict(dic)
+
+    with metrics.phase('dtd_parse', bytes=len(dtd_str)):
+        dtd_dict = dtd_to_dict_v2(dtd_str)
+    with metrics.phase('class_generation') as phase:
+        dic = _create_classes(dtd_dict)
+        phase.set(classes=len(dic))
+    if cache is not None:
+        cache.set(dtd_str, dic)
+        return dict(dic)
+    return dic
+
+
 def parse(dtd_str=None, dtd_url=None):
-    # TODO: try to put a cache on this function
+    if not dtd_str and not dtd_url:
+        raise ValueError, 'You didn\'t provide dtd_str nor dtd_url'
+
+    if dtd_str and dtd_url:
+        raise ValueError, 'You should provide either dtd_str or dtd_url'
+
+    # The concurrent parsings of the same DTD wait for the first one and get
+    # the same classes.
+    if dtd_url:
+        key = ('url', dtd_url)
+    else:
+        key = ('str', dtd_str)
+    return _parses.call(key, _parse, dtd_str, dtd_url)
+
+
+def get_parse_stats():
+    """Get the number of DTD parsings and of the parsings which waited for
+    a concurrent one of the same DTD.
+
+    :return: the counters calls, coalesced and in_flight
+    :rtype: dict
+    """
+    return _parses.get_stats()
+
+
+def parse_async(dtd_str=None, dtd_url=None, callback=None):
+    """Same as :func:`parse` but the DTD is fetched and parsed in the
+    executor (see :func:`xmltool.utils.run_async`).
+
+    :return: the result, use its get method to wait for the classes.
+    :rtype: multiprocessing.pool.AsyncResult
+    """
+    return utils.run_async(parse, (dtd_str, dtd_url), callback=callback)
+
+
+def _get_all_classes(classes):
+    """Get the given classes and all their sub classes.
+    """
+    all_classes = set()
+    lis = list(classes)
+    while lis:
+        cls = lis.pop()
+        if cls in all_classes:
+            continue
+        all_classes.add(cls)
+        lis += list(cls._sub_elements or [])
+        lis += list(getattr(cls, '_elts', None) or [])
+    return all_classes
+
+
+def _get_children_tagnames(cls):
+    """Get the tagnames of the XML children of the elements of cls, the list
+    and choice classes are not XML elements.
+    """
+    tagnames = set()
+    lis = list(cls._sub_elements or [])
+    while lis:
+        sub_cls = lis.pop()
+        if issubclass(sub_cls, (ListElement, ChoiceElement)):
+            lis += list(sub_cls._elts)
+        else:
+            tagnames.add(sub_cls._tagname)
+    return tagnames
+
+
+def _get_depths(children):
+    """Get the depth of each tagname and the recursive tagnames.
+
+    :param children: the tagnames of the children by tagname
+    :type children: dict
+    """
+    depths = {}
+    recursive = set()
+
+    def get_depth(tagname, path):
+        if tagname in path:
+            recursive.update(path[path.index(tagname):])
+            return 0
+        if tagname not in depths:
+            path = path + [tagname]
+            depths[tagname] = 1 + max(
+                [get_depth(t, path) for t in children[tagname]] or [0])
+        return depths[tagname]
+
+    for tagname in sorted(children):
+        get_depth(tagname, [])
+    return depths, recursive
+
+
+def get_stats(dtd_str=None, dtd_url=None, sample=None):
+    """Get some statistics about a DTD and the classes generated for it to
+    estimate the cost of its use.
+
+    :param dtd_str: the content of the DTD
+    :type dtd_str: str
+    :param dtd_url: the url of the DTD
+    :type dtd_url: str
+    :param sample: the root of a sample XML document, the size of its
+        HTML form is given.
+    :type sample: etree.Element
+    :return: the statistics:
+
+        * elements, attributes, entities: the numbers defined in the DTD
+        * entity_expansion: the size ratio of the elements definitions
+          after and before the expansion of the entities
+        * classes, lists, choices: the numbers of generated classes
+        * max_children: the maximum number of sub elements of an element
+        * max_list_fanout, max_choice_fanout: the maximum number of
+          possible elements in a list or a choice
+        * roots: the elements which are not a sub element
+        * max_depth: the maximum depth of the elements from the roots, the
+          recursive elements are only counted once.
+        * recursive: the elements which can contain themselves
+        * sample_nodes, form_bytes, form_bytes_per_node: the number of
+          nodes of the sample and the size of its HTML form.
+    :rtype: dict
+    """
     if not dtd_str and not dtd_url:
         raise ValueError, 'You didn\'t provide dtd_str nor dtd_url'
 
@@ -231,6 +486,46 @@ def parse(dtd_str=None, dtd_url=None):
     if dtd_url:
         dtd_str = utils.get_dtd_content(dtd_url)
 
+    dtd_entities, dtd_attributes, dtd_elements = _get_dtd_tags(dtd_str)
     dtd_dict = dtd_to_dict_v2(dtd_str)
-    return _create_classes(dtd_dict)
-
+    class_dict = _create_classes(dtd_dict)
+    all_classes = _get_all_classes(class_dict.values())
+    lists = [c for c in all_classes if issubclass(c, ListElement)]
+    choices = [c for c in all_classes if issubclass(c, ChoiceElement)]
+    raw_size = sum(map(len, dtd_elements.values()))
+    expanded_size = sum(len(dic['elts']) for dic in dtd_dict.values())
+
+    children = dict((tagname, _get_children_tagnames(cls))
+                    for tagname, cls in class_dict.items())
+    sub_tagnames = set()
+    for tagnames in children.values():
+        sub_tagnames.update(tagnames)
+    depths, recursive = _get_depths(children)
+
+    stats = {
+        'elements': len(dtd_elements),
+        'attributes': sum(map(len, dtd_attributes.values())),
+        'entities': len(dtd_entities),
+        'entity_expansion': round(float(expanded_size) / (raw_size or 1), 2),
+        'classes': len(all_classes),
+        'lists': len(lists),
+        'choices': len(choices),
+        'max_children': max([len(c._sub_elements or [])
+                             for c in class_dict.values()] or [0]),
+        'max_list_fanout': max([len(c._elts) for c in lists] or [0]),
+        'max_choice_fanout': max([len(c._elts) for c in choices] or [0]),
+        'roots': sorted(set(class_dict) - sub_tagnames),
+        'max_depth': max(depths.values() or [0]),
+        'recursive': sorted(recursive),
+    }
+
+    if sample is not None:
+        obj = class_dict[sample.tag]()
+        # We load a copy, the sample of the caller is not changed
+        obj.load_from_xml(sample)
+        nodes = len(list(sample.iter()))
+        form_bytes = len(obj.to_html())
+        stats['sample_nodes'] = nodes
+        stats['form_bytes'] = form_bytes
+        stats['form_bytes_per_node'] = form_bytes // nodes
+    return stats
@@ -1,19 +1,189 @@
 #!/usr/bin/env python
 
 import os
+import copy
+import hashlib
+import itertools
+import StringIO
 from lxml import etree
 import simplejson as json
 import dtd_parser
 import utils
+import metrics
 
 DEFAULT_ENCODING = 'UTF-8'
 
+# The private attributes which are part of the XML content. Changing them
+# means we can't reuse the lxml node we have kept.
+XML_ATTRIBUTES = ('_value', '_comment', '_attributes')
+# The private attributes which change the HTML but not the XML, they are
+# part of the hash.
+HTML_ATTRIBUTES = ('_exists',)
+
+_marker = object()
+
+# The cache of the HTML fragments, disabled by default (see set_html_cache)
+_html_cache = None
+
+
+def set_html_cache(maxsize):
+    """Enable the cache of the HTML fragments generated by to_html.
+
+    The fragments are keyed by the class, the prefixes, the rendering
+    parameters and the hash of the object, so re-rendering a mostly
+    unchanged document reuses the fragments of the unchanged parts.
+
+    ..note:: The fragments are shared between the objects using the same
+    classes, i.e. generated by the same call to dtd_parser.parse.
+
+    :param maxsize: the maximum length of the cached HTML, None to disable
+        the cache.
+    :type maxsize: int
+    """
+    global _html_cache
+    _html_cache = None
+    if maxsize:
+        _html_cache = utils.LRUCache(maxsize, len)
+
+
+# The documents loaded by xmltool.factory.load, disabled by default (see
+# set_document_cache)
+_document_cache = None
+
+
+def set_document_cache(maxsize):
+    """Enable the cache of the documents loaded by
+    :func:`xmltool.factory.load`.
+
+    The documents are keyed by the path of the file and they are reloaded
+    when its modification time, size or inode changes. A document is never
+    given to the callers: load returns a clone of it (see
+    :meth:`Element.clone`), so the loads of an unchanged file only cost the
+    parts which are changed. Writing a file with :meth:`Element.write`
+    drops its document.
+
+    :param maxsize: the maximum size of the cached XML files in bytes, None
+        to disable the cache. The loaded objects take much more memory than
+        their file.
+    :type maxsize: int
+    """
+    global _document_cache
+    _document_cache = None
+    if maxsize:
+        _document_cache = utils.LRUCache(maxsize, lambda entry: entry[-1])
+
+
+def _invalidate_document(filename):
+    cache = _document_cache
+    if cache is not None and isinstance(filename, basestring):
+        cache.pop(os.path.abspath(filename))
+
+
+def _get_children_comments(xml):
+    """Get the children of xml with their comments.
+
+    :param xml: the lxml node
+    :return: list of tuples (child, comments) where comments is the list of
+        the comments just before child. The comments at the end of xml are
+        added to the last child.
+
+    ..note:: it's the same result as _load_comment_from_xml on each child
+    but we only loop once on the children.
+    """
+    lis = []
+    comments = []
+    for child in xml:
+        if isinstance(child, etree._Comment):
+            comments += [child.text]
+            continue
+        lis += [(child, comments)]
+        comments = []
+    if lis and comments:
+        lis[-1][1].extend(comments)
+    return lis
+
+
+def _get_comments(xml):
+    """Get the texts of the comments around xml: the ones just before it and
+    the ones after it if it's the last tag of its parent.
+    """
+    previous = xml
+    comments = []
+    while True:
+        previous = previous.getprevious()
+        if previous is None:
+            break
+        if not isinstance(previous, etree._Comment):
+            break
+        comments += [previous.text]
+
+    comments.reverse()
+    end_comments = []
+    nextelt = xml
+    # Only get the comment after the tag if we don't have any other tag
+    while True:
+        nextelt = nextelt.getnext()
+        if nextelt is None:
+            break
+        if not isinstance(nextelt, etree._Comment):
+            end_comments = []
+            break
+        end_comments += [nextelt.text]
+    return comments + end_comments
+
+
+def _is_indented(xml, level):
+    """Check the kept node xml is indented for level like the generated
+    nodes.
+    """
+    return not len(xml) or xml.text == '\n' + '  ' * (level + 1)
+
+
+def _write_node(xf, xml):
+    """Write the lxml node xml in the incremental writer xf without its tail
+
+    ..note:: xml is not changed, it can be shared between the clones written
+    by several threads.
+    """
+    # The tail is the indentation in the parent, we write our own.
+    xf.write(xml, with_tail=False)
+
+
+class ElementType(type):
+    """The metaclass of the elements.
+
+    The classes generated from a dtd are frozen, we can't update them. It
+    makes sure they can be shared between threads.
+    """
+
+    def __setattr__(cls, name, value):
+        if cls.__dict__.get('_frozen'):
+            raise AttributeError("Can't set %s on the frozen class %s" % (
+                name, cls.__name__))
+        super(ElementType, cls).__setattr__(name, value)
+
+    def __delattr__(cls, name):
+        if cls.__dict__.get('_frozen'):
+            raise AttributeError("Can't delete %s on the frozen class %s" % (
+                name, cls.__name__))
+        super(ElementType, cls).__delattr__(name)
+
 
 class Element(object):
     """After reading a dtd file we construct some Element
     """
+    __metaclass__ = ElementType
     _tagname = None
     _attribute_names = None
+    # The frozenset of _attribute_names, set when the class is frozen
+    _attribute_name_set = None
+    # The attributes defined in the dtd: the type by name, the allowed
+    # values of the enumerations and of the #FIXED attributes, the default
+    # values and the #REQUIRED names.
+    _attribute_types = None
+    _attribute_values = None
+    _attribute_defaults = None
+    _required_attributes = frozenset()
     _attributes = None
     _sub_elements = None
     _required = False
@@ -22,12 +192,162 @@ class Element(object):
     _comment = None
     _is_choice = False
     _is_empty = False
+    # The lxml node this object has been loaded from. We write it and copy it
+    # in to_xml while the object is not modified.
+    _xml_node = None
+    _modified = False
+    # The hash of the content of this object, see _get_hash
+    _hash = None
 
     # The following attributes should be used for the root element.
     _xml_filename = None
     _xml_dtd_url = None
     _xml_encoding = None
 
+    # The object this one has been cloned from (see clone) and the names of
+    # its sub elements deleted in this object.
+    _clone_source = None
+    _clone_deleted = frozenset()
+
+
+    def __setattr__(self, name, value):
+        super(Element, self).__setattr__(name, value)
+        if not name.startswith('_') or name in XML_ATTRIBUTES:
+            self._set_modified()
+        elif name in HTML_ATTRIBUTES:
+            self._reset_hash()
+
+    def __delattr__(self, name):
+        if self._clone_source is not None and not name.startswith('_'):
+            # Get the sub element of the source to know if it exists and
+            # don't get it again once deleted.
+            getattr(self, name)
+            object.__setattr__(self, '_clone_deleted',
+                               self._clone_deleted | frozenset([name]))
+        super(Element, self).__delattr__(name)
+        if not name.startswith('_') or name in XML_ATTRIBUTES:
+            self._set_modified()
+
+    def __getattr__(self, name):
+        # Only called when name is not found, the sub elements of a clone
+        # are copied from its source the first time they are accessed.
+        source = self._clone_source
+        if (source is None or name.startswith('_') or
+                name in self._clone_deleted):
+            raise AttributeError(name)
+        value = getattr(source, name)
+        if isinstance(value, Element):
+            value = value._clone(self)
+        object.__setattr__(self, name, value)
+        return value
+
+    def _clone(self, parent):
+        cls = self.__class__
+        obj = cls.__new__(cls)
+        for k, v in self.__dict__.iteritems():
+            # The sub elements are copied when needed and we keep the dict
+            # small without the values of the class.
+            if k.startswith('_') and v is not getattr(cls, k, _marker):
+                object.__setattr__(obj, k, v)
+        object.__setattr__(obj, '_parent', parent)
+        object.__setattr__(obj, '_clone_source', self)
+        return obj
+
+    def clone(self):
+        """Get a copy of this object, it's cheap: the copy shares the
+        content of this object.
+
+        The sub elements are copied the first time they are accessed on the
+        copy, by add or by getting them, and the kept lxml nodes are reused
+        while they are not modified. So a copy only costs the memory of the
+        parts which are changed. Changing the copy never changes this
+        object.
+
+        ..note:: This object should not be changed while its copies are
+        used, they would see the changes of the parts they didn't copy yet.
+
+        :return: the copy
+        :rtype: :class:`Element`
+        """
+        return self._clone(None)
+
+    def _set_modified(self):
+        """Mark this object and its parents as modified.
+
+        ..note:: When an object is modified all its parents are also marked
+        as modified and their hash is reset, so we can stop as soon as we
+        find a modified one without hash.
+        """
+        if self._modified and self._hash is None:
+            return
+        object.__setattr__(self, '_modified', True)
+        object.__setattr__(self, '_hash', None)
+        if isinstance(self._parent, Element):
+            self._parent._set_modified()
+
+    def _reset_hash(self):
+        """Reset the hash of this object and its parents without marking
+        them as modified.
+        """
+        obj = self
+        while isinstance(obj, Element):
+            object.__setattr__(obj, '_hash', None)
+            obj = obj._parent
+
+    def _get_hash(self):
+        """Get the hash of the content of this object and its sub elements.
+
+        It's made of the tag, the attributes, the value, the comment and the
+        HTML_ATTRIBUTES of this object and of the hashes of its sub elements, which are kept
+        until they are modified. So the hash of a modified object only
+        computes again the hashes of the modified parts.
+        """
+        if self._hash is not None:
+            return self._hash
+        h = hashlib.sha1(repr((self._tagname, getattr(self, '_value', None),
+                               sorted((self._attributes or {}).items()),
+                               self._comment,
+                               [getattr(self, name, None)
+                                for name in HTML_ATTRIBUTES])))
+        for elt in self._sub_elements or []:
+            v = elt._get_value_from_parent(self)
+            if isinstance(v, ListElement):
+                h.update('[')
+                for e in v:
+                    h.update('%s:%s;' % (e._tagname, e._get_hash()))
+                h.update(']')
+            elif v:
+                h.update('%s:%s;' % (v._tagname, v._get_hash()))
+            else:
+                h.update(';')
+        object.__setattr__(self, '_hash', h.hexdigest())
+        return self._hash
+
+    def _set_xml_node(self, xml):
+        """Keep xml as the lxml node which represents this object
+        """
+        if self._xml_node is not None and isinstance(self._parent, Element):
+            # The node of the parent still contains the old node
+            self._parent._set_modified()
+        self._xml_node = xml
+        self._modified = False
+
+    def _get_xml_node(self):
+        """Get the lxml node of this object to put in the node of its parent.
+
+        The kept node is copied if the object has not been modified,
+        otherwise it's generated by to_xml.
+
+        ..note:: The kept node is never moved: it can be in a tree given to
+        the caller or shared with a clone.
+        """
+        if self._xml_node is not None and not self._modified:
+            xml = copy.deepcopy(self._xml_node)
+            # The tail is the indentation of the old parent, we let lxml
+            # handle it.
+            xml.tail = None
+            return xml
+        return self.to_xml()
 
     @classmethod
     def _get_allowed_tagnames(cls):
@@ -51,6 +371,19 @@ class Element(object):
             v = cls()
         return v
 
+    def _is_complete(self):
+        """Check that all the required sub elements are defined.
+
+        ..note:: to_xml adds the missing ones, so we can't reuse the loaded
+        node of an incomplete object.
+        """
+        for elt in self._sub_elements or []:
+            if issubclass(elt, ChoiceElement) or not elt._required:
+                continue
+            if not elt._get_value_from_parent(self):
+                return False
+        return True
+
     def _has_value(self):
         for elt in self._sub_elements:
             v = elt._get_value_from_parent(self)
@@ -98,11 +431,58 @@ class Element(object):
         obj = cls._add(tagname, self, value)
         return obj
 
+    def _check_attribute_value(self, name, value):
+        """Check value is allowed for the attribute name when the dtd gives
+        the allowed values: the enumerations and the #FIXED attributes.
+        """
+        values = self._attribute_values.get(name)
+        if values is None:
+            return
+        if self._attribute_types.get(name) != 'CDATA':
+            # The tokenized values are compared without the extra spaces
+            value = ' '.join(value.split())
+        if value not in values:
+            raise Exception('Invalid value for the attribute %s: %s' % (
+                name, value))
+
+    def _is_attribute_name(self, name):
+        # Only the set of the frozen class is up to date, a sub class can
+        # change _attribute_names.
+        names = type(self).__dict__.get('_attribute_name_set')
+        if names is None:
+            names = self._attribute_names or ()
+        return name in names
+
     def add_attribute(self, name, value):
-        if name not in self._attribute_names:
+        if not self._is_attribute_name(name):
             raise Exception('Invalid attribute name: %s' % name)
-        self._attributes = self._attributes or {}
-        self._attributes[name] = value
+        if self._attribute_values:
+            self._check_attribute_value(name, value)
+        # Don't change the dict which can be shared with a clone
+        attributes = dict(self._attributes or {})
+        attributes[name] = value
+        self._attributes = attributes
+
+    def get_attribute(self, name):
+        """Get the value of the attribute name, its default value defined in
+        the dtd if it's not set.
+        """
+        if not self._is_attribute_name(name):
+            raise Exception('Invalid attribute name: %s' % name)
+        value = (self._attributes or {}).get(name)
+        if value is None and self._attribute_defaults:
+            value = self._attribute_defaults.get(name)
+        return value
+
+    def check_attributes(self):
+        """Check the #REQUIRED attributes of this object and its sub
+        elements are set, without validating the whole XML with the dtd.
+        """
+        for obj in itertools.chain([self], self.walk()):
+            for name in obj._required_attributes:
+                if name not in (obj._attributes or {}):
+                    raise Exception('Missing attribute %s in %s' % (
+                        name, obj._tagname))
 
     def _load_attributes_from_xml(self, xml):
         for k, v in xml.attrib.items():
@@ -130,37 +510,14 @@ class Element(object):
         name = self._get_str_prefix(prefixes, index)
         for k, v in self._attributes.items():
             html += ['<input value="%s" name="%s" id="%s" class="_attrs" />' % (
-                v,
+                utils.escape_html(v),
                 '%s:_attrs:%s' % (name, k),
                 '%s:_attrs:%s' % (name, k),
             )]
         return ''.join(html)
 
     def _load_comment_from_xml(self, xml):
-        previous = xml
-        comments = []
-        while True:
-            previous = previous.getprevious()
-            if previous is None:
-                break
-            if not isinstance(previous, etree._Comment):
-                break
-            comments += [previous.text]
-
-        comments.reverse()
-        end_comments = []
-        nextelt = xml
-        # Only get the comment after the tag if we don't have any other tag
-        while True:
-            nextelt = nextelt.getnext()
-            if nextelt is None:
-                break
-            if not isinstance(nextelt, etree._Comment):
-                end_comments = []
-                break
-            end_comments += [nextelt.text]
-        comments += end_comments
-        self._comment = '\n'.join(comments) or None
+        self._comment = '\n'.join(_get_comments(xml)) or None
 
     def _load_comment_from_dict(self, dic):
         self._comment = dic.pop('_comment', None)
@@ -185,22 +542,44 @@ class Element(object):
                 u'<textarea class="_comment" name="{name}">{comment}</textarea>'
             ).format(
                 name=name,
-                comment=self._comment
+                comment=utils.escape_html(self._comment)
             )
 
-    def _load_extra_from_xml(self, xml):
+    def _load_extra_from_xml(self, xml, comments=None):
         self._load_attributes_from_xml(xml)
-        self._load_comment_from_xml(xml)
+        if comments is None:
+            self._load_comment_from_xml(xml)
+        else:
+            self._comment = '\n'.join(comments) or None
         self._sourceline = xml.sourceline
 
-    def load_from_xml(self, xml):
-        self._load_extra_from_xml(xml)
-        for child in xml:
-            if isinstance(child, etree._Comment):
-                # The comments are loaded when we load the object
-                continue
+    def load_from_xml(self, xml, comments=None):
+        """Load the lxml node xml in this object.
+
+        :param comments: the comments of xml, we look for them around xml if
+            not given.
+        :type comments: list
+
+        ..note:: xml is not changed, we keep an indented copy of it to write
+        the parts of the object which are not modified.
+        """
+        if comments is None:
+            # The copy has no sibling
+            comments = _get_comments(xml)
+        xml = copy.deepcopy(xml)
+        etree.indent(xml)
+        self._load_from_xml(xml, comments)
+
+    def _load_from_xml(self, xml, comments=None):
+        """Same as load_from_xml but xml is kept as it is, it should be
+        indented like the written files (see etree.indent) and not be used
+        by the caller.
+        """
+        self._load_extra_from_xml(xml, comments)
+        for child, child_comments in _get_children_comments(xml):
             obj = self.add(child.tag)
-            obj.load_from_xml(child)
+            obj._load_from_xml(child, child_comments)
+        self._set_xml_node(xml if self._is_complete() else None)
 
     def _load_extra_from_dict(self, data):
         self._load_attributes_from_dict(data)
@@ -229,7 +608,7 @@ class Element(object):
             v = elt._get_sub_value(self)
 
             if v is not None:
-                e = v.to_xml()
+                e = v._get_xml_node()
                 if isinstance(e, list):
                     xml.extend(e)
                 else:
@@ -239,6 +618,94 @@ class Element(object):
                     v._comment_to_xml(e)
         return xml
 
+    def _iter_write_objs(self, merge=None):
+        """Get the sub objects to write, the list of merge is replaced by
+        its items and its subtrees.
+        """
+        for elt in self._sub_elements:
+            if merge is not None and merge.is_slot(self, elt):
+                for obj in merge.iter_objs():
+                    yield obj
+                continue
+            v = elt._get_sub_value(self)
+            if v is None:
+                continue
+            if isinstance(v, ListElement):
+                for obj in v._get_items():
+                    yield obj
+            else:
+                yield v
+
+    def _write_xmlfile(self, xf, level=0, merge=None):
+        """Write the XML of this object in the incremental writer xf.
+
+        We get the same result as exporting to_xml with pretty_print, without
+        building the tree.
+
+        :param merge: the subtrees to write in a list (see write_merged)
+        :type merge: _MergedList
+        """
+        if (self._xml_node is not None and not self._modified and
+                (merge is None or not merge.contains(self))):
+            xml = self._xml_node
+            if not _is_indented(xml, level):
+                # The node has been loaded at another level, we indent a
+                # copy, the kept node can be shared with the clones.
+                xml = copy.deepcopy(xml)
+                etree.indent(xml, level=level)
+            _write_node(xf, xml)
+            return
+
+        objs = self._iter_write_objs(merge)
+        first = next(objs, None)
+        if first is None:
+            # Nothing to put in the tag, we want it autoclosed
+            _write_node(xf, self.to_xml())
+            return
+
+        indent = '\n' + '  ' * (level + 1)
+        with xf.element(self._tagname, self._attributes or {}):
+            for obj in itertools.chain([first], objs):
+                if obj._comment:
+                    xf.write(indent)
+                    xf.write(etree.Comment(obj._comment))
+                xf.write(indent)
+                obj._write_xmlfile(xf, level + 1, merge)
+            xf.write('\n' + '  ' * level)
+
+    def to_xmlfile(self, f, encoding=None, dtd_url=None):
+        """Write the XML of this object in the file object f.
+
+        :param f: the file object to write in
+        :param encoding: the encoding of the XML
+        :type encoding: str
+        :param dtd_url: the url of the dtd to put in the doctype
+        :type dtd_url: str
+
+        ..note:: The XML is written by chunks, the whole tree is never
+        generated.
+        """
+        self._to_xmlfile(f, encoding, dtd_url)
+
+    def _to_xmlfile(self, f, encoding, dtd_url, merge=None):
+        encoding = encoding or self._xml_encoding or DEFAULT_ENCODING
+        dtd_url = dtd_url or self._xml_dtd_url
+        with etree.xmlfile(f, encoding=encoding) as xf:
+            xf.write_declaration()
+            if dtd_url:
+                xf.write_doctype(
+                    '<!DOCTYPE %(root_tag)s SYSTEM "%(dtd_url)s">' % {
+                        'root_tag': self._tagname,
+                        'dtd_url': dtd_url,
+                    })
+            if self._comment:
+                elt = etree.Comment(self._comment)
+                # We can't write text outside of the root tag
+                elt.tail = '\n'
+                xf.write(elt)
+            self._write_xmlfile(xf, merge=merge)
+        f.write('\n')
+
     @classmethod
     def _get_html_add_button(cls, prefixes, index=None, css_class=None):
         if cls._is_choice:
@@ -255,16 +722,30 @@ class Element(object):
                     cls._tagname)
 
     @classmethod
-    def _to_html(cls, parent_obj, prefixes=None, index=None):
+    def _to_html(cls, parent_obj, prefixes=None, index=None, limit=None):
         v = cls._get_value_from_parent(parent_obj)
         if not v:
             # We always want an object since we need at least a add button.
             v = cls()
-        return v.to_html(prefixes, index)
+        return v.to_html(prefixes, index, limit=limit)
 
     def to_html(self, prefixes=None, index=None, delete_btn=False,
-                add_btn=True,  partial=False):
-
+                add_btn=True,  partial=False, limit=None):
+        if _html_cache is None:
+            return self._render_html(prefixes, index, delete_btn, add_btn,
+                                     partial, limit)
+
+        key = (self.__class__, tuple(prefixes or []), index, delete_btn,
+               add_btn, partial, limit, bool(self._parent), self._get_hash())
+        html = _html_cache.get(key)
+        if html is None:
+            html = self._render_html(prefixes, index, delete_btn, add_btn,
+                                     partial, limit)
+            _html_cache.set(key, html)
+        return html
+
+    def _render_html(self, prefixes, index, delete_btn, add_btn, partial,
+                     limit):
         if not self._has_value() and not self._required and self._parent and not partial:
             # Add button!
             return self._get_html_add_button(prefixes, index)
@@ -272,7 +753,7 @@ class Element(object):
         tmp_prefixes = self._get_prefixes(prefixes, index)
         sub_html = [self._attributes_to_html(prefixes, index)]
         for elt in self._sub_elements:
-            tmp = elt._to_html(self, tmp_prefixes)
+            tmp = elt._to_html(self, tmp_prefixes, limit=limit)
             if tmp:
                 sub_html += [tmp]
 
@@ -295,21 +776,28 @@ class Element(object):
         return ''.join(html)
 
     @classmethod
-    def _to_jstree_dict(cls, parent_obj, prefixes=None, index=None):
+    def _get_jstree_value(cls, parent_obj):
         v = cls._get_value_from_parent(parent_obj)
         if not v and cls._required:
             # We always want an object since we need at least a add button.
             v = cls()
         if v:
-            return v.to_jstree_dict(prefixes, index)
+            return v
 
-    def to_jstree_dict(self, prefixes, index=None):
+    @classmethod
+    def _to_jstree_dict(cls, parent_obj, prefixes=None, index=None,
+                        max_depth=None):
+        v = cls._get_jstree_value(parent_obj)
+        if v:
+            return v.to_jstree_dict(prefixes, index, max_depth=max_depth)
+
+    def _get_jstree_data(self, prefixes, index):
         tmp_prefixes = self._get_prefixes(prefixes, index)
         data = self._tagname
         value = getattr(self, '_value', None)
         if value:
             data += u' <span class="_tree_text">(%s)</span>' % (
-                utils.truncate(value))
+                utils.escape_html(utils.truncate(value)))
 
         css_class = 'tree_' +  ':'.join(prefixes or [])
         if index is not None:
@@ -317,21 +805,233 @@ class Element(object):
         else:
             css_class += ':' + self._tagname
 
-        dic = {
+        return {
             'data': data,
             'attr': {
                 'id': 'tree_' +  ':'.join(tmp_prefixes),
                 'class': css_class,
             },
         }
+
+    def _has_jstree_children(self):
+        for elt in self._sub_elements:
+            v = elt._get_jstree_value(self)
+            if v and not isinstance(v, ChoiceElement):
+                return True
+        return False
+
+    def _is_jstree_closed(self, max_depth):
+        """Check if the children should be loaded later.
+        """
+        if max_depth is None or max_depth > 1:
+            return False
+        return self._has_jstree_children()
+
+    def _get_jstree_children(self, prefixes, max_depth=None):
         children = []
         for elt in self._sub_elements:
-            v = elt._to_jstree_dict(self, tmp_prefixes)
+            v = elt._to_jstree_dict(self, prefixes, max_depth=max_depth)
             if v:
                 children += [v]
-        dic['children'] = children
+        return children
+
+    def to_jstree_dict(self, prefixes, index=None, max_depth=None):
+        """Get the jstree data of this object.
+
+        :param max_depth: the number of levels to render. The children of
+            the deepest objects are not rendered, the node is marked as
+            closed to load them on demand with :func:`get_jstree_children`.
+        :type max_depth: int
+        """
+        dic = self._get_jstree_data(prefixes, index)
+        if self._is_jstree_closed(max_depth):
+            dic['state'] = 'closed'
+            return dic
+
+        if max_depth is not None:
+            max_depth -= 1
+        tmp_prefixes = self._get_prefixes(prefixes, index)
+        dic['children'] = self._get_jstree_children(tmp_prefixes, max_depth)
         return dic
 
+    def iter_jstree_json(self, prefixes, index=None, max_depth=None):
+        """Same as to_jstree_dict but generate the JSON by chunks.
+
+        ..note:: The whole data is never created, it's useful to render the
+        tree of a big document.
+        """
+        dic = self._get_jstree_data(prefixes, index)
+        if self._is_jstree_closed(max_depth):
+            dic['state'] = 'closed'
+            yield json.dumps(dic)
+            return
+
+        if max_depth is not None:
+            max_depth -= 1
+        tmp_prefixes = self._get_prefixes(prefixes, index)
+        # Remove the last '}' to add the children
+        yield json.dumps(dic)[:-1] + ', "children": ['
+        sep = ''
+        for elt in self._sub_elements:
+            v = elt._get_jstree_value(self)
+            if not v or isinstance(v, ChoiceElement):
+                continue
+            yield sep
+            sep = ', '
+            for s in v.iter_jstree_json(tmp_prefixes, max_depth=max_depth):
+                yield s
+        yield ']}'
+
+    def _get_json_extra(self):
+        """Get the attributes and the comment to put in the dict data.
+        """
+        lis = []
+        if self._attributes:
+            lis += [('_attrs', dict(self._attributes))]
+        if self._comment:
+            lis += [('_comment', self._comment)]
+        return lis
+
+    def _get_json_children(self):
+        """Get the defined sub elements (the chosen one for a choice).
+        """
+        for elt in self._sub_elements:
+            v = elt._get_value_from_parent(self)
+            if v is None or (isinstance(v, ListElement) and not len(v)):
+                continue
+            yield v
+
+    def _get_dict_data(self):
+        data = dict(self._get_json_extra())
+        for v in self._get_json_children():
+            if isinstance(v, ListElement):
+                data[v._tagname] = [e.to_dict() for e in v]
+            else:
+                data[v._tagname] = v._get_dict_data()
+        return data
+
+    def to_dict(self):
+        """Get the content of this object as dict, in the format of
+        load_from_dict: the lists are under the tagname of the ListElement,
+        the chosen element of a choice under its tagname.
+        """
+        return {self._tagname: self._get_dict_data()}
+
+    def to_json(self):
+        """Get the content of this object as JSON (see to_dict).
+        """
+        return json.dumps(self.to_dict())
+
+    def _iter_json_data(self):
+        yield '{'
+        sep = ''
+        for k, v in self._get_json_extra():
+            yield '%s%s: %s' % (sep, json.dumps(k), json.dumps(v))
+            sep = ', '
+        for v in self._get_json_children():
+            yield '%s%s: ' % (sep, json.dumps(v._tagname))
+            sep = ', '
+            if isinstance(v, ListElement):
+                yield '['
+                for i, e in enumerate(v):
+                    if i:
+                        yield ', '
+                    for chunk in e.iter_json():
+                        yield chunk
+                yield ']'
+            else:
+                for chunk in v._iter_json_data():
+                    yield chunk
+        yield '}'
+
+    def iter_json(self):
+        """Same as to_json but generate the JSON by chunks.
+
+        ..note:: The whole data is never created, it's useful to export a
+        big document.
+        """
+        yield '{%s: ' % json.dumps(self._tagname)
+        for chunk in self._iter_json_data():
+            yield chunk
+        yield '}'
+
+    def _load_json_extra(self, data):
+        attrs = data.get('_attrs')
+        if attrs:
+            for k in attrs:
+                if not self._is_attribute_name(k):
+                    raise Exception('Invalid attribute name: %s' % k)
+                if self._attribute_values:
+                    self._check_attribute_value(k, attrs[k])
+            object.__setattr__(self, '_attributes', dict(attrs))
+        comment = data.get('_comment')
+        if comment:
+            object.__setattr__(self, '_comment', comment)
+
+    def _load_json_data(self, data):
+        """Load the dict data of to_dict in this new object.
+
+        ..note:: Unlike load_from_dict, data is not changed and the sub
+        objects are set directly, a new object has nothing to mark as
+        modified.
+        """
+        self._load_json_extra(data)
+        for key, value in data.iteritems():
+            if key.startswith('_'):
+                continue
+            cls = self._get_sub_element(key)
+            if cls is None:
+                raise Exception('Invalid child %s' % key)
+            if issubclass(cls, ListElement):
+                lis = cls()
+                object.__setattr__(lis, '_parent', self)
+                for item in value:
+                    (tagname, item_data), = item.items()
+                    item_cls = cls._get_sub_element(tagname)
+                    if item_cls is None:
+                        raise Exception('Invalid child %s' % tagname)
+                    obj = item_cls()
+                    object.__setattr__(obj, '_parent', lis)
+                    obj._load_json_data(item_data)
+                    list.append(lis, obj)
+                key = cls._tagname
+                if len(cls._elts) == 1:
+                    key = cls._elts[0]._tagname
+                object.__setattr__(self, key, lis)
+                continue
+            if issubclass(cls, ChoiceElement):
+                cls = cls._get_sub_element(key)
+            obj = cls()
+            object.__setattr__(obj, '_parent', self)
+            obj._load_json_data(value)
+            object.__setattr__(self, key, obj)
+
+    @classmethod
+    def from_dict(cls, dic):
+        """Create an object of this class from the data of to_dict.
+
+        :param dic: the data, it's not changed
+        :type dic: dict
+        :return: the created object
+        :rtype: :class:`Element`
+        """
+        if dic.keys() != [cls._tagname]:
+            raise Exception('Invalid data for %s' % cls._tagname)
+        obj = cls()
+        obj._load_json_data(dic[cls._tagname])
+        return obj
+
+    @classmethod
+    def from_json(cls, json_str):
+        """Create an object of this class from the JSON of to_json.
+
+        :param json_str: the JSON string
+        :type json_str: str
+        :return: the created object
+        :rtype: :class:`Element`
+        """
+        return cls.from_dict(json.loads(json_str))
+
     def __getitem__(self, tagname):
         v = getattr(self, tagname, None)
         if not v:
@@ -386,7 +1086,23 @@ class Element(object):
         return res
 
     def write(self, filename=None, encoding=None, dtd_url=None, validate=True,
-              transform=None):
+              transform=None, fsync=False, lock=False):
+        """Write the XML of this object in filename.
+
+        The XML is written in a temporary file which replaces filename, so
+        the readers never see a partial file.
+
+        ..note:: The XML is streamed in the temporary file and validated
+        while parsing it back (see :func:`xmltool.utils.validate_xml_file`),
+        the whole tree is never in memory. With transform, we need the whole
+        XML string.
+
+        :param fsync: flush the file to the disk before returning.
+        :type fsync: bool
+        :param lock: lock filename during the writing (see
+            :func:`xmltool.utils.file_lock`).
+        :type lock: bool
+        """
         filename = filename or self._xml_filename
         if not filename:
             raise Exception('No filename given')
@@ -394,9 +1110,37 @@ class Element(object):
         if not dtd_url:
             raise Exception('No dtd url given')
         encoding = encoding or self._xml_encoding or DEFAULT_ENCODING
-        xml = self.to_xml()
+        dtd_str = None
         if validate:
             dtd_str = utils.get_dtd_content(dtd_url, os.path.dirname(filename))
+
+        try:
+            if not lock:
+                self._write(filename, encoding, dtd_url, dtd_str, transform,
+                            fsync)
+                return
+            with utils.file_lock(filename):
+                self._write(filename, encoding, dtd_url, dtd_str, transform,
+                            fsync)
+        finally:
+            _invalidate_document(filename)
+
+    def _write(self, filename, encoding, dtd_url, dtd_str, transform, fsync):
+        """Write the XML in filename, validate it if dtd_str is given
+        """
+        if not transform:
+            # Stream the XML in a temporary file, it's validated while
+            # parsing it back before replacing filename.
+            with utils.atomic_open(filename, fsync) as f:
+                self.to_xmlfile(f, encoding, dtd_url)
+                if dtd_str:
+                    f.flush()
+                    utils.validate_xml_file(f.name, dtd_str)
+            return
+
+        # We need the whole string to transform it
+        xml = self.to_xml()
+        if dtd_str:
             utils.validate_xml(xml, dtd_str)
 
         doctype = ('<!DOCTYPE %(root_tag)s SYSTEM "%(dtd_url)s">' % {
@@ -409,9 +1153,77 @@ class Element(object):
             xml_declaration=True,
             encoding=encoding,
             doctype=doctype)
-        if transform:
-            xml_str = transform(xml_str)
-        open(filename, 'w').write(xml_str)
+        xml_str = transform(xml_str)
+        with utils.atomic_open(filename, fsync) as f:
+            f.write(xml_str)
+
+    def write_merged(self, tagname, subtrees, filename=None, encoding=None,
+                     dtd_url=None, validate=True, fsync=False, lock=False):
+        """Write the document of this object in filename with the subtrees
+        appended to the list of tagname elements of this object.
+
+        The subtrees are written as they come, for example from
+        :func:`xmltool.factory.map_subtrees`, they are never all in memory.
+        The file is written like :meth:`write` does, from the root of this
+        object.
+
+        :param tagname: the tagname of the items of the list
+        :type tagname: str
+        :param subtrees: the objects to write after the items of the list
+        :type subtrees: iterable of :class:`Element`
+        :param validate: validate the document with the first subtree, then
+            each subtree alone. The whole file is never validated.
+        :type validate: bool
+        :return: the number of written subtrees
+        :rtype: int
+
+        ..note:: Validating the subtrees one by one doesn't check the unicity
+        of the ID attributes between them.
+        """
+        root = self
+        while isinstance(root._parent, Element):
+            root = root._parent
+        filename = filename or root._xml_filename
+        if not filename:
+            raise Exception('No filename given')
+        dtd_url = dtd_url or root._xml_dtd_url
+        if not dtd_url:
+            raise Exception('No dtd url given')
+        encoding = encoding or root._xml_encoding or DEFAULT_ENCODING
+        list_cls = self._get_sub_element(tagname)
+        if list_cls is None or not issubclass(list_cls, ListElement):
+            raise Exception('No list of %s in %s' % (tagname, self._tagname))
+
+        subtrees = iter(subtrees)
+        head = list(itertools.islice(subtrees, 1))
+        dtd_obj = None
+        if validate:
+            dtd_str = utils.get_dtd_content(dtd_url, os.path.dirname(filename))
+            dtd_obj = etree.DTD(StringIO.StringIO(dtd_str))
+            # The document without the other subtrees
+            f = StringIO.StringIO()
+            root._to_xmlfile(f, encoding, dtd_url,
+                             _MergedList(self, list_cls, head))
+            with metrics.phase('validate'):
+                dtd_obj.assertValid(etree.fromstring(
+                    f.getvalue(), utils.get_xml_parser()).getroottree())
+
+        merge = _MergedList(self, list_cls, itertools.chain(head, subtrees),
+                            dtd_obj)
+        try:
+            if not lock:
+                root._write_merged(filename, encoding, dtd_url, merge, fsync)
+            else:
+                with utils.file_lock(filename):
+                    root._write_merged(filename, encoding, dtd_url, merge,
+                                       fsync)
+        finally:
+            _invalidate_document(filename)
+        return merge.count
+
+    def _write_merged(self, filename, encoding, dtd_url, merge, fsync):
+        with utils.atomic_open(filename, fsync) as f:
+            self._to_xmlfile(f, encoding, dtd_url, merge)
 
 
 class TextElement(Element):
@@ -423,17 +1235,36 @@ class TextElement(Element):
             self._tagname,
             (self._value or '').strip())
 
-    def load_from_xml(self, xml):
-        self._load_extra_from_xml(xml)
+    def _load_from_xml(self, xml, comments=None):
+        self._load_extra_from_xml(xml, comments)
         self._value = xml.text
         # We use _exists to know if the tag is defined in the XML.
         self._exists= True
+        if not self._is_empty and xml.text is None:
+            # Make sure the kept node is exported like in to_xml: no autoclose
+            # tag.
+            xml.text = ''
+        self._set_xml_node(xml)
 
     def load_from_dict(self, dic):
         data = dic[self._tagname]
         self._load_extra_from_dict(data)
         self._value = data.get('_value')
 
+    def _get_dict_data(self):
+        data = dict(self._get_json_extra())
+        if self._value is not None:
+            data['_value'] = self._value
+        return data
+
+    def _iter_json_data(self):
+        yield json.dumps(self._get_dict_data())
+
+    def _load_json_data(self, data):
+        self._load_json_extra(data)
+        object.__setattr__(self, '_value', data.get('_value'))
+        object.__setattr__(self, '_exists', True)
+
     def to_xml(self):
         xml = etree.Element(self._tagname)
         # The comment can't be added here since we don't always have the parent
@@ -450,6 +1281,12 @@ class TextElement(Element):
             xml.text = self._value or ''
         return xml
 
+    def _write_xmlfile(self, xf, level=0, merge=None):
+        if self._xml_node is not None and not self._modified:
+            _write_node(xf, self._xml_node)
+            return
+        _write_node(xf, self.to_xml())
+
     def _get_html_attrs(self, prefixes, index=None):
         prefixes = list(prefixes or [])
         if index is not None:
@@ -472,7 +1309,7 @@ class TextElement(Element):
         return ' ' + attr
 
     def to_html(self, prefixes=None, index=None, delete_btn=False,
-                add_btn=True, partial=False):
+                add_btn=True, partial=False, limit=None):
 
         if (not self._exists and not self._value and
             not self._required and not partial):
@@ -503,7 +1340,7 @@ class TextElement(Element):
                 delete_button=delete_button,
                 comment=self._comment_to_html(prefixes, index),
                 attrs=self._get_html_attrs(prefixes, index),
-                value=self._value or '',
+                value=utils.escape_html(self._value or ''),
                 xmlattrs=self._attributes_to_html(prefixes, index),
             )
 
@@ -520,6 +1357,71 @@ class MultipleMixin(object):
 
 class ListElement(list, MultipleMixin, Element):
 
+    def _set_modified(self):
+        # We don't have any node for a list, it's included in the parent one.
+        if isinstance(self._parent, Element):
+            self._parent._set_modified()
+
+    def _clone(self, parent):
+        obj = super(ListElement, self)._clone(parent)
+        list.extend(obj, [e._clone(obj) for e in self])
+        return obj
+
+    def append(self, obj):
+        super(ListElement, self).append(obj)
+        self._set_modified()
+
+    def extend(self, lis):
+        super(ListElement, self).extend(lis)
+        self._set_modified()
+
+    def insert(self, index, obj):
+        super(ListElement, self).insert(index, obj)
+        self._set_modified()
+
+    def remove(self, obj):
+        super(ListElement, self).remove(obj)
+        self._set_modified()
+
+    def pop(self, *args):
+        obj = super(ListElement, self).pop(*args)
+        self._set_modified()
+        return obj
+
+    def __setitem__(self, index, obj):
+        super(ListElement, self).__setitem__(index, obj)
+        self._set_modified()
+
+    def __delitem__(self, index):
+        super(ListElement, self).__delitem__(index)
+        self._set_modified()
+
+    # The slices of python 2 don't use __setitem__ and __delitem__
+    def __setslice__(self, i, j, lis):
+        super(ListElement, self).__setslice__(i, j, lis)
+        self._set_modified()
+
+    def __delslice__(self, i, j):
+        super(ListElement, self).__delslice__(i, j)
+        self._set_modified()
+
+    def __iadd__(self, lis):
+        self.extend(lis)
+        return self
+
+    def __imul__(self, n):
+        super(ListElement, self).__imul__(n)
+        self._set_modified()
+        return self
+
+    def sort(self, *args, **kwargs):
+        super(ListElement, self).sort(*args, **kwargs)
+        self._set_modified()
+
+    def reverse(self):
+        super(ListElement, self).reverse()
+        self._set_modified()
+
     @classmethod
     def _get_allowed_tagnames(cls):
         lis = [cls._tagname]
@@ -527,21 +1429,25 @@ class ListElement(list, MultipleMixin, Element):
             lis += [e._tagname]
         return lis
 
+    @classmethod
+    def _get_or_add_list(cls, parent_obj):
+        lis = cls._get_value_from_parent(parent_obj)
+        if not lis:
+            tg = cls._tagname
+            if len(cls._elts) == 1:
+                tg = cls._elts[0]._tagname
+            lis = cls()
+            lis._parent = parent_obj
+            setattr(parent_obj, tg, lis)
+        return lis
+
     @classmethod
     def _add(cls, tagname, parent_obj, value=None):
         elt = cls._get_sub_element(tagname)
         if value and not issubclass(elt, TextElement):
             raise Exception, "Can't set value to non TextElement"
 
-        tg = cls._tagname
-        if len(cls._elts) == 1:
-            tg = tagname
-
-        lis = getattr(parent_obj, tg, None)
-        if not lis:
-            lis = cls()
-            lis._parent = parent_obj
-            setattr(parent_obj, tg, lis)
+        lis = cls._get_or_add_list(parent_obj)
         tmpobj = elt()
         tmpobj._parent = lis
         if value:
@@ -549,18 +1455,29 @@ class ListElement(list, MultipleMixin, Element):
         lis.append(tmpobj)
         return tmpobj
 
+    def _get_items(self, force=False):
+        """Get the objects to render.
+
+        :param force: add a new object if the list is empty even if it's not
+            required.
+        :type force: bool
+
+        ..note:: The new object is not added in the list, the rendering never
+        changes the list.
+        """
+        if len(self) or not (self._required or force) or len(self._elts) != 1:
+            return list(self)
+        e = self._elts[0]()
+        e._parent = self
+        return [e]
+
     def to_xml(self):
         lis = []
-        if not len(self) and self._required:
-            if len(self._elts) == 1:
-                e = self.add(self._elts[0]._tagname)
-                self.append(e)
-
-        for e in self:
+        for e in self._get_items():
             if e._comment:
                 elt = etree.Comment(e._comment)
                 lis += [elt]
-            lis += [e.to_xml()]
+            lis += [e._get_xml_node()]
         return lis
 
     @classmethod
@@ -608,21 +1525,31 @@ class ListElement(list, MultipleMixin, Element):
             tg = cls._elts[0]._tagname
         return getattr(parent_obj, tg, None)
 
-    def to_html(self, prefixes=None, index=None, delete_btn=False,
-                add_btn=True, partial=False, offset=0):
-
-        # We should not have the following parameter for this object
-        assert self._attributes is None
-        assert index is None
+    def _get_html_more_button(self, prefixes, index, start, limit):
+        """The button to load the next items of the list.
 
-        if not len(self) and (self._required or partial):
-            if len(self._elts) == 1:
-                e = self.add(self._elts[0]._tagname)
-                self.append(e)
+        ..note:: The data-id is like the ones of the add buttons, the index
+        is updated on the client side when we add or delete an item. The
+        position of the next item in the loaded list is kept in data-start.
+        """
+        data_id = ':'.join(list(prefixes or []) + [self._tagname, str(index)])
+        return ('<a class="btn btn-list-more" data-id="%s" data-start="%i" '
+                'data-limit="%i">More %s (%i)</a>') % (
+                    data_id,
+                    start,
+                    limit,
+                    '/'.join([e._tagname for e in self._elts]),
+                    len(self) - start)
+
+    def _items_to_html(self, prefixes, items, offset=0, partial=False,
+                       limit=None, start=0):
+        more = limit is not None and len(items) > limit
+        if more:
+            items = items[:limit]
 
         i = -1
         lis = []
-        for i, e in enumerate(self):
+        for i, e in enumerate(items):
             if not partial:
                 lis += [self._get_html_add_button(prefixes, (i+offset))]
             force = False
@@ -632,27 +1559,54 @@ class ListElement(list, MultipleMixin, Element):
                               (i+offset),
                               delete_btn=True,
                               partial=force,
-                              add_btn=False)]
+                              add_btn=False,
+                              limit=limit)]
+
+        if more:
+            lis += [self._get_html_more_button(prefixes, i+offset+1,
+                                               i+start+1, limit)]
+        else:
+            lis += [self._get_html_add_button(prefixes, i+offset+1)]
+        return lis
 
-        lis += [self._get_html_add_button(prefixes, i+offset+1)]
+    def to_html(self, prefixes=None, index=None, delete_btn=False,
+                add_btn=True, partial=False, offset=0, limit=None):
+        """
+        :param limit: the maximum number of items to render, a button is
+            added to load the next ones with :func:`get_list_html_from_str_id`
+        :type limit: int
+        """
 
+        # We should not have the following parameter for this object
+        assert self._attributes is None
+        assert index is None
+
+        lis = self._items_to_html(prefixes, self._get_items(partial), offset,
+                                  partial, limit)
         if partial:
             return ''.join(lis)
         return '<div class="list-container">%s</div>' % ''.join(lis)
 
-    def to_jstree_dict(self, prefixes, index=None, offset=0):
-        if not len(self) and (self._required):
-            if len(self._elts) == 1:
-                e = self.add(self._elts[0]._tagname)
-                self.append(e)
-
+    def to_jstree_dict(self, prefixes, index=None, offset=0, max_depth=None):
         lis = []
-        for i, e in enumerate(self):
-            v = e.to_jstree_dict((prefixes or [])+[self._tagname], i+offset)
+        for i, e in enumerate(self._get_items()):
+            v = e.to_jstree_dict((prefixes or [])+[self._tagname], i+offset,
+                                 max_depth=max_depth)
             if v:
                 lis += [v]
         return lis
 
+    def iter_jstree_json(self, prefixes, index=None, offset=0,
+                         max_depth=None):
+        yield '['
+        for i, e in enumerate(self._get_items()):
+            if i:
+                yield ', '
+            for s in e.iter_jstree_json((prefixes or [])+[self._tagname],
+                                        i+offset, max_depth=max_depth):
+                yield s
+        yield ']'
+
     def get_or_add(self, tagname):
         raise NotImplementedError
 
@@ -716,21 +1670,64 @@ class ChoiceElement(MultipleMixin, Element):
                 return v
 
     @classmethod
-    def _to_html(cls, parent_obj, prefixes=None, index=None):
+    def _to_html(cls, parent_obj, prefixes=None, index=None, limit=None):
         v = cls._get_value_from_parent(parent_obj)
         if not v:
             return cls._get_html_add_button(prefixes, index)
-        return v.to_html(prefixes, index)
+        return v.to_html(prefixes, index, limit=limit)
 
     @classmethod
     def _get_sub_value(cls, parent_obj):
         # We don't know which object to insert, so do nothing if None
         return cls._get_value_from_parent(parent_obj)
 
-    def to_jstree_dict(self, prefixes, index=None):
+    def to_jstree_dict(self, prefixes, index=None, max_depth=None):
         # Nothing to add in for this object
         return {}
 
+    def iter_jstree_json(self, prefixes, index=None, max_depth=None):
+        yield '{}'
+
+class _MergedList(object):
+    """The subtrees written by Element.write_merged in the list list_cls of
+    parent.
+    """
+
+    def __init__(self, parent, list_cls, subtrees, dtd_obj=None):
+        self.parent = parent
+        self.list_cls = list_cls
+        self.subtrees = subtrees
+        self.dtd_obj = dtd_obj
+        self.count = 0
+        # The kept nodes of the parent and its ancestors don't contain the
+        # subtrees.
+        self._ancestors = set()
+        obj = parent
+        while obj is not None:
+            self._ancestors.add(id(obj))
+            obj = obj._parent
+
+    def contains(self, obj):
+        return id(obj) in self._ancestors
+
+    def is_slot(self, obj, elt):
+        return obj is self.parent and elt is self.list_cls
+
+    def iter_objs(self):
+        v = self.list_cls._get_value_from_parent(self.parent)
+        for obj in v or []:
+            yield obj
+        allowed_tagnames = self.list_cls._get_allowed_tagnames()
+        for obj in self.subtrees:
+            if obj._tagname not in allowed_tagnames:
+                raise Exception('Invalid child %s' % obj._tagname)
+            if self.dtd_obj is not None:
+                with metrics.phase('validate'):
+                    self.dtd_obj.assertValid(obj._get_xml_node())
+            self.count += 1
+            yield obj
+
+
 def _get_obj_from_str_id(str_id, dtd_url=None, dtd_str=None):
     # Will raise an exception if both dtd_url or dtd_str are None or set
     dic = dtd_parser.parse(dtd_url=dtd_url, dtd_str=dtd_str)
@@ -819,3 +1816,218 @@ def get_jstree_json_from_str_id(str_id, dtd_url=None, dtd_str=None):
         'html': _get_html_from_obj(obj, prefixes, index),
     }
 
+
+def _get_obj_from_loaded_str_id(obj, str_id, create=False):
+    """Get the object corresponding to str_id in the loaded object.
+
+    :param create: add the missing objects which are not in a list.
+    :type create: bool
+    """
+    splitted = str_id.split(':')
+    s = splitted.pop(0)
+    if s != obj._tagname:
+        raise Exception('Invalid id %s' % str_id)
+    while splitted:
+        s = splitted.pop(0)
+        tmp_cls = obj._get_sub_element(s)
+        if not tmp_cls:
+            raise Exception('Unsupported tag %s' % s)
+
+        if issubclass(tmp_cls, ListElement):
+            if len(splitted) < 2 or not splitted[0].isdigit():
+                raise Exception('Invalid id %s' % str_id)
+            index = int(splitted.pop(0))
+            s = splitted.pop(0)
+            v = tmp_cls._get_value_from_parent(obj)
+            if not v or index >= len(v):
+                raise Exception('Invalid id %s' % str_id)
+            v = v[index]
+        elif create:
+            v = tmp_cls._get_value_from_parent(obj)
+            if not v:
+                v = obj.add(s)
+        else:
+            v = tmp_cls._get_sub_value(obj)
+
+        if not v or v._tagname != s:
+            raise Exception('Invalid id %s' % str_id)
+        obj = v
+    return obj
+
+
+def get_jstree_children(obj, tree_id, max_depth=1):
+    """Get the jstree children of a node, useful to load the closed nodes on
+    demand.
+
+    :param obj: the loaded root object
+    :type obj: :class:`Element`
+    :param tree_id: the id of the jstree node
+    :type tree_id: str
+    :param max_depth: the number of levels to render
+    :type max_depth: int
+    :return: the jstree data of the children
+    :rtype: list
+    """
+    str_id = tree_id
+    if str_id.startswith('tree_'):
+        str_id = str_id[len('tree_'):]
+    elt = _get_obj_from_loaded_str_id(obj, str_id)
+    return elt._get_jstree_children(str_id.split(':'), max_depth)
+
+
+def get_list_html_from_str_id(obj, str_id, start=None, limit=None):
+    """Get the HTML of the next items of a list rendered with a limit.
+
+    :param obj: the loaded root object
+    :type obj: :class:`Element`
+    :param str_id: the data-id of the button to load the next items
+    :type str_id: str
+    :param start: the position of the first item to render in the loaded
+        list, the index of str_id is used if not given.
+    :type start: int
+    :param limit: the maximum number of items to render
+    :type limit: int
+    :return: the HTML of the items
+    :rtype: str
+    """
+    splitted = str_id.split(':')
+    if len(splitted) < 3 or not splitted[-1].isdigit():
+        raise Exception('Invalid id %s' % str_id)
+    index = int(splitted.pop())
+    tagname = splitted.pop()
+    if start is None:
+        start = index
+    parent = _get_obj_from_loaded_str_id(obj, ':'.join(splitted))
+    cls = parent._get_sub_element(tagname)
+    if not cls or not issubclass(cls, ListElement):
+        raise Exception('Invalid id %s' % str_id)
+    lis = cls._get_value_from_parent(parent)
+    if not lis or start > len(lis):
+        raise Exception('Invalid id %s' % str_id)
+    return ''.join(lis._items_to_html(splitted, lis[start:], index,
+                                      limit=limit, start=start))
+
+
+def _get_position_from_loaded_str_id(obj, str_id, create=False):
+    """Get the parent and the position of the object corresponding to str_id
+    in the loaded object.
+
+    :return: the parent, the tagname, the list containing the object and its
+        index. The list and the index are None if the object is not in a
+        list.
+    :rtype: tuple
+    """
+    splitted = str_id.split(':')
+    if len(splitted) < 2:
+        raise Exception('Invalid id %s' % str_id)
+    tagname = splitted.pop()
+    index = None
+    if len(splitted) > 2 and splitted[-1].isdigit():
+        index = int(splitted.pop())
+        list_tagname = splitted.pop()
+    parent = _get_obj_from_loaded_str_id(obj, ':'.join(splitted), create)
+    if index is None:
+        if not parent._get_sub_element(tagname):
+            raise Exception('Unsupported tag %s' % tagname)
+        return parent, tagname, None, None
+
+    cls = parent._get_sub_element(list_tagname)
+    if not cls or not issubclass(cls, ListElement):
+        raise Exception('Invalid id %s' % str_id)
+    if not cls._get_sub_element(tagname):
+        raise Exception('Unsupported tag %s' % tagname)
+    if create:
+        lis = cls._get_or_add_list(parent)
+    else:
+        lis = cls._get_value_from_parent(parent)
+        if not lis or index >= len(lis) or lis[index]._tagname != tagname:
+            raise Exception('Invalid id %s' % str_id)
+    return parent, tagname, lis, index
+
+
+def _set_from_str_id(obj, name, value):
+    splitted = name.split(':')
+    if len(splitted) > 2 and splitted[-2] == '_attrs':
+        elt = _get_obj_from_loaded_str_id(obj, ':'.join(splitted[:-2]), True)
+        if value is not None:
+            elt.add_attribute(splitted[-1], value)
+            return
+        # Remove the attribute
+        attributes = dict(elt._attributes or {})
+        attributes.pop(splitted[-1], None)
+        elt._attributes = attributes or None
+    elif splitted[-1] == '_comment':
+        elt = _get_obj_from_loaded_str_id(obj, ':'.join(splitted[:-1]), True)
+        elt._comment = value or None
+    elif splitted[-1] == '_value':
+        elt = _get_obj_from_loaded_str_id(obj, ':'.join(splitted[:-1]), True)
+        if not isinstance(elt, TextElement):
+            raise Exception, "Can't set value to non TextElement"
+        elt._value = value
+    else:
+        raise Exception('Invalid name %s' % name)
+
+
+def _add_from_str_id(obj, str_id):
+    parent, tagname, lis, index = _get_position_from_loaded_str_id(
+        obj, str_id, create=True)
+    if lis is None:
+        return parent.add(tagname)
+    if index > len(lis):
+        raise Exception('Invalid id %s' % str_id)
+    elt = lis._get_sub_element(tagname)()
+    elt._parent = lis
+    lis.insert(index, elt)
+    return elt
+
+
+def _delete_from_str_id(obj, str_id):
+    parent, tagname, lis, index = _get_position_from_loaded_str_id(
+        obj, str_id)
+    if lis is None:
+        if not getattr(parent, tagname, None):
+            raise Exception('Invalid id %s' % str_id)
+        delattr(parent, tagname)
+        return
+    del lis[index]
+
+
+def _move_from_str_id(obj, str_id, new_index):
+    parent, tagname, lis, index = _get_position_from_loaded_str_id(
+        obj, str_id)
+    if lis is None or int(new_index) >= len(lis):
+        raise Exception('Invalid move of %s' % str_id)
+    lis.insert(int(new_index), lis.pop(index))
+
+
+_operations = {
+    'set': _set_from_str_id,
+    'add': _add_from_str_id,
+    'delete': _delete_from_str_id,
+    'move': _move_from_str_id,
+}
+
+
+def apply_operations(obj, operations):
+    """Apply the operations made in the form to the loaded object.
+
+    The operations are applied in order, the ids are the ones we have in the
+    form when the operation is made:
+
+        * ('set', name, value): set the value, the comment or an attribute,
+          name is the name of the form field. An attribute is removed if
+          value is None.
+        * ('add', str_id): add a new object.
+        * ('delete', str_id): delete the object.
+        * ('move', str_id, index): move the object to index in its list.
+
+    :param obj: the loaded root object
+    :type obj: :class:`Element`
+    :param operations: the operations to apply
+    :type operations: list of tuple
+    """
+    for operation in operations:
+        func = _operations.get(operation[0])
+        if not func:
+            raise Exception('Unsupported operation %s' % operation[0])
+        func(obj, *operation[1:])
@@ -1,45 +1,134 @@
 #!/usr/bin/env python
 
 import os
+import mmap
+import itertools
+import collections
+import multiprocessing
+import StringIO
+import json
 from lxml import etree
-from StringIO import StringIO
 import dtd_parser
 import utils
 import elements
+import metrics
 
+# The buffers accepted by load and load_string
+BUFFER_TYPES = (bytearray, memoryview, mmap.mmap)
 
+
+@metrics.measured('load')
 def load(filename, validate=True):
     """Generate a python object
 
-    :param filename: the XML filename we should load
+    :param filename: the XML filename we should load, a file object or a
+        buffer containing the XML (see :func:`load_string`)
     :param validate: validate the XML before generating the python object.
     :type filename: str
     :type validate: bool
     :return: the generated python object
     :rtype: :class:`Element`
+
+    ..note:: When the cache of the documents is enabled (see
+    :func:`xmltool.elements.set_document_cache`), the object of a filename
+    is a clone of its cached document.
     """
-    tree = etree.parse(filename)
-    dtd_url = tree.docinfo.system_url
+    if isinstance(filename, BUFFER_TYPES):
+        return load_string(filename, validate)
+    if (elements._document_cache is not None and
+            isinstance(filename, basestring)):
+        return _load_cached(filename, validate)
+    return _load(filename, validate)
+
+
+def _load(filename, validate):
+    with metrics.phase('xml_parse') as phase:
+        tree = etree.parse(filename, utils.get_xml_parser())
+        if phase.enabled and isinstance(filename, basestring):
+            phase.set(bytes=os.path.getsize(filename))
     path = isinstance(filename, basestring) and os.path.dirname(filename) or None
-    dtd_str = utils.get_dtd_content(dtd_url, path)
+    return _load_tree(tree, filename, path, validate)
+
+
+_loads = utils.SingleFlight()
+
+
+def _load_document(key, filename, stamp, validate):
+    obj = _load(filename, validate)
+    cache = elements._document_cache
+    if cache is not None:
+        cache.set(key, (stamp, validate, obj, stamp[1]))
+    return obj
+
+
+def _load_cached(filename, validate):
+    """Get a clone of the cached document of filename, the file is loaded
+    when it's not cached or when it has changed.
+    """
+    key = os.path.abspath(filename)
+    st = os.stat(filename)
+    stamp = (st.st_mtime, st.st_size, st.st_ino)
+    entry = elements._document_cache.get(key)
+    if entry is not None and entry[0] == stamp and (entry[1] or not validate):
+        obj = entry[2]
+    else:
+        # The concurrent loads of the same file wait for the first one
+        obj = _loads.call((key, stamp, validate), _load_document, key,
+                          filename, stamp, validate)
+    with metrics.phase('clone'):
+        obj = obj.clone()
+    obj._xml_filename = filename
+    return obj
+
+
+def _parse_buffer(data):
+    """Parse the XML of a buffer by feeding the parser with chunks, lxml
+    only parses strings.
+    """
+    parser = utils.get_xml_parser()
+    try:
+        for chunk in utils.iter_buffer_chunks(data):
+            parser.feed(chunk)
+    except:
+        # Reset the parser, it's reused by the thread
+        try:
+            parser.close()
+        except etree.XMLSyntaxError:
+            pass
+        raise
+    return parser.close().getroottree()
+
+
+def _load_tree(tree, filename, path, validate):
+    """Generate the python object of the parsed tree
+    """
+    dtd_url = tree.docinfo.system_url
+    dtd_str = utils.get_dtd_content(dtd_url, path, tree.docinfo.public_id)
     if validate:
         utils.validate_xml(tree, dtd_str)
 
     dic = dtd_parser.parse(dtd_str=dtd_str)
     root = tree.getroot()
     obj = dic[root.tag]()
-    obj.load_from_xml(root)
+    with metrics.phase('load_from_xml') as phase:
+        # The tree is only used by obj, it doesn't need to be copied
+        etree.indent(root)
+        obj._load_from_xml(root)
+        if phase.enabled:
+            phase.set(nodes=sum(1 for e in root.iter()))
     obj._xml_filename = filename
     obj._xml_dtd_url = dtd_url
     obj._xml_encoding = tree.docinfo.encoding
     return obj
 
 
+@metrics.measured('load_string')
 def load_string(xml_str, validate=True):
     """Generate a python object
 
-    :param xml_str: the XML file as string
-    :type xml_str: str
+    :param xml_str: the XML file as string or as buffer, the buffers are
+        parsed by chunks without copying all their content.
+    :type xml_str: str, unicode, bytearray, memoryview or mmap.mmap
     :param validate: validate the XML before generating the python object.
     :type validate: bool
     :return: the generated python object
@@ -47,10 +136,207 @@ def load_string(xml_str, validate=True):
     """
     if type(xml_str) == unicode:
         xml_str = xml_str.encode('utf-8')
-    return load(StringIO(xml_str), validate)
+    with metrics.phase('xml_parse', bytes=len(xml_str)):
+        if isinstance(xml_str, BUFFER_TYPES):
+            tree = _parse_buffer(xml_str)
+        else:
+            # Parse the string directly, without copying it in a file object
+            tree = etree.fromstring(xml_str,
+                                    utils.get_xml_parser()).getroottree()
+    return _load_tree(tree, None, None, validate)
+
+
+def load_async(filename, validate=True, callback=None):
+    """Same as :func:`load` but the file is loaded in the executor (see
+    :func:`xmltool.utils.run_async`), the caller is not blocked.
+
+    :param callback: function called with the python object when it's
+        loaded.
+    :type callback: function
+    :return: the result, use its get method to wait for the python object.
+    :rtype: multiprocessing.pool.AsyncResult
+    """
+    return utils.run_async(load, (filename, validate), callback=callback)
+
+
+class _SubtreeLoader(object):
+    """Generate the python objects of the subtrees, it's created in each
+    process of :func:`map_subtrees`.
+    """
+
+    def __init__(self, dtd_url, dtd_str, tag, validate=False, func=None,
+                 level=0):
+        dic = dtd_parser.parse(dtd_str=dtd_str)
+        if tag not in dic:
+            raise Exception('Invalid tag %s' % tag)
+        self.cls = dic[tag]
+        self.dtd_url = dtd_url
+        self.dtd_obj = None
+        if validate:
+            self.dtd_obj = etree.DTD(StringIO.StringIO(dtd_str))
+        self.func = func
+        # The level of the elements in the document
+        self.level = level
+
+    def load(self, xml, comments):
+        if self.dtd_obj is not None:
+            with metrics.phase('validate'):
+                self.dtd_obj.assertValid(xml)
+        obj = self.cls()
+        etree.indent(xml, level=self.level)
+        obj._load_from_xml(xml, comments)
+        obj._xml_dtd_url = self.dtd_url
+        return obj
+
+    def run(self, subtrees):
+        parser = utils.get_xml_parser()
+        return [self.func(self.load(etree.fromstring(s, parser), comments))
+                for s, comments in subtrees]
+
+
+# The loader of the processes of map_subtrees
+_subtree_loader = None
+
+
+def _init_subtree_worker(*args):
+    global _subtree_loader
+    _subtree_loader = _SubtreeLoader(*args)
+
+
+def _run_subtrees(subtrees):
+    return _subtree_loader.run(subtrees)
+
+
+def _iter_subtree_nodes(filename, tag):
+    """Iterate over the tag nodes of filename while parsing it, with the
+    texts of the comments just before them.
+    """
+    context = etree.iterparse(
+        filename, events=('end',), tag=tag,
+        huge_tree=utils._xml_parser_options.get('huge_tree', False))
+    for event, elem in context:
+        comments = []
+        previous = elem.getprevious()
+        while isinstance(previous, etree._Comment):
+            comments += [previous]
+            previous = previous.getprevious()
+        comments.reverse()
+        yield elem, [c.text for c in comments]
+        # Don't keep the processed subtrees and their comments in the
+        # parsed document
+        parent = elem.getparent()
+        if parent is not None:
+            for c in comments:
+                parent.remove(c)
+            parent.remove(elem)
+
+
+def _get_subtree_loader_args(elem, filename, tag, validate, func=None):
+    docinfo = elem.getroottree().docinfo
+    path = isinstance(filename, basestring) and os.path.dirname(filename) or None
+    dtd_url = docinfo.system_url
+    dtd_str = utils.get_dtd_content(dtd_url, path, docinfo.public_id)
+    level = sum(1 for e in elem.iterancestors())
+    return (dtd_url, dtd_str, tag, validate, func, level)
+
+
+def iter_subtrees(filename, tag, validate=False):
+    """Generate the python objects of the tag elements of filename one by
+    one. The file is parsed while iterating, the whole document is never
+    loaded.
+
+    :param filename: the XML filename or file object
+    :type filename: str
+    :param tag: the tag of the elements to generate, it should be a
+        repeated tag like the items of a list but not contained in itself.
+    :type tag: str
+    :param validate: validate each element with the DTD before generating
+        its python object.
+    :type validate: bool
+    :return: the python objects
+    :rtype: generator of :class:`Element`
+
+    ..note:: The comment of an object is made of the comments just before
+    its element, the comments after the last element are ignored.
+    """
+    loader = None
+    for elem, comments in _iter_subtree_nodes(filename, tag):
+        if loader is None:
+            loader = _SubtreeLoader(*_get_subtree_loader_args(
+                elem, filename, tag, validate))
+        yield loader.load(elem, comments)
+
+
+def _iter_chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 
-def generate_form(filename, form_action=None, form_filename=None, validate=True):
+def map_subtrees(func, filename, tag, jobs=None, chunksize=100,
+                 validate=False):
+    """Call func on the python object of each tag element of filename (see
+    :func:`iter_subtrees`) in a pool of processes.
+
+    The file is parsed in the current process, the elements are sent as
+    XML by chunks to the processes and their python objects are generated
+    there. The number of chunks waiting for the processes is limited, the
+    memory doesn't depend on the size of the file.
+
+    :param func: the function to call on each python object, its results
+        need to be picklable. It should be defined at the top level of a
+        module.
+    :type func: function
+    :param filename: the XML filename or file object
+    :type filename: str
+    :param tag: the tag of the elements to process
+    :type tag: str
+    :param jobs: the number of processes, by default the number of CPUs.
+        If it's 1, the elements are processed in the current process.
+    :type jobs: int
+    :param chunksize: the number of elements sent at once to a process
+    :type chunksize: int
+    :param validate: validate each element with the DTD before generating
+        its python object.
+    :type validate: bool
+    :return: the results of func in the order of the elements
+    :rtype: generator
+    """
+    if jobs == 1:
+        for obj in iter_subtrees(filename, tag, validate):
+            yield func(obj)
+        return
+
+    nodes = _iter_subtree_nodes(filename, tag)
+    first = next(nodes, None)
+    if first is None:
+        return
+    args = _get_subtree_loader_args(first[0], filename, tag, validate, func)
+    jobs = jobs or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(jobs, _init_subtree_worker, args)
+    try:
+        pending = collections.deque()
+        subtrees = ((etree.tostring(elem, with_tail=False), comments)
+                    for elem, comments in itertools.chain([first], nodes))
+        for chunk in _iter_chunks(subtrees, chunksize):
+            pending.append(pool.apply_async(_run_subtrees, (chunk,)))
+            if len(pending) > jobs * 2:
+                for result in pending.popleft().get():
+                    yield result
+        while pending:
+            for result in pending.popleft().get():
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+@metrics.measured('generate_form')
+def generate_form(filename, form_action=None, form_filename=None, validate=True,
+                  limit=None):
     """Generate the HTML form for the given filename.
 
     :param filename: the XML filename we should load
@@ -59,17 +345,22 @@ def generate_form(filename, form_action=None, form_filename=None, validate=True)
     :type form_action: str
     :param validate: validate the XML before generating the form.
     :type validate: bool
+    :param limit: the maximum number of items to render for each list. The
+        next ones are loaded on demand with :func:`get_list_html`.
+    :type limit: int
     :return: the generated HTML form
     :rtype: str
     """
     if not form_filename:
         form_filename = filename
     obj = load(filename, validate)
-    return generate_form_from_obj(obj, form_action, form_filename, validate)
+    return generate_form_from_obj(obj, form_action, form_filename, validate,
+                                  limit)
 
 
+@metrics.measured('generate_form_from_obj')
 def generate_form_from_obj(obj, form_action=None, form_filename=None,
-                           validate=True):
+                           validate=True, limit=None):
     hidden_inputs = (
         '<input type="hidden" name="_xml_filename" '
         'id="_xml_filename" value="%s" />'
@@ -90,12 +381,58 @@ def generate_form_from_obj(obj, form_action=None, form_filename=None,
     else:
         html += ['<form method="POST" id="xmltool-form">']
     html += [hidden_inputs]
-    html += [obj.to_html()]
+    with metrics.phase('to_html') as phase:
+        html += [obj.to_html(limit=limit)]
+        phase.set(bytes=len(html[-1]))
     html += ['</form>']
     return ''.join(html)
 
 
-def update(filename, data, validate=True, transform=None):
+@metrics.measured('get_list_html')
+def get_list_html(filename, str_id, start=None, limit=None, validate=True):
+    """Get the HTML of the next items of a list of a form generated with a
+    limit.
+
+    :param filename: the XML filename we should load
+    :type filename: str
+    :param str_id: the data-id of the button to load the next items
+    :type str_id: str
+    :param start: the position of the first item to render
+    :type start: int
+    :param limit: the maximum number of items to render
+    :type limit: int
+    :param validate: validate the XML before generating the HTML.
+    :type validate: bool
+    :return: the HTML of the items
+    :rtype: str
+    """
+    obj = load(filename, validate)
+    return elements.get_list_html_from_str_id(obj, str_id, start, limit)
+
+
+@metrics.measured('get_jstree_children')
+def get_jstree_children(filename, tree_id, max_depth=1, validate=True):
+    """Get the jstree children of a closed node of the tree generated with
+    a max_depth, it's called by the jstree when the node is opened.
+
+    :param filename: the XML filename we should load
+    :type filename: str
+    :param tree_id: the id of the jstree node
+    :type tree_id: str
+    :param max_depth: the number of levels to render
+    :type max_depth: int
+    :param validate: validate the XML before generating the children.
+    :type validate: bool
+    :return: the jstree data of the children, to return as JSON
+    :rtype: list
+    """
+    obj = load(filename, validate)
+    return elements.get_jstree_children(obj, tree_id, max_depth)
+
+
+@metrics.measured('update')
+def update(filename, data, validate=True, transform=None, fsync=False,
+           lock=False):
     """Update the file named filename with data.
 
     :param filename: the XML filename we should update
@@ -107,9 +444,23 @@ def update(filename, data, validate=True, transform=None):
     :param transform: function to transform the XML string just before
         writing it.
     :type transform: function
+    :param fsync: flush the file to the disk before returning.
+    :type fsync: bool
+    :param lock: lock the file during the writing, useful when it can be
+        updated by multiple threads or processes at the same time.
+    :type lock: bool
     :return: the object generated from the data
     :rtype: :class:`Element`
+
+    ..note:: when the form is submitted with the partial option, data
+        contains the operations in the _xml_operations field, only these
+        operations are applied to the file (see :func:`update_partial`).
     """
+    if '_xml_operations' in data:
+        operations = get_operations(data['_xml_operations'])
+        return update_partial(filename, operations, validate, transform,
+                              fsync, lock)
+
     data = utils.unflatten_params(data)
     encoding = data.pop('_xml_encoding')
     dtd_url = data.pop('_xml_dtd_url')
@@ -122,10 +473,118 @@ def update(filename, data, validate=True, transform=None):
     obj = dic[root_tag]()
 
     obj.load_from_dict(data)
-    obj.write(filename, encoding, dtd_url, validate, transform)
+    with metrics.phase('write'):
+        obj.write(filename, encoding, dtd_url, validate, transform, fsync,
+                  lock)
+    return obj
+
+
+def update_async(filename, data, validate=True, transform=None,
+                 fsync=False, lock=False, callback=None):
+    """Same as :func:`update` but the file is updated in the executor (see
+    :func:`xmltool.utils.run_async`), the caller is not blocked.
+
+    :param callback: function called with the python object when the file
+        is written.
+    :type callback: function
+    :return: the result, use its get method to wait for the python object.
+    :rtype: multiprocessing.pool.AsyncResult
+    """
+    return utils.run_async(
+        update, (filename, data, validate, transform, fsync, lock),
+        callback=callback)
+
+
+# The number of items of each operation, the name included
+_operation_lengths = {
+    'set': 3,
+    'add': 2,
+    'delete': 2,
+    'move': 3,
+}
+
+
+def get_operations(operations_str):
+    """Get the operations submitted by the form in the _xml_operations field.
+
+    :param operations_str: the operations encoded in JSON
+    :type operations_str: str
+    :return: the operations to give to :func:`update_partial`
+    :rtype: list of tuple
+    """
+    try:
+        operations = json.loads(operations_str)
+    except (TypeError, ValueError):
+        raise Exception('Bad operations')
+
+    if not isinstance(operations, list):
+        raise Exception('Bad operations')
+
+    lis = []
+    for operation in operations:
+        if (not isinstance(operation, list) or
+                not operation or
+                not isinstance(operation[0], basestring) or
+                _operation_lengths.get(operation[0]) != len(operation) or
+                not isinstance(operation[1], basestring)):
+            raise Exception('Bad operation %s' % (operation,))
+        if operation[0] == 'set':
+            if (operation[2] is not None and
+                    not isinstance(operation[2], basestring)):
+                raise Exception('Bad operation %s' % (operation,))
+        elif operation[0] == 'move':
+            if (not isinstance(operation[2], int) or
+                    isinstance(operation[2], bool)):
+                raise Exception('Bad operation %s' % (operation,))
+        lis.append(tuple(operation))
+    return lis
+
+
+@metrics.measured('update_partial')
+def update_partial(filename, operations, validate=True, transform=None,
+                   fsync=False, lock=False):
+    """Update the file named filename with the operations made in the form.
+
+    Only the changes are sent by the form, the other parts of the file are
+    kept as loaded.
+
+    :param filename: the XML filename we should update
+    :param operations: the operations to apply (see
+        :func:`xmltool.elements.apply_operations`)
+    :param validate: validate the updated XML before writing it.
+    :type filename: str
+    :type operations: list of tuple
+    :type validate: bool
+    :param transform: function to transform the XML string just before
+        writing it.
+    :type transform: function
+    :param fsync: flush the file to the disk before returning.
+    :type fsync: bool
+    :param lock: lock the file during the update, useful when it can be
+        updated by multiple threads or processes at the same time.
+    :type lock: bool
+    :return: the updated object
+    :rtype: :class:`Element`
+    """
+    if lock:
+        # Lock during the loading to not lose the concurrent updates
+        with utils.file_lock(filename):
+            return _update_partial(filename, operations, validate, transform,
+                                   fsync)
+    return _update_partial(filename, operations, validate, transform, fsync)
+
+
+def _update_partial(filename, operations, validate, transform, fsync):
+    obj = load(filename, validate=False)
+    with metrics.phase('apply_operations'):
+        elements.apply_operations(obj, operations)
+    with metrics.phase('write'):
+        obj.write(filename, validate=validate, transform=transform,
+                  fsync=fsync)
     return obj
 
 
+@metrics.measured('new')
 def new(dtd_url, root_tag, form_action=None):
     dic = dtd_parser.parse(dtd_url=dtd_url)
     obj = dic[root_tag]()
@@ -150,6 +609,8 @@ def new(dtd_url, root_tag, form_action=None):
     else:
         html += ['<form method="POST" id="xmltool-form">']
     html += [hidden_inputs]
-    html += [obj.to_html()]
+    with metrics.phase('to_html') as phase:
+        html += [obj.to_html()]
+        phase.set(bytes=len(html[-1]))
     html += ['</form>']
     return ''.join(html)
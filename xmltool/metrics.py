@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+"""Measure the phases of the loading, the validation, the rendering and the
+writing of the XML files.
+
+Nothing is measured by default. The measures are sent to the handlers added
+with :func:`add_handler` and to the :func:`collect` contexts of the current
+thread. A handler is called with the name of the phase, its duration in
+seconds and a dict of information like the number of nodes or of bytes.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+import utils
+
+
+_handlers = []
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class _NoopPhase(object):
+    """The phase used when nothing is measured
+    """
+    enabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+    def set(self, **info):
+        pass
+
+
+_noop_phase = _NoopPhase()
+
+
+class Phase(object):
+    """A measured phase, use set to add some information.
+    """
+    enabled = True
+
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        duration = time.time() - self.start
+        if exc_type is not None:
+            self.info['error'] = exc_type.__name__
+        _emit(self.name, duration, self.info)
+        return False
+
+    def set(self, **info):
+        self.info.update(info)
+
+
+def _emit(name, duration, info):
+    for handler in list(_handlers):
+        handler(name, duration, info)
+    for events in getattr(_local, 'collectors', []):
+        events.append((name, duration, info))
+
+
+def _is_enabled():
+    """Check the phases of the current thread are measured: there is a
+    handler or a collect context in this thread.
+    """
+    return bool(_handlers or getattr(_local, 'collectors', None))
+
+
+def phase(name, **info):
+    """Measure the phase name.
+
+    :param name: the name of the phase
+    :type name: str
+    :param info: the information about the phase
+    :return: a context manager, its enabled attribute is False when nothing
+        is measured to skip the computation of the information.
+    """
+    if not _is_enabled():
+        return _noop_phase
+    return Phase(name, info)
+
+
+def measured(name):
+    """Decorator measuring the calls of the function as the phase name.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _is_enabled():
+                return func(*args, **kwargs)
+            with Phase(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_handler(handler):
+    """Add a function called with the name, the duration and the
+    information of each measured phase.
+
+    :param handler: the function to call
+    :type handler: function
+    """
+    with _lock:
+        _handlers.append(handler)
+
+
+def remove_handler(handler):
+    """Remove a handler added with :func:`add_handler`.
+    """
+    with _lock:
+        _handlers.remove(handler)
+
+
+@contextmanager
+def collect():
+    """Collect the phases measured by the current thread in the context.
+
+    :return: the list of the collected (name, duration, info)
+    :rtype: list
+    """
+    events = []
+    collectors = _local.__dict__.setdefault('collectors', [])
+    collectors.append(events)
+    try:
+        yield events
+    finally:
+        # The contexts of a thread are nested
+        collectors.pop()
+
+
+class PrometheusHandler(object):
+    """Handler aggregating the phases to export them in the Prometheus text
+    format.
+
+    For each phase, we count the calls and the errors, we sum the durations
+    and the numerical information.
+    """
+
+    def __init__(self, prefix='xmltool'):
+        self.prefix = prefix
+        self._phases = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, name, duration, info):
+        with self._lock:
+            stats = self._phases.setdefault(
+                name, {'count': 0, 'errors': 0, 'seconds': 0.0, 'info': {}})
+            stats['count'] += 1
+            stats['seconds'] += duration
+            if 'error' in info:
+                stats['errors'] += 1
+            for k, v in info.items():
+                if isinstance(v, (int, long, float)):
+                    stats['info'][k] = stats['info'].get(k, 0) + v
+
+    def to_text(self):
+        """Get the metrics in the Prometheus text format
+
+        :rtype: str
+        """
+        with self._lock:
+            phases = sorted(self._phases.items())
+            metric = '%s_phase_seconds' % self.prefix
+            lines = ['# HELP %s Duration of the phases' % metric,
+                     '# TYPE %s summary' % metric]
+            for name, stats in phases:
+                lines += ['%s_count{phase="%s"} %s' % (metric, name,
+                                                       stats['count'])]
+                lines += ['%s_sum{phase="%s"} %s' % (metric, name,
+                                                     stats['seconds'])]
+
+            metric = '%s_phase_errors_total' % self.prefix
+            lines += ['# HELP %s Number of phases which raised an error' %
+                      metric,
+                      '# TYPE %s counter' % metric]
+            for name, stats in phases:
+                lines += ['%s{phase="%s"} %s' % (metric, name,
+                                                 stats['errors'])]
+
+            info_names = set()
+            for name, stats in phases:
+                info_names.update(stats['info'])
+            for info_name in sorted(info_names):
+                metric = '%s_phase_%s_total' % (self.prefix, info_name)
+                lines += ['# TYPE %s counter' % metric]
+                for name, stats in phases:
+                    if info_name in stats['info']:
+                        lines += ['%s{phase="%s"} %s' % (
+                            metric, name, stats['info'][info_name])]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        """Write the metrics in filename, for example for the textfile
+        collector of the Prometheus node exporter.
+
+        :param filename: the filename to write
+        :type filename: str
+        """
+        with utils.atomic_open(filename) as f:
+            f.write(self.to_text())
@@ -1,11 +1,25 @@
 #!/usr/bin/env python
 
 import os
+import stat
 import urllib2
 import StringIO
+import uuid
+import threading
+import weakref
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
+from contextlib import contextmanager
 from lxml import etree
 import re
 import webob
+import metrics
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, we only lock between the threads.
+    fcntl = None
 
 
 # This hack helps work with different versions of WebOb
@@ -26,22 +40,204 @@ def is_http_url(url):
     return False
 
 
-def get_dtd_content(url, path=None):
+def _fetch_url(url):
+    req = urllib2.Request(url)
+    response = urllib2.urlopen(req)
+    s = response.read()
+    response.close()
+    return s
+
+
+# The local files of the DTD urls and public ids
+_catalog = {}
+# The DTD contents loaded by preload_catalog
+_catalog_contents = {}
+
+
+def add_catalog_entry(key, filename):
+    """Use the local file filename for the DTD url or public id key.
+
+    :param key: the url or the public id of the DTD
+    :type key: str
+    :param filename: the local file of the DTD
+    :type filename: str
+    """
+    _catalog[key] = os.path.abspath(filename)
+
+
+def load_catalog(filename):
+    """Add the entries of an XML catalog file to the catalog.
+
+    The system, uri and public entries are supported, the relative uris are
+    resolved from the directory of the catalog file.
+
+    :param filename: the catalog filename
+    :type filename: str
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    tree = etree.parse(filename)
+    for elt in tree.getroot().iter(etree.Element):
+        tagname = etree.QName(elt).localname
+        if tagname == 'system':
+            key = elt.get('systemId')
+        elif tagname == 'uri':
+            key = elt.get('name')
+        elif tagname == 'public':
+            key = elt.get('publicId')
+        else:
+            continue
+        uri = elt.get('uri')
+        if uri.startswith('file://'):
+            uri = uri[len('file://'):]
+        add_catalog_entry(key, os.path.join(dirname, uri))
+
+
+def clear_catalog():
+    """Remove all the entries of the catalog.
+    """
+    _catalog.clear()
+    _catalog_contents.clear()
+
+
+def get_catalog_filename(url, public_id=None):
+    """Get the local file of a DTD from the catalog.
+
+    :param url: the url of the DTD
+    :type url: str
+    :param public_id: the public id of the DTD
+    :type public_id: str
+    :return: the filename or None if the DTD is not in the catalog
+    :rtype: str
+    """
+    filename = _catalog.get(url)
+    if filename is None and public_id:
+        filename = _catalog.get(public_id)
+    return filename
+
+
+def preload_catalog():
+    """Read and check all the DTDs of the catalog, the next calls of
+    :func:`get_dtd_content` use the loaded contents.
+
+    :return: the loaded filenames
+    :rtype: list
+    """
+    for filename in set(_catalog.values()):
+        content = open(filename, 'r').read()
+        # Raise an error now for an invalid DTD
+        etree.DTD(StringIO.StringIO(content))
+        _catalog_contents[filename] = content
+    return sorted(_catalog_contents)
+
+
+class CatalogResolver(etree.Resolver):
+    """lxml resolver using the local files of the catalog.
+    """
+
+    def resolve(self, url, public_id, context):
+        filename = get_catalog_filename(url, public_id)
+        if filename is None:
+            return None
+        content = _catalog_contents.get(filename)
+        if content is not None:
+            return self.resolve_string(content, context)
+        return self.resolve_filename(filename, context)
+
+
+# The default options of the XML parsers, we don't use the ids of lxml.
+DEFAULT_XML_PARSER_OPTIONS = {
+    'collect_ids': False,
+    'huge_tree': False,
+    'no_network': True,
+    'remove_blank_text': False,
+    'resolve_entities': True,
+}
+_xml_parser_options = DEFAULT_XML_PARSER_OPTIONS
+# The parsers can't be shared between the threads
+_xml_parsers = threading.local()
+
+
+def set_xml_parser_options(**options):
+    """Set the options of the XML parsers returned by
+    :func:`get_xml_parser`, the options not given take their default value
+    (see DEFAULT_XML_PARSER_OPTIONS).
+
+    :param options: the keyword arguments of etree.XMLParser
+    """
+    global _xml_parser_options
+    new_options = dict(DEFAULT_XML_PARSER_OPTIONS)
+    new_options.update(options)
+    _xml_parser_options = new_options
+
+
+def get_xml_parser():
+    """Get the XML parser of the current thread. It's created on the first
+    call or when the options have changed, the DTDs are resolved with the
+    catalog.
+
+    :rtype: etree.XMLParser
+    """
+    options = _xml_parser_options
+    parser = getattr(_xml_parsers, 'parser', None)
+    if parser is None or _xml_parsers.options is not options:
+        parser = etree.XMLParser(**options)
+        parser.resolvers.add(CatalogResolver())
+        _xml_parsers.parser = parser
+        _xml_parsers.options = options
+    return parser
+
+
+def iter_buffer_chunks(data, size=1024 * 1024):
+    """Iterate over the content of a buffer by strings of size bytes, only
+    one chunk is copied at a time.
+
+    :param data: the buffer
+    :type data: str, bytearray, memoryview or mmap.mmap
+    :param size: the size of the chunks
+    :type size: int
+    :return: the chunks
+    :rtype: generator of str
+    """
+    if isinstance(data, memoryview):
+        for i in xrange(0, len(data), size):
+            yield data[i:i + size].tobytes()
+        return
+    for i in xrange(0, len(data), size):
+        yield str(buffer(data, i, size))
+
+
+def get_dtd_content(url, path=None, public_id=None):
     """Get the content of url.
 
+    The DTDs of the catalog (see :func:`add_catalog_entry`) are read from
+    their local file.
+
     :param url: the url of the dtd file.
     :type url: str
     :param path: the path to use for a local file.
     :type path: str
+    :param public_id: the public id of the dtd.
+    :type public_id: str
     :return: The content of the given url
     :rtype: string
     """
+    with metrics.phase('dtd_fetch', url=url) as phase:
+        content = _get_dtd_content(url, path, public_id)
+        phase.set(bytes=len(content))
+    return content
+
+
+def _get_dtd_content(url, path, public_id):
+    filename = get_catalog_filename(url, public_id)
+    if filename is not None:
+        content = _catalog_contents.get(filename)
+        if content is None:
+            content = open(filename, 'r').read()
+        return content
+
     if is_http_url(url):
-        req = urllib2.Request(url)
-        response = urllib2.urlopen(req)
-        s = response.read()
-        response.close()
-        return s
+        # The concurrent requests of the same url wait for the same fetch
+        return _dtd_fetches.call(url, _fetch_url, url)
 
     if path and not url.startswith('/'):
         url = os.path.join(path, url)
@@ -58,11 +254,408 @@ def validate_xml(xml_obj, dtd_str):
     :return: True. Raise an exception if the XML is not valid
     :rtype: bool
     """
-    dtd_obj = etree.DTD(StringIO.StringIO(dtd_str))
-    dtd_obj.assertValid(xml_obj)
+    with metrics.phase('validate'):
+        dtd_obj = etree.DTD(StringIO.StringIO(dtd_str))
+        dtd_obj.assertValid(xml_obj)
+    return True
+
+
+class _DtdResolver(etree.Resolver):
+    """lxml resolver giving the content of the dtd to the validating parser
+    """
+
+    def __init__(self, dtd_str):
+        super(_DtdResolver, self).__init__()
+        self.dtd_str = dtd_str
+
+    def resolve(self, url, public_id, context):
+        return self.resolve_string(self.dtd_str, context)
+
+
+def _get_id_attributes(dtd_obj):
+    """Get the names of the ID and IDREF(S) attributes of each tag
+    """
+    ids = {}
+    refs = {}
+    for elt in dtd_obj.iterelements():
+        for attr in elt.iterattributes():
+            if attr.type == 'id':
+                ids.setdefault(elt.name, []).append(attr.name)
+            elif attr.type in ('idref', 'idrefs'):
+                refs.setdefault(elt.name, []).append(attr.name)
+    return ids, refs
+
+
+def validate_xml_file(filename, dtd_str):
+    """Validate an XML file while parsing it, the whole tree is never in
+    memory.
+
+    Each element is validated by the parser when its end tag is parsed, then
+    its children are removed. The parser doesn't check the IDREF attributes,
+    we check them at the end of the file.
+
+    :param filename: The XML filename or file object to validate
+    :type filename: str
+    :param dtd_str: The dtd to use for the validation, the one of the
+        doctype is ignored
+    :type dtd_str: str
+    :return: True. Raise etree.DocumentInvalid if the XML is not valid
+    :rtype: bool
+    """
+    with metrics.phase('validate'):
+        ids, refs = _get_id_attributes(etree.DTD(StringIO.StringIO(dtd_str)))
+        context = etree.iterparse(
+            filename, events=('end',), dtd_validation=True, load_dtd=True,
+            huge_tree=_xml_parser_options.get('huge_tree', False))
+        context.resolvers.add(_DtdResolver(dtd_str))
+        defined = set()
+        referenced = set()
+        try:
+            for event, elem in context:
+                for name in ids.get(elem.tag, ()):
+                    value = elem.get(name)
+                    if value is None:
+                        continue
+                    if value in defined:
+                        raise etree.DocumentInvalid(
+                            'ID %s already defined, line %s' % (
+                                value, elem.sourceline))
+                    defined.add(value)
+                for name in refs.get(elem.tag, ()):
+                    referenced.update((elem.get(name) or '').split())
+                if len(elem):
+                    # The parent only needs elem to validate its content
+                    del elem[:]
+        except etree.XMLSyntaxError, e:
+            raise etree.DocumentInvalid(str(e))
+        unknown = referenced - defined
+        if unknown:
+            raise etree.DocumentInvalid(
+                'IDREF attribute references an unknown ID "%s"' % (
+                    sorted(unknown)[0]))
     return True
 
 
+def _fsync_dir(dirname):
+    """Flush the directory entries of dirname to the disk
+    """
+    if os.name == 'nt':
+        # We can't open a directory on Windows
+        return
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def atomic_open(filename, fsync=False):
+    """Open a temporary file to write the content of filename.
+
+    The temporary file replaces filename when we leave the context without
+    error, so the readers never see a partial file. It gets the permissions
+    and, when possible, the owner of the replaced file. The symlinks are
+    followed: the file they point to is replaced.
+
+    :param filename: the filename we want to write
+    :type filename: str
+    :param fsync: flush the file and the rename to the disk before returning.
+    :type fsync: bool
+    :return: the opened temporary file
+    :rtype: file
+    """
+    filename = os.path.realpath(filename)
+    dirname, basename = os.path.split(filename)
+    tmp_filename = os.path.join(
+        dirname, '.%s.%s.tmp' % (basename, uuid.uuid4().hex))
+    try:
+        st = os.stat(filename)
+    except OSError:
+        st = None
+    if st is None:
+        # Create the file like open does to have the same permissions
+        fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        os.close(fd)
+    else:
+        # Nobody else can read the content before we set the permissions
+        fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        os.close(fd)
+        try:
+            if hasattr(os, 'chown'):
+                try:
+                    os.chown(tmp_filename, st.st_uid, st.st_gid)
+                except OSError:
+                    # Only root can give a file to another user
+                    pass
+            os.chmod(tmp_filename, stat.S_IMODE(st.st_mode))
+        except:
+            os.remove(tmp_filename)
+            raise
+    f = open(tmp_filename, 'wb')
+    try:
+        yield f
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+        f.close()
+        if os.name == 'nt' and os.path.exists(filename):
+            # We can't rename on an existing file on Windows
+            os.remove(filename)
+        os.rename(tmp_filename, filename)
+    except:
+        f.close()
+        os.remove(tmp_filename)
+        raise
+    if fsync:
+        _fsync_dir(dirname)
+
+
+_thread_locks = weakref.WeakValueDictionary()
+_thread_locks_lock = threading.Lock()
+# The files locked by the current thread
+_locked_files = threading.local()
+
+
+def _get_thread_lock(filename):
+    with _thread_locks_lock:
+        lock = _thread_locks.get(filename)
+        if lock is None:
+            lock = threading.Lock()
+            _thread_locks[filename] = lock
+        return lock
+
+
+def get_lock_filename(filename):
+    """Get the file used by :func:`file_lock` to lock filename between the
+    processes, it's hidden in the directory of filename.
+
+    ..note:: The lock file is never removed: a process can wait for the lock
+    on it while another one removes it, then both would hold the lock.
+
+    :param filename: the locked filename
+    :type filename: str
+    :return: the lock filename
+    :rtype: str
+    """
+    dirname, basename = os.path.split(os.path.realpath(filename))
+    return os.path.join(dirname, '.%s.lock' % basename)
+
+
+@contextmanager
+def file_lock(filename):
+    """Lock filename for writing.
+
+    The lock is taken between the threads of the process and, when fcntl is
+    available, with an advisory lock on a hidden file next to filename for
+    the other processes (see :func:`get_lock_filename`).
+
+    :param filename: the filename we want to write
+    :type filename: str
+
+    ..note:: Like :func:`atomic_open`, the symlinks are followed: we lock
+    the file they point to.
+    """
+    filename = os.path.realpath(filename)
+    locked = _locked_files.__dict__.setdefault('filenames', set())
+    if filename in locked:
+        # Already locked by this thread
+        yield
+        return
+
+    lock = _get_thread_lock(filename)
+    with lock:
+        locked.add(filename)
+        try:
+            if fcntl is None:
+                yield
+                return
+            # We can't lock filename itself since it's replaced when written
+            lock_file = open(get_lock_filename(filename), 'a')
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            finally:
+                lock_file.close()
+        finally:
+            locked.remove(filename)
+
+
+class LRUCache(object):
+    """A thread safe cache which drops the least recently used items when
+    it's full.
+
+    :param maxsize: the maximum size of the cache
+    :type maxsize: int
+    :param getsize: the function giving the size of a value, each value
+        counts as 1 by default.
+    :type getsize: function
+    """
+
+    def __init__(self, maxsize, getsize=None):
+        self.maxsize = maxsize
+        self.getsize = getsize or (lambda value: 1)
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                return default
+            # Put it at the end, it's the most recently used
+            self._data[key] = (value, size)
+            return value
+
+    def set(self, key, value):
+        size = self.getsize(value)
+        with self._lock:
+            if key in self._data:
+                self.size -= self._data.pop(key)[1]
+            if size > self.maxsize:
+                # We can't keep it
+                return
+            self._data[key] = (value, size)
+            self.size += size
+            while self.size > self.maxsize:
+                self.size -= self._data.popitem(last=False)[1][1]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                return default
+            self.size -= size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+class SingleFlight(object):
+    """Make the concurrent calls for the same key wait on the result of the
+    first one instead of calling the function again.
+
+    The number of calls of the function and of the coalesced calls which
+    waited for another one are counted in calls and coalesced.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def call(self, key, func, *args, **kwargs):
+        """Call func or wait for the result of the in-flight call of key.
+
+        :param key: the key identifying the call
+        :type key: hashable
+        :param func: the function to call
+        :type func: function
+        :return: the result of func, the exception raised by func is raised
+            in all the waiting threads.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'event': threading.Event()}
+                self._calls[key] = call
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call['event'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = func(*args, **kwargs)
+            return call['result']
+        except Exception, e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['event'].set()
+
+    def get_stats(self):
+        """Get the counters and the number of in-flight calls.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'coalesced': self.coalesced,
+                'in_flight': len(self._calls),
+            }
+
+
+_dtd_fetches = SingleFlight()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def set_executor(executor):
+    """Set the executor used to run the asynchronous calls.
+
+    :param executor: the executor, it should have the apply_async method
+        of multiprocessing.pool.ThreadPool. None to use the default one.
+    """
+    global _executor
+    with _executor_lock:
+        _executor = executor
+
+
+def get_executor():
+    """Get the executor used to run the asynchronous calls, by default a
+    pool of 4 threads created on the first call.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPool(4)
+        return _executor
+
+
+def run_async(func, args=(), kwargs=None, callback=None):
+    """Run func in the executor without blocking the caller.
+
+    :param func: the function to run
+    :type func: function
+    :param args: the positional arguments of func
+    :type args: tuple
+    :param kwargs: the keyword arguments of func
+    :type kwargs: dict
+    :param callback: function called in the executor with the result of
+        func when it succeeds.
+    :type callback: function
+    :return: the result, use its get method to wait for it.
+    :rtype: multiprocessing.pool.AsyncResult
+    """
+    return get_executor().apply_async(func, args, kwargs or {}, callback)
+
+
 def to_int(value):
     try:
         return int(value)
@@ -81,6 +674,24 @@ def truncate(s, limit=30):
     return s
 
 
+_escape_regex = re.compile(r'[&<>"\']')
+
+
+def escape_html(s):
+    """Escape s to put it in HTML, as text or as attribute value.
+
+    ..note:: Most of the values don't need to be escaped, we only search
+    them in this case.
+    """
+    if not _escape_regex.search(s):
+        return s
+    return (s.replace('&', '&amp;')
+             .replace('<', '&lt;')
+             .replace('>', '&gt;')
+             .replace('"', '&quot;')
+             .replace("'", '&#39;'))
+
+
 # Basically the same function as in tw2.core.validation.
 # We don't want to have a lot of dependancies just for this function.
 def unflatten_params(params):